@@ -157,10 +157,17 @@ def conversation_with_switching():
     print(f"       → 会清空对话历史")
     
     # 方式B: 保持历史继续对话 (推荐!)
-    print(f"\n方式B: agent.change_persona() 然后重新添加消息")
+    print(f"\n方式B: DynamicAgent(keep_history_on_switch=True) 切换时保留历史")
+    agent = DynamicAgent(keep_history_on_switch=True)
+    agent.initialize_persona_with_profile('analyst')
+    agent.add_to_history('user', '分析这个数据')
+    agent.add_to_history('assistant', '根据分析...')
+    analyst_id = agent.current_persona_id
     agent.change_persona()
     persona_new = agent.get_current_persona()
     print(f"✓ 现在是: {persona_new['agent_name']}")
+    print(f"✓ 对话消息数: {len(agent.get_conversation_history())}")
+    print(f"✓ 分析师说过的话: {len(agent.get_messages_by_persona(analyst_id))} 条")
 
 
 def switching_scenarios():
@@ -242,9 +249,10 @@ def quick_reference():
 └────────────────────────────────┴──────────────┴─────────────────────────────┘
 
 重要提示:
-  ✓ 所有 initialize_* 方法都会清空对话历史
+  ✓ 所有 initialize_* 方法默认会清空对话历史
   ✓ change_persona() 本质上是调用 initialize_persona()
-  ✓ 如果要保持对话，需要手动重新添加消息到历史中
+  ✓ 如果要保持对话，使用 DynamicAgent(keep_history_on_switch=True)
+  ✓ 每条消息都带有角色编号，get_messages_by_persona(id) 可按角色查看
   ✓ get_current_persona() 可以查看当前角色信息，不会改变角色
 """)
 
@@ -317,24 +325,20 @@ for profile in profiles:
 
 【例子5】保留对话历史切换角色的技巧:
 ────────────────────────────────
-agent = DynamicAgent()
+agent = DynamicAgent(keep_history_on_switch=True)
 
 # 初始化第一个角色并添加对话
 agent.initialize_persona_with_profile('analyst')
 agent.add_to_history('user', '分析问题')
 agent.add_to_history('assistant', '分析结果...')
+analyst_id = agent.current_persona_id
 
-# 保存当前历史
-history = agent.get_conversation_history()
-
-# 切换角色 (会清空历史)
+# 切换角色 (保留历史)
 agent.initialize_persona_with_profile('mentor')
 
-# 恢复历史
-for msg in history:
-    agent.add_to_history(msg['role'], msg['content'])
-
 # 继续使用新角色，但保留之前的对话上下文
+# 按角色查看消息
+analyst_messages = agent.get_messages_by_persona(analyst_id)
 """
     print(examples)
 
@@ -52,7 +52,7 @@ def simulate_response(agent: DynamicAgent, user_input: str) -> str:
 
 def interactive_chat():
     """交互式对话演示"""
-    agent = DynamicAgent()
+    agent = DynamicAgent(shuffle=True, keep_history_on_switch=True)  # 不重复地轮换角色，保留对话历史
     
     print("\n" + "╔" + "="*88 + "╗")
     print("║" + " "*88 + "║")
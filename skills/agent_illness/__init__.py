@@ -7,10 +7,12 @@ from .system_prompt import SystemPromptSkill
 from .agent_profiles import AgentProfileManager
 from .characteristics import CharacteristicManager
 from .dynamic_agent import DynamicAgent
+from .template import PromptTemplate
 
 __all__ = [
     'SystemPromptSkill',
     'AgentProfileManager',
     'CharacteristicManager',
-    'DynamicAgent'
+    'DynamicAgent',
+    'PromptTemplate'
 ]
@@ -3,9 +3,17 @@ Agent Profile Manager
 Manages different agent roles and profiles with random assignment
 """
 
+import bisect
 import random
-from typing import Dict, List, Optional
-from dataclasses import dataclass
+from functools import partial
+from typing import (
+    Any, Callable, Dict, Iterable, List, Mapping, MutableMapping, NamedTuple, Optional, Set, Tuple
+)
+from dataclasses import asdict, dataclass
+
+from .catalog import Interner, LazyCatalog
+from .sampling import KeyIndex
+from .store import DEFAULT_CACHE_SIZE, SqliteCatalog
 
 
 @dataclass
@@ -17,56 +25,180 @@ class AgentProfile:
     expertise_areas: List[str]
 
 
+def profile_from_record(record: Mapping[str, Any]) -> AgentProfile:
+    """Build an AgentProfile from a catalog record"""
+    return AgentProfile(
+        role=record['role'],
+        name=record['name'],
+        description=record['description'],
+        expertise_areas=list(record.get('expertise_areas', []))
+    )
+
+
+class CompactAgentProfile(NamedTuple):
+    """
+    Immutable variant of AgentProfile for very large catalogs
+    A tuple with empty __slots__, so instances carry no per-instance __dict__.
+    Roles and expertise area strings are shared through the catalog's Interner
+    """
+    role: str
+    name: str
+    description: str
+    expertise_areas: Tuple[str, ...] = ()
+    
+    @classmethod
+    def from_profile(cls, profile: AgentProfile,
+                     interner: Optional[Interner] = None) -> 'CompactAgentProfile':
+        """Build the compact form of an AgentProfile"""
+        return compact_profile_from_record(asdict(profile), interner)
+    
+    def to_record(self) -> Dict[str, Any]:
+        """Fields in catalog record form, as written by write_catalog"""
+        record = self._asdict()
+        record['expertise_areas'] = list(self.expertise_areas)
+        return record
+    
+    def to_profile(self) -> AgentProfile:
+        """Build the equivalent mutable AgentProfile"""
+        return profile_from_record(self.to_record())
+
+
+def compact_profile_from_record(record: Mapping[str, Any],
+                                interner: Optional[Interner] = None) -> CompactAgentProfile:
+    """
+    Build a CompactAgentProfile from a catalog record
+    Roles and expertise areas are shared through interner, the catalog's string pool
+    """
+    intern = Interner() if interner is None else interner
+    return CompactAgentProfile(
+        role=intern(record['role']),
+        name=record['name'],
+        description=record['description'],
+        expertise_areas=tuple(intern(area) for area in record.get('expertise_areas', []))
+    )
+
+
+def normalize_expertise(term: str) -> str:
+    """Normalize an expertise term for indexing and lookup"""
+    return ' '.join(term.lower().split())
+
+
+def _expertise_terms(profile: AgentProfile) -> Set[str]:
+    """Index terms of a profile: each normalized expertise area and its words"""
+    terms = set()
+    for area in profile.expertise_areas:
+        normalized = normalize_expertise(area)
+        if normalized:
+            terms.add(normalized)
+            terms.update(normalized.split())
+    return terms
+
+
+def _default_profiles() -> Dict[str, AgentProfile]:
+    """Build the predefined agent profiles"""
+    return {
+        'researcher': AgentProfile(
+            role='Research Expert',
+            name='Dr. Alexandria',
+            description='A scholarly researcher focused on in-depth analysis and discovery',
+            expertise_areas=['research', 'analysis', 'data interpretation', 'literature review']
+        ),
+        'educator': AgentProfile(
+            role='Educator',
+            name='Professor Marcus',
+            description='A patient educator who excels at explaining complex concepts clearly',
+            expertise_areas=['teaching', 'explanation', 'learning guidance', 'simplification']
+        ),
+        'mentor': AgentProfile(
+            role='Career Mentor',
+            name='Coach Jordan',
+            description='A supportive mentor focused on growth and development',
+            expertise_areas=['career guidance', 'motivation', 'skill development', 'advice']
+        ),
+        'innovator': AgentProfile(
+            role='Innovation Specialist',
+            name='Dr. Nova',
+            description='A creative innovator who thinks outside the box',
+            expertise_areas=['ideation', 'innovation', 'creativity', 'problem-solving']
+        ),
+        'analyst': AgentProfile(
+            role='Data Analyst',
+            name='Alex Sterling',
+            description='A detail-oriented analyst who focuses on patterns and insights',
+            expertise_areas=['data analysis', 'statistics', 'pattern recognition', 'reporting']
+        ),
+        'strategist': AgentProfile(
+            role='Strategic Advisor',
+            name='Morgan Chase',
+            description='A strategic thinker focused on long-term planning and outcomes',
+            expertise_areas=['strategy', 'planning', 'forecasting', 'decision-making']
+        ),
+    }
+
+
 class AgentProfileManager:
     """Manages a collection of agent profiles with random selection"""
     
-    def __init__(self):
-        """Initialize with predefined agent profiles"""
-        self.profiles: Dict[str, AgentProfile] = {
-            'researcher': AgentProfile(
-                role='Research Expert',
-                name='Dr. Alexandria',
-                description='A scholarly researcher focused on in-depth analysis and discovery',
-                expertise_areas=['research', 'analysis', 'data interpretation', 'literature review']
-            ),
-            'educator': AgentProfile(
-                role='Educator',
-                name='Professor Marcus',
-                description='A patient educator who excels at explaining complex concepts clearly',
-                expertise_areas=['teaching', 'explanation', 'learning guidance', 'simplification']
-            ),
-            'mentor': AgentProfile(
-                role='Career Mentor',
-                name='Coach Jordan',
-                description='A supportive mentor focused on growth and development',
-                expertise_areas=['career guidance', 'motivation', 'skill development', 'advice']
-            ),
-            'innovator': AgentProfile(
-                role='Innovation Specialist',
-                name='Dr. Nova',
-                description='A creative innovator who thinks outside the box',
-                expertise_areas=['ideation', 'innovation', 'creativity', 'problem-solving']
-            ),
-            'analyst': AgentProfile(
-                role='Data Analyst',
-                name='Alex Sterling',
-                description='A detail-oriented analyst who focuses on patterns and insights',
-                expertise_areas=['data analysis', 'statistics', 'pattern recognition', 'reporting']
-            ),
-            'strategist': AgentProfile(
-                role='Strategic Advisor',
-                name='Morgan Chase',
-                description='A strategic thinker focused on long-term planning and outcomes',
-                expertise_areas=['strategy', 'planning', 'forecasting', 'decision-making']
-            ),
-        }
+    def __init__(self, profiles: Optional[MutableMapping[str, AgentProfile]] = None):
+        """
+        Initialize with predefined agent profiles, or with the given catalog
+        (e.g. a file-backed LazyCatalog from from_catalog)
+        """
+        self.profiles: MutableMapping[str, AgentProfile] = (
+            _default_profiles() if profiles is None else profiles
+        )
         self.current_profile: Optional[AgentProfile] = None
+        self.current_profile_key: Optional[str] = None
+        # Keys, weights and listeners for sampling; also follows profiles
+        # other processes add to a shared store
+        self._keys = KeyIndex(self.profiles, 'Profile', self._index_added_profile)
+        # Inverted index of expertise term -> profile keys, with the terms kept
+        # sorted for prefix queries; built on first query so file-backed
+        # catalogs are not materialized up front
+        self._expertise_index: Optional[Dict[str, Set[str]]] = None
+        self._sorted_expertise_terms: List[str] = []
+    
+    @classmethod
+    def from_catalog(cls, path: str, compact: bool = False) -> 'AgentProfileManager':
+        """
+        Create a manager over a JSONL/JSON profile catalog file
+        Profiles are built only when first used, as CompactAgentProfile
+        instances if compact is set
+        """
+        factory = partial(compact_profile_from_record, interner=Interner()) \
+            if compact else profile_from_record
+        return cls(LazyCatalog(path, factory))
+    
+    @classmethod
+    def from_sqlite(cls, path: str, compact: bool = False,
+                    cache_size: int = DEFAULT_CACHE_SIZE) -> 'AgentProfileManager':
+        """
+        Create a manager over a SQLite profile store, creating it if needed
+        Role and expertise lookups are indexed queries behind an LRU of
+        cache_size profiles; the database can be shared between processes
+        """
+        factory = partial(compact_profile_from_record, interner=Interner()) \
+            if compact else profile_from_record
+        return cls(SqliteCatalog(path, 'profiles', factory, columns=('role',),
+                                 terms=_expertise_terms, cache_size=cache_size))
     
-    def get_random_profile(self) -> AgentProfile:
-        """Select and return a random agent profile"""
-        self.current_profile = random.choice(list(self.profiles.values()))
+    def get_random_profile(self, rng: Optional[random.Random] = None) -> AgentProfile:
+        """
+        Select and return a random agent profile
+        Honors profile weights once any have been set
+        """
+        key = self.sample_profile_key(rng)
+        self.current_profile_key = key
+        self.current_profile = self.profiles[key]
         return self.current_profile
     
+    def sample_profile_key(self, rng: Optional[random.Random] = None) -> str:
+        """
+        Draw a random profile key without changing the current profile
+        Honors profile weights once any have been set
+        """
+        return self._keys.sample_key(rng)
+    
     def get_profile_by_role(self, role: str) -> Optional[AgentProfile]:
         """Get a specific profile by role key"""
         return self.profiles.get(role)
@@ -77,7 +209,143 @@ class AgentProfileManager:
     
     def add_profile(self, key: str, profile: AgentProfile) -> None:
         """Add a new profile to the collection"""
+        if not self._keys.add(key) and self._expertise_index is not None:
+            self._unindex_expertise(key, self.profiles[key])
         self.profiles[key] = profile
+        if self._expertise_index is not None:
+            self._index_expertise(key, profile)
+        self._keys.listeners.notify(key)
+    
+    def _index_added_profile(self, key: str) -> None:
+        """Index the expertise of a profile another process added to the store"""
+        if self._expertise_index is not None:
+            self._index_expertise(key, self.profiles[key])
+    
+    def find_profiles_by_expertise(self, terms: Iterable[str], match: str = 'all',
+                                   prefix: bool = False) -> List[str]:
+        """
+        Find profile keys by expertise using the inverted index
+        Args:
+            terms: Expertise areas or single words, matched case-insensitively
+            match: 'all' for profiles covering every term (AND), 'any' for
+                profiles covering at least one (OR)
+            prefix: Treat each term as a prefix of indexed terms
+        Returns matching keys in catalog order
+        """
+        if match not in ('all', 'any'):
+            raise ValueError(f"Match mode must be 'all' or 'any', got '{match}'")
+        self._keys.refresh()
+        # Stores that index expertise terms themselves answer lookups directly
+        find_term = getattr(self.profiles, 'find_term', None)
+        if find_term is None:
+            index = self._get_expertise_index()
+        
+        result: Optional[Set[str]] = None
+        for term in terms:
+            term = normalize_expertise(term)
+            if find_term is not None:
+                keys = find_term(term, prefix)
+            else:
+                keys = self._lookup_expertise(index, term, prefix)
+            if result is None:
+                result = set(keys)
+            elif match == 'all':
+                result &= keys
+            else:
+                result |= keys
+            if not result and match == 'all':
+                return []
+        
+        if not result:
+            return []
+        # A shared store may return keys added after the refresh; they sort last
+        positions = self._keys.positions
+        return sorted(result, key=lambda key: (positions.get(key, len(positions)), key))
+    
+    def _lookup_expertise(self, index: Dict[str, Set[str]], term: str, prefix: bool) -> Set[str]:
+        """Return the keys indexed under a term, or under every term it prefixes"""
+        if not prefix:
+            return index.get(term, set())
+        terms = self._sorted_expertise_terms
+        keys: Set[str] = set()
+        position = bisect.bisect_left(terms, term)
+        while position < len(terms) and terms[position].startswith(term):
+            keys |= index[terms[position]]
+            position += 1
+        return keys
+    
+    def _get_expertise_index(self) -> Dict[str, Set[str]]:
+        """Return the expertise index, building it on first use"""
+        if self._expertise_index is None:
+            self._expertise_index = {}
+            self._sorted_expertise_terms = []
+            for key in self._keys.keys:
+                self._index_expertise(key, self.profiles[key])
+        return self._expertise_index
+    
+    def _index_expertise(self, key: str, profile: AgentProfile) -> None:
+        """Add a profile's expertise terms to the index"""
+        index = self._expertise_index
+        for term in _expertise_terms(profile):
+            keys = index.get(term)
+            if keys is None:
+                keys = index[term] = set()
+                bisect.insort(self._sorted_expertise_terms, term)
+            keys.add(key)
+    
+    def _unindex_expertise(self, key: str, profile: AgentProfile) -> None:
+        """Remove a profile's expertise terms from the index"""
+        index = self._expertise_index
+        for term in _expertise_terms(profile):
+            keys = index.get(term)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del index[term]
+                terms = self._sorted_expertise_terms
+                del terms[bisect.bisect_left(terms, term)]
+    
+    def get_profile_keys(self) -> List[str]:
+        """
+        Get all profile keys in insertion order
+        Returns the live index used for sampling; do not modify it
+        """
+        self._keys.refresh()
+        return self._keys.keys
+    
+    def set_profile_weight(self, key: str, weight: float) -> None:
+        """
+        Set the relative sampling weight of a profile (default 1.0)
+        Once any weight is set, random selection becomes weighted
+        """
+        self._keys.set_weight(key, weight)
+    
+    def get_profile_weight(self, key: str) -> float:
+        """Get the sampling weight of a profile"""
+        return self._keys.get_weight(key)
+    
+    def is_weighted(self) -> bool:
+        """Whether random selection uses profile weights"""
+        return self._keys.weighted
+    
+    def sample_profile_indices(self, k: int, rng: Optional[random.Random] = None) -> List[int]:
+        """
+        Draw k profile indices (positions in get_profile_keys()) in one call
+        Weighted when weights are set, uniform otherwise
+        """
+        return self._keys.sample_indices(k, rng)
+    
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        Register a callback invoked with the key of every added profile
+        Bound methods are held weakly (see ListenerList)
+        """
+        self._keys.listeners.add(listener)
+    
+    def remove_listener(self, listener: Callable[[str], None]) -> None:
+        """Unregister a callback registered with add_listener"""
+        self._keys.listeners.remove(listener)
     
     def get_current_profile(self) -> Optional[AgentProfile]:
         """Get the currently active profile"""
@@ -0,0 +1,187 @@
+"""
+Benchmarks
+Micro-benchmarks for the per-turn prompt path
+Run from the skills directory: python -m agent_illness.benchmarks
+"""
+
+import random
+import timeit
+from typing import Callable, Dict
+
+from .agent_profiles import AgentProfile, AgentProfileManager
+from .characteristics import CharacteristicManager, TalkingStyle
+from .system_prompt import SystemPromptSkill
+
+
+# The str.format template SystemPromptSkill rendered before it was compiled
+_LEGACY_TEMPLATE = """You are {agent_name}, a {role}.
+
+## Identity
+- Role: {role}
+- Name: {agent_name}
+- Expertise Areas: {expertise_areas}
+- Description: {description}
+
+## Communication Style
+- Tone: {tone}
+- Formality Level: {formality}
+- Pace: {pace}
+- Verbosity: {verbosity}
+- Personality Traits: {personality_traits}
+
+## Communication Patterns
+{communication_patterns}
+
+## Behavioral Guidelines
+1. Maintain your assigned role and expertise consistently
+2. Communicate in the specified tone and formality level
+3. Adapt your response pace to the conversation needs
+4. Provide responses matching your verbosity preference
+5. Demonstrate the personality traits listed above
+6. Follow the communication patterns for greetings, explanations, and closings
+
+## Core Instructions
+- Always stay in character as {agent_name}
+- Use your expertise areas to provide valuable insights
+- Follow your communication style guidelines in every interaction
+- Be helpful, honest, and harmless while maintaining your persona
+- Adapt your responses to the user's needs while staying true to your characteristics
+"""
+
+
+def _legacy_format_prompt(profile: AgentProfile, style: TalkingStyle) -> str:
+    """Render a prompt the way SystemPromptSkill did with str.format"""
+    communication_patterns_str = '\n'.join([
+        f"  - {key.capitalize()}: {value}"
+        for key, value in style.communication_patterns.items()
+    ])
+    return _LEGACY_TEMPLATE.format(
+        agent_name=profile.name,
+        role=profile.role,
+        expertise_areas=', '.join(profile.expertise_areas),
+        description=profile.description,
+        tone=style.tone,
+        formality=style.formality,
+        pace=style.pace,
+        verbosity=style.verbosity,
+        personality_traits=', '.join(style.personality_traits),
+        communication_patterns=communication_patterns_str
+    )
+
+
+def _time_per_call(func: Callable[[], object], iterations: int) -> float:
+    """Return the best per-call time in microseconds over a few repeats"""
+    best = min(timeit.repeat(func, number=iterations, repeat=5))
+    return best / iterations * 1e6
+
+
+def bench_prompt_rendering(iterations: int = 20000) -> Dict[str, float]:
+    """
+    Compare legacy str.format rendering with the compiled template
+    Returns microseconds per call for each rendering path
+    """
+    skill = SystemPromptSkill()
+    profile = skill.profile_manager.get_profile_by_role('researcher')
+    style = skill.characteristic_manager.get_style_by_name('professional')
+    context = skill._build_context(profile, style)
+
+    return {
+        'str.format (_format_prompt before)': _time_per_call(
+            lambda: _legacy_format_prompt(profile, style), iterations),
+        'compiled (_format_prompt)': _time_per_call(
+            lambda: skill._format_prompt(profile, style), iterations),
+        'compiled render only': _time_per_call(
+            lambda: skill.compiled_template.render(context), iterations),
+        'cached (generate_system_prompt_custom)': _time_per_call(
+            lambda: skill.generate_system_prompt_custom('researcher', 'professional'),
+            iterations),
+    }
+
+
+def bench_batch_generation(n: int = 10000) -> Dict[str, float]:
+    """
+    Compare n calls to generate_system_prompt with one batch call
+    Returns microseconds per generated prompt
+    """
+    skill = SystemPromptSkill()
+
+    def one_at_a_time():
+        for _ in range(n):
+            skill.generate_system_prompt()
+
+    return {
+        'generate_system_prompt() x n': _time_per_call(one_at_a_time, 1) / n,
+        'generate_system_prompts_batch(n)': _time_per_call(
+            lambda: skill.generate_system_prompts_batch(n, seed=0), 1) / n,
+        'generate_system_prompts_batch(n, as_handles)': _time_per_call(
+            lambda: skill.generate_system_prompts_batch(n, seed=0, as_handles=True), 1) / n,
+    }
+
+
+def _generated_profile_manager(size: int) -> AgentProfileManager:
+    """Build a profile manager padded with generated profiles"""
+    manager = AgentProfileManager()
+    for index in range(size):
+        manager.add_profile(f'generated_{index}', AgentProfile(
+            role=f'Generated Role {index}',
+            name=f'Persona {index}',
+            description='A generated persona',
+            expertise_areas=['generation', f'topic {index % 100}']
+        ))
+    return manager
+
+
+def bench_random_sampling(catalog_size: int = 50000,
+                          iterations: int = 2000) -> Dict[str, float]:
+    """
+    Compare copying the catalog on every pick with the key index
+    Returns microseconds per random profile pick
+    """
+    manager = _generated_profile_manager(catalog_size)
+
+    return {
+        'random.choice(list(values())) (before)': _time_per_call(
+            lambda: random.choice(list(manager.profiles.values())), iterations),
+        'get_random_profile()': _time_per_call(manager.get_random_profile, iterations),
+    }
+
+
+def bench_style_filtering(catalog_size: int = 50000,
+                          iterations: int = 200) -> Dict[str, float]:
+    """
+    Compare scanning every style with the bitmap attribute index
+    Returns microseconds per "casual, fast, concise" query
+    """
+    manager = CharacteristicManager()
+    space = manager.get_style_space()
+    rng = random.Random(0)
+    for index in range(catalog_size):
+        manager.add_style(f'generated_{index}', space[space.sample_index(rng)])
+    manager.filter_styles()  # build the index outside the timed loop
+
+    def scan():
+        return [
+            style for style in manager.get_all_styles()
+            if style.formality == 'casual' and style.pace == 'fast' and style.verbosity == 'concise'
+        ]
+
+    return {
+        'scan get_all_styles() (before)': _time_per_call(scan, iterations),
+        'filter_styles()': _time_per_call(
+            lambda: manager.filter_styles(formality='casual', pace='fast', verbosity='concise'),
+            iterations),
+    }
+
+
+def _print_results(title: str, results: Dict[str, float]) -> None:
+    """Print one benchmark's results"""
+    print(title)
+    for name, micros in results.items():
+        print(f"  {name:<45} {micros:8.2f} us/call")
+
+
+if __name__ == '__main__':
+    _print_results("Prompt rendering", bench_prompt_rendering())
+    _print_results("Batch generation", bench_batch_generation())
+    _print_results("Random sampling (50k profiles)", bench_random_sampling())
+    _print_results("Style filtering (50k styles)", bench_style_filtering())
@@ -0,0 +1,176 @@
+"""
+Persona Catalogs
+File-backed profile and style catalogs that materialize entries only when used
+"""
+
+import json
+import mmap
+import re
+from collections.abc import MutableMapping
+from dataclasses import asdict
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional, Tuple, Union
+
+
+# Fast path for the index: records written by write_catalog start with "key"
+_KEY_PREFIX = re.compile(rb'\s*\{\s*"key"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def write_catalog(path: str, entries: Mapping[str, Any]) -> int:
+    """
+    Write profiles or styles to a JSONL catalog, one record per line with
+    the key first so LazyCatalog can index it without parsing the record
+    Returns the number of records written
+    """
+    count = 0
+    with open(path, 'w', encoding='utf-8') as catalog_file:
+        for key, entry in entries.items():
+            record = {'key': key}
+            # Compact entries convert themselves; dataclasses go through asdict
+            to_record = getattr(entry, 'to_record', None)
+            record.update(to_record() if to_record else asdict(entry))
+            catalog_file.write(json.dumps(record, ensure_ascii=False))
+            catalog_file.write('\n')
+            count += 1
+    return count
+
+
+class Interner:
+    """
+    Shares equal strings between the entries built for one catalog
+    Pass one to the compact entry factories of a catalog; unlike sys.intern
+    or a module-level pool, its strings are released with the catalog
+    """
+    
+    def __init__(self):
+        """Create an empty pool"""
+        self._strings: Dict[str, str] = {}
+    
+    def __call__(self, value: str) -> str:
+        """Return the shared copy of value"""
+        return self._strings.setdefault(value, value)
+    
+    def __len__(self) -> int:
+        """Number of distinct strings held"""
+        return len(self._strings)
+
+
+class LazyCatalog(MutableMapping):
+    """
+    A key -> entry mapping over a JSONL or JSON catalog file
+
+    JSONL files are memory-mapped and indexed as key -> (start, end) byte
+    offsets; a record is parsed and turned into an entry only on first
+    access. JSON files (an object keyed by entry key, or a list of records
+    with a "key" field) are parsed up front but still materialize entries
+    lazily. Entries added or replaced in memory take precedence over the file.
+    """
+
+    def __init__(self, path: str, factory: Callable[[Mapping[str, Any]], Any]):
+        """Open and index a catalog file"""
+        self.path = path
+        self.factory = factory
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        # key -> byte span in the mapped file, raw record, or None when the
+        # entry only exists in memory
+        self._index: Dict[str, Union[Tuple[int, int], Mapping[str, Any], None]] = {}
+        self._entries: Dict[str, Any] = {}
+
+        if path.endswith('.json'):
+            self._index_json()
+        else:
+            self._index_jsonl()
+
+    def _index_json(self) -> None:
+        """Index a JSON catalog"""
+        with open(self.path, encoding='utf-8') as catalog_file:
+            data = json.load(catalog_file)
+        if isinstance(data, dict):
+            self._index.update(data)
+        else:
+            for record in data:
+                self._index[record['key']] = record
+
+    def _index_jsonl(self) -> None:
+        """Memory-map a JSONL catalog and record the byte span of each line"""
+        self._file = open(self.path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self._file.close()
+            self._file = None
+            return
+
+        data = self._map
+        size = len(data)
+        start = 0
+        while start < size:
+            end = data.find(b'\n', start)
+            if end == -1:
+                end = size
+            match = _KEY_PREFIX.match(data, start, end)
+            if match:
+                key = json.loads(b'"' + match.group(1) + b'"')
+                self._index[key] = (start, end)
+            elif data[start:end].strip():
+                self._index[json.loads(data[start:end])['key']] = (start, end)
+            start = end + 1
+
+    def _read_record(self, key: str) -> Mapping[str, Any]:
+        """Return the raw record stored for key in the catalog file"""
+        location = self._index[key]
+        if isinstance(location, tuple):
+            start, end = location
+            return json.loads(self._map[start:end])
+        return location
+
+    def __getitem__(self, key: str) -> Any:
+        """Return an entry, materializing it from the file on first access"""
+        entry = self._entries.get(key)
+        if entry is None:
+            if key not in self._index:
+                raise KeyError(key)
+            entry = self._entries[key] = self.factory(self._read_record(key))
+        return entry
+
+    def __setitem__(self, key: str, entry: Any) -> None:
+        """Add or replace an entry in memory"""
+        if key not in self._index:
+            self._index[key] = None
+        self._entries[key] = entry
+
+    def __delitem__(self, key: str) -> None:
+        """Remove an entry"""
+        del self._index[key]
+        self._entries.pop(key, None)
+
+    def __contains__(self, key: object) -> bool:
+        """Check for a key without materializing its entry"""
+        return key in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate keys in file order, then keys added in memory"""
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        """Number of entries in the catalog"""
+        return len(self._index)
+
+    def materialized_count(self) -> int:
+        """Number of entries built so far"""
+        return len(self._entries)
+
+    def close(self) -> None:
+        """Release the memory map; entries already materialized stay usable"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __repr__(self) -> str:
+        """String representation of the catalog"""
+        return f"LazyCatalog({self.path!r}, entries={len(self)}, materialized={len(self._entries)})"
+
@@ -3,10 +3,19 @@ Characteristic Manager
 Manages agent talking styles and behavioral characteristics
 """
 
+import math
 import random
-from typing import Dict, List, Optional
+from functools import partial
+from typing import (
+    Any, Callable, Dict, Iterable, List, Mapping, MutableMapping, NamedTuple, Optional, Sequence,
+    Tuple, Union
+)
 from dataclasses import dataclass, field
 
+from .catalog import Interner, LazyCatalog
+from .sampling import KeyIndex
+from .store import DEFAULT_CACHE_SIZE, SqliteCatalog
+
 
 @dataclass
 class TalkingStyle:
@@ -20,101 +29,399 @@ class TalkingStyle:
     communication_patterns: Dict[str, str] = field(default_factory=dict)
 
 
+def style_from_record(record: Mapping[str, Any]) -> TalkingStyle:
+    """Build a TalkingStyle from a catalog record"""
+    return TalkingStyle(
+        name=record['name'],
+        tone=record['tone'],
+        formality=record['formality'],
+        pace=record['pace'],
+        verbosity=record['verbosity'],
+        personality_traits=list(record.get('personality_traits', [])),
+        communication_patterns=dict(record.get('communication_patterns', {}))
+    )
+
+
+class CompactTalkingStyle(NamedTuple):
+    """
+    Immutable variant of TalkingStyle for very large catalogs
+    A tuple with empty __slots__, so instances carry no per-instance __dict__.
+    The formality, pace, verbosity, trait and communication pattern strings
+    are shared through the catalog's Interner; traits and patterns are tuples.
+    Reads like a TalkingStyle, so it can be used wherever one is rendered
+    """
+    name: str
+    tone: str
+    formality: str
+    pace: str
+    verbosity: str
+    personality_traits: Tuple[str, ...] = ()
+    pattern_items: Tuple[Tuple[str, str], ...] = ()
+    
+    @classmethod
+    def from_style(cls, style: TalkingStyle,
+                   interner: Optional[Interner] = None) -> 'CompactTalkingStyle':
+        """Build the compact form of a TalkingStyle"""
+        return cls.from_values(
+            style.name, style.tone, style.formality, style.pace, style.verbosity,
+            style.personality_traits, style.communication_patterns, interner
+        )
+    
+    @classmethod
+    def from_values(cls, name: str, tone: str, formality: str, pace: str, verbosity: str,
+                    personality_traits: List[str],
+                    communication_patterns: Mapping[str, str],
+                    interner: Optional[Interner] = None) -> 'CompactTalkingStyle':
+        """
+        Build a compact style from TalkingStyle field values
+        Enum-like fields and the trait and pattern strings are shared
+        through interner, the catalog's string pool
+        """
+        intern = Interner() if interner is None else interner
+        return cls(
+            name,
+            tone,
+            intern(formality),
+            intern(pace),
+            intern(verbosity),
+            tuple(intern(trait) for trait in personality_traits),
+            tuple((intern(key), intern(value)) for key, value in communication_patterns.items())
+        )
+    
+    @property
+    def communication_patterns(self) -> Dict[str, str]:
+        """Communication patterns as a new dict"""
+        return dict(self.pattern_items)
+    
+    def to_record(self) -> Dict[str, Any]:
+        """Fields in catalog record form, as written by write_catalog"""
+        return {
+            'name': self.name,
+            'tone': self.tone,
+            'formality': self.formality,
+            'pace': self.pace,
+            'verbosity': self.verbosity,
+            'personality_traits': list(self.personality_traits),
+            'communication_patterns': self.communication_patterns,
+        }
+    
+    def to_style(self) -> TalkingStyle:
+        """Build the equivalent mutable TalkingStyle"""
+        return style_from_record(self.to_record())
+
+
+def compact_style_from_record(record: Mapping[str, Any],
+                              interner: Optional[Interner] = None) -> CompactTalkingStyle:
+    """Build a CompactTalkingStyle from a catalog record, sharing strings through interner"""
+    return CompactTalkingStyle.from_values(
+        record['name'],
+        record['tone'],
+        record['formality'],
+        record['pace'],
+        record['verbosity'],
+        record.get('personality_traits', []),
+        record.get('communication_patterns', {}),
+        interner
+    )
+
+
+def _style_attributes(style: TalkingStyle) -> List[Tuple[str, str]]:
+    """(attribute, value) pairs of a style covered by the bitmap index"""
+    attributes = [
+        ('formality', style.formality),
+        ('pace', style.pace),
+        ('verbosity', style.verbosity),
+        ('tone', style.tone),
+    ]
+    attributes.extend(('trait', trait) for trait in style.personality_traits)
+    return attributes
+
+
+def _bit_positions(bits: int) -> List[int]:
+    """Positions of the set bits of a non-negative int, in ascending order"""
+    # Scanning the reversed binary string runs in C, unlike per-bit int ops
+    digits = bin(bits)[:1:-1]
+    positions = []
+    position = digits.find('1')
+    while position != -1:
+        positions.append(position)
+        position = digits.find('1', position + 1)
+    return positions
+
+
+def _unrank_combination(rank: int, n: int, k: int) -> List[int]:
+    """Return the rank-th k-combination of range(n) in lexicographic order"""
+    combination = []
+    start = 0
+    for slots in range(k, 0, -1):
+        for candidate in range(start, n):
+            count = math.comb(n - candidate - 1, slots - 1)
+            if rank < count:
+                combination.append(candidate)
+                start = candidate + 1
+                break
+            rank -= count
+    return combination
+
+
+class StyleSpace:
+    """
+    Virtual catalog of every combination of style axis values
+    Each style is addressed by a mixed-radix integer index over the
+    formality, pace, verbosity and tone axes and a combination of
+    traits_per_style traits; TalkingStyles are built only when indexed,
+    so the product is never materialized
+    """
+    
+    def __init__(self, formality: Sequence[str], pace: Sequence[str], verbosity: Sequence[str],
+                 tone: Sequence[str], traits: Sequence[str], traits_per_style: int = 3):
+        """Define the space from the values of each axis"""
+        self.axes: Tuple[Tuple[str, ...], ...] = (
+            tuple(formality), tuple(pace), tuple(verbosity), tuple(tone)
+        )
+        self.traits: Tuple[str, ...] = tuple(traits)
+        if not all(self.axes):
+            raise ValueError("Every style axis needs at least one value")
+        if not 0 <= traits_per_style <= len(self.traits):
+            raise ValueError(f"Cannot pick {traits_per_style} of {len(self.traits)} traits")
+        self.traits_per_style = traits_per_style
+        self._trait_combinations = math.comb(len(self.traits), traits_per_style)
+        self._size = self._trait_combinations
+        for values in self.axes:
+            self._size *= len(values)
+    
+    @classmethod
+    def from_styles(cls, styles: Iterable[TalkingStyle], traits_per_style: int = 3) -> 'StyleSpace':
+        """Build the space spanned by the distinct axis values of some styles"""
+        axes: Tuple[Dict[str, None], ...] = ({}, {}, {}, {}, {})
+        for style in styles:
+            for values, value in zip(axes, (style.formality, style.pace, style.verbosity, style.tone)):
+                values[value] = None
+            for trait in style.personality_traits:
+                axes[4][trait] = None
+        return cls(*(list(values) for values in axes), traits_per_style=traits_per_style)
+    
+    def __len__(self) -> int:
+        """Number of styles in the space"""
+        return self._size
+    
+    def coordinates(self, index: int) -> Tuple[int, ...]:
+        """
+        Decode an index into (formality, pace, verbosity, tone, trait
+        combination rank) positions
+        """
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(f"Style index {index} out of range")
+        index, trait_rank = divmod(index, self._trait_combinations)
+        positions = []
+        for values in reversed(self.axes):
+            index, position = divmod(index, len(values))
+            positions.append(position)
+        positions.reverse()
+        positions.append(trait_rank)
+        return tuple(positions)
+    
+    def __getitem__(self, index: int) -> TalkingStyle:
+        """Build the style at an index"""
+        *positions, trait_rank = self.coordinates(index)
+        formality, pace, verbosity, tone = (
+            values[position] for values, position in zip(self.axes, positions)
+        )
+        traits = [
+            self.traits[position] for position in
+            _unrank_combination(trait_rank, len(self.traits), self.traits_per_style)
+        ]
+        return TalkingStyle(
+            name=f"Generated Style {index % self._size}",
+            tone=tone,
+            formality=formality,
+            pace=pace,
+            verbosity=verbosity,
+            personality_traits=traits
+        )
+    
+    def key(self, index: int) -> str:
+        """Key for the style at an index"""
+        return f"space_{index % self._size}"
+    
+    def index_of(self, key: str) -> Optional[int]:
+        """Index of the style a key from key() names, or None if it names none"""
+        prefix, _, digits = key.partition('_')
+        if prefix != 'space' or not digits.isdigit():
+            return None
+        index = int(digits)
+        return index if index < self._size else None
+    
+    def sample_index(self, rng: Optional[random.Random] = None) -> int:
+        """Draw a uniformly random index"""
+        return (rng or random).randrange(self._size)
+
+
+def _default_styles() -> Dict[str, TalkingStyle]:
+    """Build the predefined talking styles"""
+    return {
+        'enthusiastic': TalkingStyle(
+            name='Enthusiastic',
+            tone='excited and energetic',
+            formality='casual',
+            pace='fast',
+            verbosity='detailed',
+            personality_traits=['optimistic', 'engaging', 'motivating'],
+            communication_patterns={
+                'greeting': 'excited and warm',
+                'explanation': 'detailed with examples',
+                'closing': 'uplifting and encouraging'
+            }
+        ),
+        'professional': TalkingStyle(
+            name='Professional',
+            tone='formal and authoritative',
+            formality='formal',
+            pace='moderate',
+            verbosity='balanced',
+            personality_traits=['competent', 'trustworthy', 'precise'],
+            communication_patterns={
+                'greeting': 'formal and respectful',
+                'explanation': 'structured and clear',
+                'closing': 'professional and conclusive'
+            }
+        ),
+        'friendly': TalkingStyle(
+            name='Friendly',
+            tone='warm and approachable',
+            formality='casual',
+            pace='moderate',
+            verbosity='balanced',
+            personality_traits=['empathetic', 'supportive', 'relatable'],
+            communication_patterns={
+                'greeting': 'warm and personal',
+                'explanation': 'conversational',
+                'closing': 'friendly and open-ended'
+            }
+        ),
+        'analytical': TalkingStyle(
+            name='Analytical',
+            tone='logical and objective',
+            formality='professional',
+            pace='moderate',
+            verbosity='balanced',
+            personality_traits=['logical', 'methodical', 'data-driven'],
+            communication_patterns={
+                'greeting': 'straightforward',
+                'explanation': 'fact-based and structured',
+                'closing': 'evidence-based conclusion'
+            }
+        ),
+        'concise': TalkingStyle(
+            name='Concise',
+            tone='direct and efficient',
+            formality='professional',
+            pace='fast',
+            verbosity='concise',
+            personality_traits=['efficient', 'focused', 'precise'],
+            communication_patterns={
+                'greeting': 'brief and direct',
+                'explanation': 'minimal but comprehensive',
+                'closing': 'short and clear'
+            }
+        ),
+        'nurturing': TalkingStyle(
+            name='Nurturing',
+            tone='supportive and encouraging',
+            formality='casual',
+            pace='slow',
+            verbosity='detailed',
+            personality_traits=['caring', 'patient', 'encouraging'],
+            communication_patterns={
+                'greeting': 'warm and welcoming',
+                'explanation': 'step-by-step guidance',
+                'closing': 'supportive and affirming'
+            }
+        ),
+    }
+
+
 class CharacteristicManager:
     """Manages agent characteristics and talking styles"""
     
-    def __init__(self):
-        """Initialize with predefined talking styles"""
-        self.talking_styles: Dict[str, TalkingStyle] = {
-            'enthusiastic': TalkingStyle(
-                name='Enthusiastic',
-                tone='excited and energetic',
-                formality='casual',
-                pace='fast',
-                verbosity='detailed',
-                personality_traits=['optimistic', 'engaging', 'motivating'],
-                communication_patterns={
-                    'greeting': 'excited and warm',
-                    'explanation': 'detailed with examples',
-                    'closing': 'uplifting and encouraging'
-                }
-            ),
-            'professional': TalkingStyle(
-                name='Professional',
-                tone='formal and authoritative',
-                formality='formal',
-                pace='moderate',
-                verbosity='balanced',
-                personality_traits=['competent', 'trustworthy', 'precise'],
-                communication_patterns={
-                    'greeting': 'formal and respectful',
-                    'explanation': 'structured and clear',
-                    'closing': 'professional and conclusive'
-                }
-            ),
-            'friendly': TalkingStyle(
-                name='Friendly',
-                tone='warm and approachable',
-                formality='casual',
-                pace='moderate',
-                verbosity='balanced',
-                personality_traits=['empathetic', 'supportive', 'relatable'],
-                communication_patterns={
-                    'greeting': 'warm and personal',
-                    'explanation': 'conversational',
-                    'closing': 'friendly and open-ended'
-                }
-            ),
-            'analytical': TalkingStyle(
-                name='Analytical',
-                tone='logical and objective',
-                formality='professional',
-                pace='moderate',
-                verbosity='balanced',
-                personality_traits=['logical', 'methodical', 'data-driven'],
-                communication_patterns={
-                    'greeting': 'straightforward',
-                    'explanation': 'fact-based and structured',
-                    'closing': 'evidence-based conclusion'
-                }
-            ),
-            'concise': TalkingStyle(
-                name='Concise',
-                tone='direct and efficient',
-                formality='professional',
-                pace='fast',
-                verbosity='concise',
-                personality_traits=['efficient', 'focused', 'precise'],
-                communication_patterns={
-                    'greeting': 'brief and direct',
-                    'explanation': 'minimal but comprehensive',
-                    'closing': 'short and clear'
-                }
-            ),
-            'nurturing': TalkingStyle(
-                name='Nurturing',
-                tone='supportive and encouraging',
-                formality='casual',
-                pace='slow',
-                verbosity='detailed',
-                personality_traits=['caring', 'patient', 'encouraging'],
-                communication_patterns={
-                    'greeting': 'warm and welcoming',
-                    'explanation': 'step-by-step guidance',
-                    'closing': 'supportive and affirming'
-                }
-            ),
-        }
+    def __init__(self, talking_styles: Optional[MutableMapping[str, TalkingStyle]] = None):
+        """
+        Initialize with predefined talking styles, or with the given catalog
+        (e.g. a file-backed LazyCatalog from from_catalog)
+        """
+        self.talking_styles: MutableMapping[str, TalkingStyle] = (
+            _default_styles() if talking_styles is None else talking_styles
+        )
         self.current_style: Optional[TalkingStyle] = None
+        self.current_style_key: Optional[str] = None
+        # Keys, weights and listeners for sampling; also follows styles
+        # other processes add to a shared store
+        self._keys = KeyIndex(self.talking_styles, 'Style', self._index_added_style)
+        self.style_space: Optional[StyleSpace] = None
+        # (attribute, value) -> int bitset over key positions;
+        # built on the first filter and kept up to date by add_style
+        self._attribute_bitmaps: Optional[Dict[Tuple[str, str], int]] = None
     
-    def get_random_style(self) -> TalkingStyle:
-        """Select and return a random talking style"""
-        self.current_style = random.choice(list(self.talking_styles.values()))
+    @classmethod
+    def from_catalog(cls, path: str, compact: bool = False) -> 'CharacteristicManager':
+        """
+        Create a manager over a JSONL/JSON talking style catalog file
+        Styles are built only when first used, as CompactTalkingStyle
+        instances if compact is set
+        """
+        factory = partial(compact_style_from_record, interner=Interner()) \
+            if compact else style_from_record
+        return cls(LazyCatalog(path, factory))
+    
+    @classmethod
+    def from_sqlite(cls, path: str, compact: bool = False,
+                    cache_size: int = DEFAULT_CACHE_SIZE) -> 'CharacteristicManager':
+        """
+        Create a manager over a SQLite style store, creating it if needed
+        Name and attribute lookups are indexed queries behind an LRU of
+        cache_size styles; the database can be shared between processes
+        """
+        factory = partial(compact_style_from_record, interner=Interner()) \
+            if compact else style_from_record
+        return cls(SqliteCatalog(path, 'styles', factory,
+                                 columns=('formality', 'pace', 'verbosity'),
+                                 cache_size=cache_size))
+    
+    def get_random_style(self, rng: Optional[random.Random] = None) -> TalkingStyle:
+        """
+        Select and return a random talking style
+        Honors style weights once any have been set
+        """
+        key = self.sample_style_key(rng)
+        self.current_style_key = key
+        self.current_style = self.talking_styles[key]
         return self.current_style
     
+    def sample_style_key(self, rng: Optional[random.Random] = None) -> str:
+        """
+        Draw a random style key without changing the current style
+        Honors style weights once any have been set
+        """
+        return self._keys.sample_key(rng)
+    
     def get_style_by_name(self, name: str) -> Optional[TalkingStyle]:
-        """Get a specific style by name"""
-        return self.talking_styles.get(name)
+        """
+        Get a specific style by name
+        Style space keys (see sample_space_style_key) are built from the
+        space, which is derived from the catalog on first use
+        """
+        style = self.talking_styles.get(name)
+        if style is None and name.startswith('space_'):
+            index = self.get_style_space().index_of(name)
+            if index is not None:
+                style = self.style_space[index]
+        return style
+    
+    def is_catalog_style(self, key: str) -> bool:
+        """Whether a key names a catalog style rather than a generated space style"""
+        return key in self._keys
     
     def get_all_styles(self) -> List[TalkingStyle]:
         """Get all available talking styles"""
@@ -122,7 +429,176 @@ class CharacteristicManager:
     
     def add_style(self, key: str, style: TalkingStyle) -> None:
         """Add a new talking style to the collection"""
+        if not self._keys.add(key) and self._attribute_bitmaps is not None:
+            self._update_style_bits(key, self.talking_styles[key], False)
         self.talking_styles[key] = style
+        if self._attribute_bitmaps is not None:
+            self._update_style_bits(key, style, True)
+        self._keys.listeners.notify(key)
+    
+    def _index_added_style(self, key: str) -> None:
+        """Set the attribute bits of a style another process added to the store"""
+        if self._attribute_bitmaps is not None:
+            self._update_style_bits(key, self.talking_styles[key], True)
+    
+    def find_styles(self, formality: Optional[str] = None, pace: Optional[str] = None,
+                    verbosity: Optional[str] = None) -> List[str]:
+        """
+        Find style keys matching every given attribute, in catalog order
+        Runs as an indexed query when the styles live in a SQLite store
+        """
+        attributes = {
+            name: value for name, value in
+            (('formality', formality), ('pace', pace), ('verbosity', verbosity))
+            if value is not None
+        }
+        query = getattr(self.talking_styles, 'query', None)
+        if query is not None:
+            return query(**attributes)
+        return self.filter_styles(**attributes)
+    
+    def filter_styles(self, formality: Union[str, Iterable[str], None] = None,
+                      pace: Union[str, Iterable[str], None] = None,
+                      verbosity: Union[str, Iterable[str], None] = None,
+                      tone: Union[str, Iterable[str], None] = None,
+                      traits: Optional[Iterable[str]] = None,
+                      any_traits: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Find style keys with the bitmap attribute index, in catalog order
+        Args:
+            formality, pace, verbosity, tone: A value, or several values of
+                which a style must have one
+            traits: Traits a style must all have
+            any_traits: Traits a style must have at least one of
+        Given arguments are combined with AND
+        """
+        self._keys.refresh()
+        bitmaps = self._get_attribute_bitmaps()
+        result = (1 << len(self._keys)) - 1
+        for attribute, values in (('formality', formality), ('pace', pace),
+                                  ('verbosity', verbosity), ('tone', tone)):
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = (values,)
+            matches = 0
+            for value in values:
+                matches |= bitmaps.get((attribute, value), 0)
+            result &= matches
+        for trait in traits or ():
+            result &= bitmaps.get(('trait', trait), 0)
+        if any_traits is not None:
+            matches = 0
+            for trait in any_traits:
+                matches |= bitmaps.get(('trait', trait), 0)
+            result &= matches
+        
+        keys = self._keys.keys
+        return [keys[position] for position in _bit_positions(result)]
+    
+    def _get_attribute_bitmaps(self) -> Dict[Tuple[str, str], int]:
+        """Return the bitmap attribute index, building it on first use"""
+        if self._attribute_bitmaps is None:
+            # Set bits in byte arrays first; OR-ing into growing ints one
+            # style at a time would be quadratic
+            size = (len(self._keys) + 7) // 8
+            arrays: Dict[Tuple[str, str], bytearray] = {}
+            for position, key in enumerate(self._keys.keys):
+                for attribute in _style_attributes(self.talking_styles[key]):
+                    array = arrays.get(attribute)
+                    if array is None:
+                        array = arrays[attribute] = bytearray(size)
+                    array[position >> 3] |= 1 << (position & 7)
+            self._attribute_bitmaps = {
+                attribute: int.from_bytes(array, 'little') for attribute, array in arrays.items()
+            }
+        return self._attribute_bitmaps
+    
+    def _update_style_bits(self, key: str, style: TalkingStyle, present: bool) -> None:
+        """Set (or clear) a style's bit in the bitmap of each of its attributes"""
+        bitmaps = self._attribute_bitmaps
+        bit = 1 << self._keys.positions[key]
+        for attribute in _style_attributes(style):
+            if present:
+                bitmaps[attribute] = bitmaps.get(attribute, 0) | bit
+            else:
+                bitmaps[attribute] = bitmaps.get(attribute, 0) & ~bit
+    
+    def get_style_space(self, traits_per_style: int = 3) -> StyleSpace:
+        """
+        Get the virtual space of every combination of the catalog's
+        formality, pace, verbosity, tone and trait values
+        Built from the catalog on first use; set_style_space replaces it
+        """
+        if self.style_space is None:
+            self.style_space = StyleSpace.from_styles(
+                self.talking_styles.values(), traits_per_style
+            )
+        return self.style_space
+    
+    def set_style_space(self, space: StyleSpace) -> None:
+        """Use a custom style space"""
+        self.style_space = space
+    
+    def sample_space_style_key(self, rng: Optional[random.Random] = None) -> str:
+        """
+        Draw a random style space key without changing the current style
+        The style is not added to the catalog: its key (see StyleSpace.key)
+        resolves through get_style_by_name, so prompts can be rendered for
+        it while the catalog stays unchanged
+        """
+        space = self.get_style_space()
+        return space.key(space.sample_index(rng))
+    
+    def get_random_space_style(self, rng: Optional[random.Random] = None) -> TalkingStyle:
+        """
+        Draw a random style from the style space and make it current
+        Only the drawn style is built, and it is not added to the catalog
+        """
+        self.current_style_key = self.sample_space_style_key(rng)
+        self.current_style = self.get_style_by_name(self.current_style_key)
+        return self.current_style
+    
+    def get_style_keys(self) -> List[str]:
+        """
+        Get all style keys in insertion order
+        Returns the live index used for sampling; do not modify it
+        """
+        self._keys.refresh()
+        return self._keys.keys
+    
+    def set_style_weight(self, key: str, weight: float) -> None:
+        """
+        Set the relative sampling weight of a style (default 1.0)
+        Once any weight is set, random selection becomes weighted
+        """
+        self._keys.set_weight(key, weight)
+    
+    def get_style_weight(self, key: str) -> float:
+        """Get the sampling weight of a style"""
+        return self._keys.get_weight(key)
+    
+    def is_weighted(self) -> bool:
+        """Whether random selection uses style weights"""
+        return self._keys.weighted
+    
+    def sample_style_indices(self, k: int, rng: Optional[random.Random] = None) -> List[int]:
+        """
+        Draw k style indices (positions in get_style_keys()) in one call
+        Weighted when weights are set, uniform otherwise
+        """
+        return self._keys.sample_indices(k, rng)
+    
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        Register a callback invoked with the key of every added style
+        Bound methods are held weakly (see ListenerList)
+        """
+        self._keys.listeners.add(listener)
+    
+    def remove_listener(self, listener: Callable[[str], None]) -> None:
+        """Unregister a callback registered with add_listener"""
+        self._keys.listeners.remove(listener)
     
     def get_current_style(self) -> Optional[TalkingStyle]:
         """Get the currently active talking style"""
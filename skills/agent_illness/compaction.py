@@ -0,0 +1,111 @@
+"""
+History Compaction
+Replaces old conversation history with summaries produced off the caller's thread
+"""
+
+import re
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from .history import ConversationHistory, Message
+
+
+_SENTENCE_END = re.compile(r'(?<=[.!?。！？])\s')
+
+
+def truncating_summarizer(messages: List[Message], max_lines: int = 8,
+                          max_chars: int = 80) -> str:
+    """
+    Local stand-in summarizer: the first sentence of each of the newest
+    max_lines messages, truncated to max_chars characters
+    Output size is bounded however many messages are summarized
+    """
+    lines = []
+    for message in messages[-max_lines:]:
+        text = ' '.join(message['content'].split())
+        text = _SENTENCE_END.split(text, 1)[0]
+        if len(text) > max_chars:
+            text = text[:max_chars - 3].rstrip() + '...'
+        lines.append(f"- {message['role']}: {text}")
+    skipped = len(messages) - len(lines)
+    header = f"Summary of {len(messages)} earlier messages"
+    if skipped:
+        header += f" ({skipped} older ones omitted)"
+    return header + ':\n' + '\n'.join(lines)
+
+
+class HistoryCompactor:
+    """
+    Keeps history size roughly flat by summarizing old messages in the background
+
+    Once a history holds more than threshold messages, everything but the
+    newest keep_recent messages is handed to the summarizer on a worker
+    thread. The finished summary replaces those messages, as one message
+    with role summary_role, on the first append after it is ready, so
+    appends never wait for the summarizer. A summary is discarded if messages were removed
+    from the history in the meantime (eviction, clear or a persona reset),
+    or if the summarizer raised.
+    """
+
+    def __init__(self, threshold: int = 64, keep_recent: int = 16,
+                 summarizer: Callable[[List[Message]], str] = truncating_summarizer,
+                 executor: Optional[Executor] = None, summary_role: str = 'system'):
+        """
+        Configure when to compact, what to keep and how to summarize
+        Use summary_role='user' for histories sent as user/assistant turns
+        """
+        if not 0 <= keep_recent < threshold:
+            raise ValueError("keep_recent must be non-negative and below threshold")
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.summarizer = summarizer
+        self.summary_role = summary_role
+        self._executor = executor
+        self._owns_executor = executor is None
+        # (summary future, history, number of messages summarized, history version)
+        self._pending: Optional[Tuple[Future, ConversationHistory, int, int]] = None
+        self.compactions = 0
+
+    def after_append(self, history: ConversationHistory) -> bool:
+        """
+        Apply a finished summary and start a new one if the history is too long
+        Never blocks; returns True if a summary was applied
+        """
+        applied = False
+        if self._pending is not None and self._pending[0].done():
+            applied = self._apply()
+        if self._pending is None and len(history) > self.threshold:
+            self._submit(history)
+        return applied
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until a pending summary is ready and apply it; returns True if applied"""
+        if self._pending is None:
+            return False
+        self._pending[0].exception(timeout)  # waits without raising the summarizer's error
+        return self._apply()
+
+    def _submit(self, history: ConversationHistory) -> None:
+        """Snapshot the messages to summarize and hand them to the worker"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-compactor')
+        count = len(history) - self.keep_recent
+        messages = history[:count]
+        future = self._executor.submit(self.summarizer, messages)
+        self._pending = (future, history, count, history.version)
+
+    def _apply(self) -> bool:
+        """Replace the summarized messages if they are still where they were"""
+        future, history, count, version = self._pending
+        self._pending = None
+        if history.version != version or future.exception() is not None:
+            return False
+        history.replace_oldest(count, self.summary_role, future.result())
+        self.compactions += 1
+        return True
+
+    def shutdown(self) -> None:
+        """Stop the worker thread if this compactor created it"""
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -10,6 +10,8 @@ DEFAULT_CONFIG = {
     'enable_random_switching': False,
     'max_history_length': 1000,
     'auto_clear_history': False,
+    'history_resident_length': 256,  # messages kept in memory by the 'spill' history backend
+    'history_spill_dir': None,       # None = system temp directory
     'default_profile': None,  # None = random
     'default_style': None,    # None = random
     'logging_enabled': True,
@@ -3,8 +3,23 @@ Dynamic Agent
 A complete agent implementation that uses SystemPromptSkill to manage dynamic personas
 """
 
-from typing import Optional, Dict
-from .system_prompt import SystemPromptSkill
+import os
+import random
+import uuid
+from typing import Callable, Dict, List, Optional
+from .agent_profiles import AgentProfileManager
+from .characteristics import CharacteristicManager
+from .compaction import HistoryCompactor
+from .config import AgentConfig, get_global_config
+from .history import HISTORY_BACKENDS, ConversationHistory, Message
+from .router import PersonaRouter
+from .snapshot import AgentSnapshot, decode_snapshot, encode_snapshot
+from .system_prompt import PromptHandle, SystemPromptSkill
+from .tokenizer import Tokenizer
+
+
+# Snapshot placeholder for a reclaimed persona ID
+_FREE_PERSONA = PromptHandle(None, None)
 
 
 class DynamicAgent:
@@ -13,11 +28,88 @@ class DynamicAgent:
     based on the system prompt generated by SystemPromptSkill
     """
     
-    def __init__(self):
-        """Initialize the dynamic agent with system prompt skill"""
-        self.system_prompt_skill = SystemPromptSkill()
+    # Persona IDs no message is tagged with are reclaimed for reuse once more
+    # than this many (or twice the history length) are assigned
+    min_persona_table = 64
+    
+    def __init__(self, layout: str = 'standard', tokenizer: Optional[Tokenizer] = None,
+                 profile_manager: Optional[AgentProfileManager] = None,
+                 characteristic_manager: Optional[CharacteristicManager] = None,
+                 seed: Optional[int] = None, shuffle: bool = False,
+                 config: Optional[AgentConfig] = None,
+                 on_evict: Optional[Callable[[Message], None]] = None,
+                 history_backend: str = 'deque',
+                 compactor: Optional[HistoryCompactor] = None,
+                 keep_history_on_switch: bool = False,
+                 delta_role: str = 'system'):
+        """
+        Initialize the dynamic agent with system prompt skill
+        Args:
+            layout: Prompt layout passed to SystemPromptSkill ('standard' or
+                'prefix_cache' for a provider-cacheable shared prefix)
+            tokenizer: Token counter passed to SystemPromptSkill
+            profile_manager: Profile catalog passed to SystemPromptSkill
+            characteristic_manager: Style catalog passed to SystemPromptSkill
+            seed: Seed for the agent's own random stream, for reproducible
+                persona choices (unseeded if omitted)
+            shuffle: Cycle through every profile and style before repeating one
+            config: Settings for max_history_length and auto_clear_history
+                (defaults to the global configuration)
+            on_evict: Called with each message dropped from a full history
+            history_backend: 'deque' for a list of message dicts, 'arena'
+                for compact columnar storage (see ArenaHistory), or 'spill' to
+                keep only history_resident_length messages in memory and spill
+                older ones to a segment file in history_spill_dir
+            compactor: Summarizes old history in the background once it
+                grows past the compactor's threshold
+            keep_history_on_switch: Keep the conversation history when a new
+                persona is initialized; messages stay tagged with the persona
+                ID they were added under (see get_messages_by_persona). IDs
+                that no message carries any more are reused
+            delta_role: Role of the persona update messages change_persona_delta
+                adds to the history; 'user' keeps the history sendable as-is to
+                APIs whose message lists take only user/assistant turns
+        """
+        history_class = HISTORY_BACKENDS.get(history_backend)
+        if history_class is None:
+            raise ValueError(f"History backend '{history_backend}' not found")
+        config = config or get_global_config()
+        self.rng = random.Random(seed)
+        self.system_prompt_skill = SystemPromptSkill(
+            layout=layout, tokenizer=tokenizer,
+            profile_manager=profile_manager,
+            characteristic_manager=characteristic_manager,
+            rng=self.rng, shuffle=shuffle
+        )
         self.current_system_prompt: Optional[str] = None
-        self.conversation_history: list = []
+        # Profile/style keys the current system prompt was rendered from
+        self._prompt_handle: Optional[PromptHandle] = None
+        self._prompt_tier = 'full'
+        self._router: Optional[PersonaRouter] = None
+        # Persona IDs tag history messages: ID -> handle, handle -> ID (0 = no persona);
+        # reclaimed IDs have a None handle and wait in the free list
+        self._persona_handles: List[Optional[PromptHandle]] = [None]
+        self._persona_ids: Dict[PromptHandle, int] = {}
+        self._free_persona_ids: List[int] = []
+        self.current_persona_id = 0
+        self.keep_history_on_switch = keep_history_on_switch
+        self.delta_role = delta_role
+        history_options = {}
+        if history_backend == 'spill':
+            history_options['resident_limit'] = config.get('history_resident_length', 256)
+            spill_dir = config.get('history_spill_dir')
+            if spill_dir is not None:
+                history_options['path'] = os.path.join(
+                    spill_dir, f"history-{uuid.uuid4().hex}.seg"
+                )
+        self.conversation_history: ConversationHistory = history_class(
+            max_length=config.get('max_history_length'),
+            auto_clear=config.get('auto_clear_history', False),
+            on_evict=on_evict,
+            count_tokens=self.system_prompt_skill.count_tokens,
+            **history_options
+        )
+        self.compactor = compactor
         self.persona_info: Dict[str, str] = {}
     
     def initialize_persona(self) -> str:
@@ -25,35 +117,102 @@ class DynamicAgent:
         Initialize a new random persona for the agent
         Returns the generated system prompt
         """
-        self.current_system_prompt = self.system_prompt_skill.generate_system_prompt()
-        self.persona_info = self.system_prompt_skill.get_current_persona()
-        self.conversation_history.clear()
-        
-        return self.current_system_prompt
+        return self._activate_prompt(self.system_prompt_skill.generate_system_prompt())
     
     def initialize_persona_with_profile(self, profile_key: str) -> str:
         """Initialize persona with a specific profile"""
-        self.current_system_prompt = self.system_prompt_skill.generate_system_prompt_for_profile(profile_key)
-        self.persona_info = self.system_prompt_skill.get_current_persona()
-        self.conversation_history.clear()
-        
-        return self.current_system_prompt
+        return self._activate_prompt(self.system_prompt_skill.generate_system_prompt_for_profile(profile_key))
     
     def initialize_persona_with_style(self, style_key: str) -> str:
         """Initialize persona with a specific talking style"""
-        self.current_system_prompt = self.system_prompt_skill.generate_system_prompt_for_style(style_key)
-        self.persona_info = self.system_prompt_skill.get_current_persona()
-        self.conversation_history.clear()
-        
-        return self.current_system_prompt
+        return self._activate_prompt(self.system_prompt_skill.generate_system_prompt_for_style(style_key))
+    
+    def initialize_persona_with_space_style(self, profile_key: Optional[str] = None) -> str:
+        """Initialize persona with a style drawn from the style space (see StyleSpace)"""
+        return self._activate_prompt(self.system_prompt_skill.generate_system_prompt_for_space_style(profile_key))
     
     def initialize_persona_custom(self, profile_key: str, style_key: str) -> str:
         """Initialize persona with specific profile and style"""
-        self.current_system_prompt = self.system_prompt_skill.generate_system_prompt_custom(profile_key, style_key)
-        self.persona_info = self.system_prompt_skill.get_current_persona()
-        self.conversation_history.clear()
+        return self._activate_prompt(self.system_prompt_skill.generate_system_prompt_custom(profile_key, style_key))
+    
+    def initialize_persona_for_budget(self, token_budget: int,
+                                      profile_key: Optional[str] = None,
+                                      style_key: Optional[str] = None) -> str:
+        """
+        Initialize persona with the richest prompt tier that fits token_budget
+        Omitted profile/style keys are chosen at random
+        """
+        skill = self.system_prompt_skill
+        handle = skill.select_persona(profile_key, style_key)
+        tier = skill.select_prompt_tier(handle.profile_key, handle.style_key, token_budget)
+        return self._activate_prompt(
+            skill.get_prompt_tier(handle.profile_key, handle.style_key, tier), tier
+        )
+    
+    def _activate_prompt(self, prompt: str, tier: str = 'full') -> str:
+        """
+        Make a freshly generated system prompt current
+        Resets the conversation unless keep_history_on_switch is set
+        """
+        skill = self.system_prompt_skill
+        handle = PromptHandle(
+            skill.current_profile_key,
+            skill.current_style_key
+        )
+        if not self.keep_history_on_switch:
+            # No tagged message survives the switch, so the IDs start over
+            self.conversation_history.clear()
+            self._reset_persona_ids()
+        persona_id = self._persona_id(handle)
         
-        return self.current_system_prompt
+        self.current_system_prompt = prompt
+        self._prompt_handle = handle
+        self._prompt_tier = tier
+        self.persona_info = skill.get_current_persona()
+        self.current_persona_id = persona_id
+        
+        return prompt
+    
+    def _persona_id(self, handle: PromptHandle) -> int:
+        """
+        Return the persona ID of a profile/style pair, assigning one if new
+        Reuses IDs that no message in the history carries any more
+        """
+        persona_id = self._persona_ids.get(handle)
+        if persona_id is not None:
+            return persona_id
+        
+        table_limit = min(0xFFFF, max(self.min_persona_table, 2 * len(self.conversation_history)))
+        if not self._free_persona_ids and len(self._persona_ids) >= table_limit:
+            self._reclaim_persona_ids()
+        if self._free_persona_ids:
+            persona_id = self._free_persona_ids.pop()
+            self._persona_handles[persona_id] = handle
+        else:
+            persona_id = len(self._persona_handles)
+            if persona_id > 0xFFFF:
+                raise ValueError("Too many personas in the history for 16-bit persona IDs")
+            self._persona_handles.append(handle)
+        self._persona_ids[handle] = persona_id
+        return persona_id
+    
+    def _reclaim_persona_ids(self) -> None:
+        """Free the persona IDs that neither the history nor the current persona uses"""
+        in_use = set(self.conversation_history.personas())
+        in_use.add(self.current_persona_id)
+        for handle, persona_id in list(self._persona_ids.items()):
+            if persona_id not in in_use:
+                del self._persona_ids[handle]
+                self._persona_handles[persona_id] = None
+                self._free_persona_ids.append(persona_id)
+        # Hand out the lowest IDs first
+        self._free_persona_ids.sort(reverse=True)
+    
+    def _reset_persona_ids(self) -> None:
+        """Forget every persona ID"""
+        self._persona_handles = [None]
+        self._persona_ids = {}
+        self._free_persona_ids = []
     
     def change_persona(self) -> str:
         """
@@ -62,6 +221,55 @@ class DynamicAgent:
         """
         return self.initialize_persona()
     
+    def change_persona_delta(self, profile_key: Optional[str] = None,
+                             style_key: Optional[str] = None) -> str:
+        """
+        Switch persona without replacing the system prompt
+        Keeps the conversation history and appends a message (with role
+        delta_role) listing only the persona fields that changed. Omitted
+        keys are chosen at random
+        Returns the delta message ('' if the persona did not change)
+        """
+        if self.current_system_prompt is None:
+            raise ValueError("No active persona to switch from; initialize a persona first")
+        
+        skill = self.system_prompt_skill
+        old = PromptHandle(
+            skill.current_profile_key,
+            skill.current_style_key
+        )
+        new = skill.select_persona(profile_key, style_key)
+        delta = skill.build_persona_delta(old, new)
+        persona_id = self._persona_id(new)
+        self.persona_info = skill.get_current_persona()
+        self.current_persona_id = persona_id
+        if delta:
+            self.add_to_history(self.delta_role, delta)
+        
+        return delta
+    
+    def adapt_persona(self, message: str) -> Optional[str]:
+        """
+        Route a user message to the best-matching profile ('adaptive' mode)
+        Switches to that profile, keeping the current style, when it differs
+        from the active one: the first persona is initialized normally and
+        later switches go through change_persona_delta so history is kept
+        Returns the routed profile key, or None if no profile matched
+        """
+        if self._router is None:
+            self._router = PersonaRouter(self.system_prompt_skill.profile_manager)
+        profile_key = self._router.route(message)
+        if profile_key is None:
+            return None
+        
+        if self.current_system_prompt is None:
+            self.initialize_persona_with_profile(profile_key)
+        elif profile_key != self.system_prompt_skill.current_profile_key:
+            self.change_persona_delta(
+                profile_key, self.system_prompt_skill.current_style_key
+            )
+        return profile_key
+    
     def get_current_persona(self) -> Dict[str, str]:
         """Get information about the current persona"""
         return self.persona_info
@@ -72,30 +280,181 @@ class DynamicAgent:
     
     def add_to_history(self, role: str, message: str) -> None:
         """
-        Add a message to conversation history
+        Add a message to conversation history, tagged with the current persona ID
+        Once max_history_length messages are held the oldest is evicted
+        (or the whole history, with auto_clear_history)
         Args:
-            role: 'user' or 'assistant'
+            role: 'user', 'assistant' or 'system'
             message: The message content
         """
-        self.conversation_history.append({
-            'role': role,
-            'content': message
-        })
+        self.conversation_history.add(role, message, self.current_persona_id)
+        if self.compactor is not None:
+            self.compactor.after_append(self.conversation_history)
     
-    def get_conversation_history(self) -> list:
-        """Get the entire conversation history"""
+    def get_conversation_history(self) -> List[Message]:
+        """
+        Get the entire conversation history as a list of {'role', 'content'} dicts
+        The arena and spill backends decode every message; use
+        get_history_view to read only the messages needed
+        """
+        return list(self.conversation_history)
+    
+    def get_history_view(self) -> ConversationHistory:
+        """
+        Get the live conversation history, a sequence of {'role', 'content'} dicts
+        The arena and spill backends decode each message only when it is read
+        """
         return self.conversation_history
     
+    def get_persona_handle(self, persona_id: int) -> Optional[PromptHandle]:
+        """Get the profile/style keys behind a persona ID (None for 0, untagged messages)"""
+        if not 0 <= persona_id < len(self._persona_handles) or \
+                (persona_id and self._persona_handles[persona_id] is None):
+            raise ValueError(f"Persona ID {persona_id} not found")
+        return self._persona_handles[persona_id]
+    
+    def get_messages_by_persona(self, persona_id: Optional[int] = None) -> List[Message]:
+        """
+        Get the messages added under a persona ID (the current one if omitted)
+        Filters the history's persona tags; other messages are not decoded
+        """
+        if persona_id is None:
+            persona_id = self.current_persona_id
+        return self.conversation_history.messages_by_persona(persona_id)
+    
     def clear_history(self) -> None:
-        """Clear conversation history"""
+        """Clear conversation history, forgetting every persona ID but the current one's"""
+        handle = self._persona_handles[self.current_persona_id]
         self.conversation_history.clear()
+        self._reset_persona_ids()
+        self.current_persona_id = 0 if handle is None else self._persona_id(handle)
+    
+    def get_prompt_token_count(self) -> int:
+        """Get the token count of the current system prompt (0 if none)"""
+        if self._prompt_handle is None:
+            return 0
+        return self.system_prompt_skill.count_prompt_tokens(
+            self._prompt_handle.profile_key, self._prompt_handle.style_key, self._prompt_tier
+        )
+    
+    def get_history_token_count(self) -> int:
+        """Get the total token count of the conversation history (a running total)"""
+        return self.conversation_history.token_total
+    
+    def get_window(self, token_budget: int) -> List[Message]:
+        """
+        Get the newest messages that fit token_budget alongside the system prompt
+        Uses per-message token counts kept by the history, so only the
+        messages returned are visited
+        """
+        remaining = token_budget - self.get_prompt_token_count()
+        if remaining <= 0:
+            return []
+        return self.conversation_history.get_window(remaining)
+    
+    def snapshot(self) -> bytes:
+        """
+        Serialize the agent's state to a compact binary snapshot
+        Holds the current profile/style keys, the keys and tier of the system
+        prompt, the persona IDs, the random and shuffle state and the tagged
+        history; prompt text is not stored, so restore rebuilds it from the catalogs
+        """
+        skill = self.system_prompt_skill
+        history = self.conversation_history
+        messages = [
+            (message['role'], message['content'], persona)
+            for message, persona in zip(history, history.personas())
+        ]
+        return encode_snapshot(AgentSnapshot(
+            profile_key=skill.current_profile_key,
+            style_key=skill.current_style_key,
+            prompt=self._prompt_handle,
+            tier=self._prompt_tier,
+            persona_handles=[handle or _FREE_PERSONA for handle in self._persona_handles[1:]],
+            current_persona_id=self.current_persona_id,
+            rng_state=self.rng.getstate(),
+            shuffle_state=skill.get_shuffle_state(),
+            messages=messages
+        ))
+    
+    def restore(self, data: bytes) -> None:
+        """
+        Replace the agent's state with a snapshot taken by snapshot()
+        The agent's catalogs must hold the snapshot's profile and style keys;
+        history token counts are recounted with this agent's tokenizer
+        """
+        state = decode_snapshot(data)
+        skill = self.system_prompt_skill
+        prompt = None
+        if state.prompt is not None:
+            prompt = skill.get_prompt_tier(state.prompt.profile_key, state.prompt.style_key, state.tier)
+        if state.profile_key is not None and state.style_key is not None:
+            skill.select_persona(state.profile_key, state.style_key)
+            self.persona_info = skill.get_current_persona()
+        else:
+            self.persona_info = {}
+        
+        self.current_system_prompt = prompt
+        self._prompt_handle = state.prompt
+        self._prompt_tier = state.tier
+        self._reset_persona_ids()
+        for persona_id, handle in enumerate(state.persona_handles, 1):
+            if handle == _FREE_PERSONA:
+                self._persona_handles.append(None)
+                self._free_persona_ids.append(persona_id)
+            else:
+                self._persona_handles.append(handle)
+                self._persona_ids[handle] = persona_id
+        self._free_persona_ids.reverse()
+        self.current_persona_id = state.current_persona_id
+        self.rng.setstate(state.rng_state)
+        skill.set_shuffle_state(state.shuffle_state)
+        
+        history = self.conversation_history
+        history.clear()
+        for role, content, persona in state.messages:
+            history.add(role, content, persona)
+    
+    @classmethod
+    def from_snapshot(cls, data: bytes, **kwargs) -> 'DynamicAgent':
+        """
+        Create an agent from a snapshot
+        kwargs are passed to DynamicAgent (catalogs, tokenizer, history backend...)
+        """
+        agent = cls(**kwargs)
+        agent.restore(data)
+        return agent
+    
+    def close(self) -> None:
+        """
+        Release the agent's resources: the spill backend's segment file and
+        its listeners on the (possibly shared) catalogs
+        The conversation history is emptied
+        """
+        self.conversation_history.close()
+        self.system_prompt_skill.detach()
+        if self._router is not None:
+            self._router.detach()
+            self._router = None
+    
+    def __enter__(self) -> 'DynamicAgent':
+        """Use the agent as a context manager that closes it on exit"""
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        """Close the agent"""
+        self.close()
     
     def get_agent_info(self) -> Dict:
         """Get complete agent information"""
         return {
             'persona': self.persona_info,
             'system_prompt': self.current_system_prompt,
+            'prompt_prefix_hash': self.system_prompt_skill.get_prefix_hash(),
+            'prompt_tokens': self.get_prompt_token_count(),
+            'history_tokens': self.get_history_token_count(),
             'history_length': len(self.conversation_history),
+            'persona_id': self.current_persona_id,
             'available_profiles': self.system_prompt_skill.list_available_profiles(),
             'available_styles': self.system_prompt_skill.list_available_styles()
         }
@@ -0,0 +1,167 @@
+"""
+Prompt Exporter
+Streams rendered prompts into file-like sinks as JSONL or length-prefixed binary records
+"""
+
+import itertools
+import json
+import struct
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+
+from .system_prompt import PromptHandle, SystemPromptSkill
+
+
+DEFAULT_BUFFER_SIZE = 1 << 20  # flush to the sink in ~1 MiB writes
+
+# Binary format: a magic header, then one record per prompt made of
+# little-endian (profile key length: u16, style key length: u16,
+# prompt length: u32) followed by the three UTF-8 payloads
+BINARY_MAGIC = b'PRMT\x01'
+_RECORD_HEADER = struct.Struct('<HHI')
+
+
+def iter_prompt_handles(skill: SystemPromptSkill,
+                        profile_keys: Optional[Iterable[str]] = None,
+                        style_keys: Optional[Iterable[str]] = None) -> Iterator[PromptHandle]:
+    """
+    Yield handles for the cross product of profile and style keys
+    Defaults to every profile and style in the skill's managers
+    """
+    if profile_keys is None:
+        profile_keys = skill.profile_manager.get_profile_keys()
+    if style_keys is None:
+        style_keys = skill.characteristic_manager.get_style_keys()
+    for profile_key, style_key in itertools.product(profile_keys, style_keys):
+        yield PromptHandle(profile_key, style_key)
+
+
+def iter_prompt_records(skill: SystemPromptSkill,
+                        handles: Iterable[PromptHandle]) -> Iterator[Tuple[PromptHandle, str]]:
+    """
+    Render each handle lazily, yielding (handle, prompt) pairs
+    Prompts bypass the skill's prompt cache so memory stays bounded
+    """
+    for handle in handles:
+        yield handle, skill.render_prompt_uncached(handle.profile_key, handle.style_key)
+
+
+class _BufferedPromptWriter:
+    """Base class that batches encoded records into bulk writes to a binary sink"""
+
+    def __init__(self, sink: BinaryIO, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        """Wrap a binary file-like sink"""
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.records_written = 0
+        self._buffer = bytearray()
+
+    def write(self, handle: PromptHandle, prompt: str) -> None:
+        """Queue one record, flushing once the buffer is full"""
+        self._encode_into(self._buffer, handle, prompt)
+        self.records_written += 1
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_all(self, records: Iterable[Tuple[PromptHandle, str]]) -> int:
+        """Write every record from an iterable and return how many were written"""
+        start = self.records_written
+        for handle, prompt in records:
+            self.write(handle, prompt)
+        self.flush()
+        return self.records_written - start
+
+    def flush(self) -> None:
+        """Write any buffered records to the sink"""
+        if self._buffer:
+            self.sink.write(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _encode_into(self, buffer: bytearray, handle: PromptHandle, prompt: str) -> None:
+        """Append the encoded record to buffer"""
+        raise NotImplementedError
+
+    def __enter__(self):
+        """Use the writer as a context manager"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        """Flush buffered records on exit"""
+        self.flush()
+
+
+class JsonlPromptWriter(_BufferedPromptWriter):
+    """Writes one JSON object per line: {"profile": ..., "style": ..., "prompt": ...}"""
+
+    def _encode_into(self, buffer: bytearray, handle: PromptHandle, prompt: str) -> None:
+        """Append the record as a UTF-8 JSON line"""
+        buffer += json.dumps(
+            {'profile': handle.profile_key, 'style': handle.style_key, 'prompt': prompt},
+            ensure_ascii=False
+        ).encode('utf-8')
+        buffer += b'\n'
+
+
+class BinaryPromptWriter(_BufferedPromptWriter):
+    """Writes length-prefixed binary records after a BINARY_MAGIC header"""
+
+    def __init__(self, sink: BinaryIO, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        """Wrap a binary sink and queue the format header"""
+        super().__init__(sink, buffer_size)
+        self._buffer += BINARY_MAGIC
+
+    def _encode_into(self, buffer: bytearray, handle: PromptHandle, prompt: str) -> None:
+        """Append the record header followed by its payloads"""
+        profile_key = handle.profile_key.encode('utf-8')
+        style_key = handle.style_key.encode('utf-8')
+        prompt_bytes = prompt.encode('utf-8')
+        buffer += _RECORD_HEADER.pack(len(profile_key), len(style_key), len(prompt_bytes))
+        buffer += profile_key
+        buffer += style_key
+        buffer += prompt_bytes
+
+
+WRITERS = {
+    'jsonl': JsonlPromptWriter,
+    'binary': BinaryPromptWriter,
+}
+
+
+def export_prompts(skill: SystemPromptSkill, sink: BinaryIO, fmt: str = 'jsonl',
+                   handles: Optional[Iterable[PromptHandle]] = None,
+                   buffer_size: int = DEFAULT_BUFFER_SIZE) -> int:
+    """
+    Stream rendered prompts into a binary sink
+    Exports the full profile x style cross product unless handles are given.
+    Returns the number of records written
+    """
+    writer_class = WRITERS.get(fmt)
+    if writer_class is None:
+        raise ValueError(f"Unknown export format '{fmt}'")
+    if handles is None:
+        handles = iter_prompt_handles(skill)
+
+    with writer_class(sink, buffer_size) as writer:
+        return writer.write_all(iter_prompt_records(skill, handles))
+
+
+def iter_binary_prompts(source: BinaryIO) -> Iterator[Tuple[PromptHandle, str]]:
+    """Read records written by BinaryPromptWriter one at a time"""
+    if source.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("Not a binary prompt export")
+
+    while True:
+        header = source.read(_RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) != _RECORD_HEADER.size:
+            raise ValueError("Truncated binary prompt record")
+        profile_length, style_length, prompt_length = _RECORD_HEADER.unpack(header)
+        payload = source.read(profile_length + style_length + prompt_length)
+        if len(payload) != profile_length + style_length + prompt_length:
+            raise ValueError("Truncated binary prompt record")
+        style_end = profile_length + style_length
+        yield (
+            PromptHandle(payload[:profile_length].decode('utf-8'),
+                         payload[profile_length:style_end].decode('utf-8')),
+            payload[style_end:].decode('utf-8')
+        )
@@ -0,0 +1,750 @@
+"""
+Conversation History
+Bounded conversation history storage for DynamicAgent
+"""
+
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+import weakref
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .tokenizer import ApproximateTokenizer
+
+
+Message = Dict[str, str]
+
+
+class ConversationHistory(Sequence):
+    """
+    Ring buffer of {'role': ..., 'content': ...} messages
+
+    Appends and evictions are O(1). Once max_length messages are held, each
+    append first evicts the oldest message, or every message when auto_clear
+    is set. Evicted messages are passed to on_evict, e.g. to spill or
+    summarize them. Indexing the oldest and newest messages is O(1).
+    Each message's token count is taken once on append and kept alongside
+    it, and token_total is updated on every append and eviction. version
+    changes whenever messages are removed, so holders of positions into the
+    history (like HistoryCompactor) can tell when those went stale.
+    Messages can be tagged with a small-int persona ID (0 = untagged).
+    """
+
+    def __init__(self, max_length: Optional[int] = None, auto_clear: bool = False,
+                 on_evict: Optional[Callable[[Message], None]] = None,
+                 count_tokens: Optional[Callable[[str], int]] = None):
+        """
+        Create an empty history holding at most max_length messages (None = unbounded)
+        count_tokens defaults to an offline ApproximateTokenizer
+        """
+        if max_length is not None and max_length < 1:
+            raise ValueError(f"max_length must be at least 1, got {max_length}")
+        self.max_length = max_length
+        self.auto_clear = auto_clear
+        self.on_evict = on_evict
+        self.count_tokens = count_tokens or ApproximateTokenizer().count
+        self.evicted_count = 0
+        self.token_total = 0
+        self.version = 0
+        self._messages: Deque[Message] = deque()
+        self._token_counts: Deque[int] = deque()
+        self._personas: Deque[int] = deque()
+
+    def add(self, role: str, content: str, persona: int = 0) -> None:
+        """
+        Add a message tagged with a persona ID (0-65535), evicting old
+        ones first if the history is full
+        """
+        if self.max_length is not None and len(self) >= self.max_length:
+            if self.auto_clear:
+                while len(self):
+                    self._evict()
+            else:
+                self._evict()
+        tokens = self.count_tokens(content)
+        self._store(role, content, tokens, persona)
+        self.token_total += tokens
+
+    def append(self, message: Message) -> None:
+        """Add a {'role': ..., 'content': ...} message"""
+        self.add(message['role'], message['content'])
+
+    def _evict(self) -> None:
+        """Drop the oldest message and hand it to on_evict"""
+        message, tokens, _ = self._pop_oldest()
+        self.evicted_count += 1
+        self.version += 1
+        self.token_total -= tokens
+        if self.on_evict is not None:
+            self.on_evict(message)
+
+    def _store(self, role: str, content: str, tokens: int, persona: int) -> None:
+        """Append a message, its token count and its persona ID to the storage"""
+        self._messages.append({'role': role, 'content': content})
+        self._token_counts.append(tokens)
+        self._personas.append(persona)
+
+    def _pop_oldest(self) -> Tuple[Message, int, int]:
+        """
+        Remove the oldest message from the storage, returning it with its
+        token count and persona ID
+        """
+        return self._messages.popleft(), self._token_counts.popleft(), self._personas.popleft()
+
+    def persona(self, index: int) -> int:
+        """Persona ID of a message"""
+        return self._personas[index]
+
+    def personas(self) -> Iterable[int]:
+        """Persona IDs from the oldest message to the newest"""
+        return iter(self._personas)
+
+    def persona_positions(self, persona: int) -> List[int]:
+        """Positions of the messages tagged with a persona ID"""
+        return [position for position, tag in enumerate(self.personas()) if tag == persona]
+
+    def messages_by_persona(self, persona: int) -> List[Message]:
+        """Messages tagged with a persona ID, oldest first"""
+        return [message for message, tag in zip(self, self._personas) if tag == persona]
+
+    def _newest_token_counts(self) -> Iterable[int]:
+        """Token counts from the newest message back"""
+        return reversed(self._token_counts)
+
+    def _newest(self, count: int) -> List[Message]:
+        """The newest count messages, oldest first"""
+        messages = list(itertools.islice(reversed(self._messages), count))
+        messages.reverse()
+        return messages
+
+    def get_window(self, token_budget: int) -> List[Message]:
+        """
+        Get the newest messages whose token counts fit token_budget, oldest first
+        Walks back from the newest message, so it costs O(k) for k messages
+        """
+        remaining = token_budget
+        count = 0
+        for tokens in self._newest_token_counts():
+            if tokens > remaining:
+                break
+            remaining -= tokens
+            count += 1
+        return self._newest(count)
+
+    def replace_oldest(self, count: int, role: str, content: str, persona: int = 0) -> None:
+        """Replace the oldest count messages with one message, e.g. a summary of them"""
+        if not 0 < count <= len(self):
+            raise ValueError(f"Cannot replace {count} of {len(self)} messages")
+        for _ in range(count):
+            self._messages.popleft()
+            self._personas.popleft()
+            self.token_total -= self._token_counts.popleft()
+        tokens = self.count_tokens(content)
+        self._messages.appendleft({'role': role, 'content': content})
+        self._token_counts.appendleft(tokens)
+        self._personas.appendleft(persona)
+        self.token_total += tokens
+        self.version += 1
+
+    def clear(self) -> None:
+        """Drop every message without calling on_evict"""
+        self._messages.clear()
+        self._token_counts.clear()
+        self._personas.clear()
+        self.token_total = 0
+        self.version += 1
+
+    def close(self) -> None:
+        """Release what the history holds outside memory (nothing for this backend)"""
+
+    def __len__(self) -> int:
+        """Number of messages held"""
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Message]:
+        """Iterate messages from oldest to newest"""
+        return iter(self._messages)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Message, List[Message]]:
+        """Get a message by position, or a list of messages for a slice"""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._messages))
+            if step == 1:
+                return list(itertools.islice(self._messages, start, stop))
+            return [self._messages[position] for position in range(start, stop, step)]
+        return self._messages[index]
+
+    def __eq__(self, other: object) -> bool:
+        """Compare messages with another history or a list of messages"""
+        if isinstance(other, (ConversationHistory, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        """String representation of the history"""
+        return f"ConversationHistory(length={len(self)}, max_length={self.max_length})"
+
+
+class ArenaHistory(ConversationHistory):
+    """
+    Columnar conversation history with the same interface as ConversationHistory
+
+    Roles are stored as uint8 codes and persona IDs as uint16 values in
+    typed arrays. Message text is UTF-8 encoded into bytearray arena chunks
+    with per-message chunk/offset/length/token count arrays. That is about
+    19 bytes of bookkeeping per message instead of a dict and two strings.
+    Messages are decoded only when read, and content_view returns a
+    zero-copy view.
+    Chunks are preallocated and never resized, so views stay valid while
+    the history grows. The first chunk holds FIRST_CHUNK_SIZE bytes and each
+    new one doubles in size up to chunk_size, so short sessions stay small.
+    A chunk is freed once no live message is stored in it.
+    """
+
+    ROLES = ('user', 'assistant', 'system')
+    FIRST_CHUNK_SIZE = 256
+
+    def __init__(self, max_length: Optional[int] = None, auto_clear: bool = False,
+                 on_evict: Optional[Callable[[Message], None]] = None,
+                 count_tokens: Optional[Callable[[str], int]] = None,
+                 chunk_size: int = 1 << 16):
+        """Create an empty history whose arena grows in chunks of up to chunk_size bytes"""
+        super().__init__(max_length, auto_clear, on_evict, count_tokens)
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+        self.chunk_size = chunk_size
+        self._roles: List[str] = list(self.ROLES)
+        self._role_codes: Dict[str, int] = {role: code for code, role in enumerate(self._roles)}
+        self._clear_columns()
+
+    def _clear_columns(self) -> None:
+        """Reset the columns and the arena"""
+        self._role_column = array('B')
+        self._persona_column = array('H')
+        self._chunk_column = array('I')
+        self._offset_column = array('I')
+        self._length_column = array('I')
+        self._token_column = array('I')
+        # Live chunks by number and the number of live rows in each;
+        # the last one is filled by appends
+        self._chunks: Dict[int, bytearray] = {}
+        self._chunk_rows: Dict[int, int] = {}
+        self._chunk_count = 0
+        self._fill = 0
+        self._next_chunk_size = min(self.FIRST_CHUNK_SIZE, self.chunk_size)
+        # Rows before _head are evicted and are dropped in bulk later
+        self._head = 0
+
+    def _role_code(self, role: str) -> int:
+        """Code of a role, assigning the next one if it is new"""
+        code = self._role_codes.get(role)
+        if code is None:
+            code = self._role_codes[role] = len(self._roles)
+            self._roles.append(role)
+        return code
+
+    def _write(self, data: bytes) -> Tuple[int, int]:
+        """Copy a row's text into the arena, returning its chunk number and offset"""
+        size = len(data)
+        if self._chunk_count == 0 or self._fill + size > len(self._chunks[self._chunk_count - 1]):
+            if self._chunk_rows.get(self._chunk_count - 1) == 0:
+                # The filled chunk's rows were all evicted while it was current
+                self._release_chunk(self._chunk_count - 1, 0)
+            self._chunks[self._chunk_count] = bytearray(max(self._next_chunk_size, size))
+            self._chunk_rows[self._chunk_count] = 0
+            self._chunk_count += 1
+            self._fill = 0
+            self._next_chunk_size = min(self._next_chunk_size * 2, self.chunk_size)
+        chunk_number = self._chunk_count - 1
+        offset = self._fill
+        self._chunks[chunk_number][offset:offset + size] = data
+        self._chunk_rows[chunk_number] += 1
+        self._fill += size
+        return chunk_number, offset
+
+    def _release_chunk(self, chunk_number: int, rows: int) -> None:
+        """Record a chunk's live row count, freeing it at zero unless appends still fill it"""
+        if rows or chunk_number == self._chunk_count - 1:
+            self._chunk_rows[chunk_number] = rows
+        else:
+            del self._chunk_rows[chunk_number]
+            del self._chunks[chunk_number]
+
+    def _store(self, role: str, content: str, tokens: int, persona: int) -> None:
+        """Encode a message into the arena and append its row"""
+        data = content.encode('utf-8')
+        chunk_number, offset = self._write(data)
+        self._role_column.append(self._role_code(role))
+        self._persona_column.append(persona)
+        self._chunk_column.append(chunk_number)
+        self._offset_column.append(offset)
+        self._length_column.append(len(data))
+        self._token_column.append(tokens)
+
+    def _pop_oldest(self) -> Tuple[Message, int, int]:
+        """Evict the oldest row"""
+        message = self[0]
+        return (message,) + self._drop_head()
+
+    def _drop_head(self) -> Tuple[int, int]:
+        """
+        Drop the oldest row without decoding it, returning its token count
+        and persona ID; its chunk is freed once no live row uses it
+        """
+        row = self._head
+        tokens = self._token_column[row]
+        persona = self._persona_column[row]
+        chunk_number = self._chunk_column[row]
+        self._head += 1
+        rows = len(self._role_column)
+        if self._head == rows:
+            self._clear_columns()
+            return tokens, persona
+        self._release_chunk(chunk_number, self._chunk_rows[chunk_number] - 1)
+        if self._head >= 1024 and self._head * 2 >= rows:
+            # Amortized O(1): drop the evicted rows once they are half the columns
+            for column in (self._role_column, self._persona_column, self._chunk_column,
+                           self._offset_column, self._length_column, self._token_column):
+                del column[:self._head]
+            self._head = 0
+        return tokens, persona
+
+    def _newest_token_counts(self) -> Iterable[int]:
+        """Token counts from the newest message back"""
+        column = self._token_column
+        return (column[row] for row in range(len(column) - 1, self._head - 1, -1))
+
+    def _newest(self, count: int) -> List[Message]:
+        """The newest count messages, oldest first"""
+        return self[len(self) - count:]
+
+    def replace_oldest(self, count: int, role: str, content: str, persona: int = 0) -> None:
+        """
+        Replace the oldest count messages with one message, e.g. a summary of them
+        The replaced rows are dropped like evicted ones, without decoding them,
+        and the last of them is rewritten in place to hold the new message
+        """
+        if not 0 < count <= len(self):
+            raise ValueError(f"Cannot replace {count} of {len(self)} messages")
+        for _ in range(count - 1):
+            self.token_total -= self._drop_head()[0]
+        row = self._head
+        self.token_total -= self._token_column[row]
+        chunk_number = self._chunk_column[row]
+        self._release_chunk(chunk_number, self._chunk_rows[chunk_number] - 1)
+
+        data = content.encode('utf-8')
+        tokens = self.count_tokens(content)
+        self._chunk_column[row], self._offset_column[row] = self._write(data)
+        self._role_column[row] = self._role_code(role)
+        self._persona_column[row] = persona
+        self._length_column[row] = len(data)
+        self._token_column[row] = tokens
+        self.token_total += tokens
+        self.version += 1
+
+    def clear(self) -> None:
+        """Drop every message without calling on_evict"""
+        self._clear_columns()
+        self.token_total = 0
+        self.version += 1
+
+    def __len__(self) -> int:
+        """Number of messages held"""
+        return len(self._role_column) - self._head
+
+    def _row(self, index: int) -> int:
+        """Translate a message position into a column row"""
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("history index out of range")
+        return self._head + index
+
+    def content_view(self, index: int) -> memoryview:
+        """Zero-copy read-only view of a message's UTF-8 content"""
+        row = self._row(index)
+        offset = self._offset_column[row]
+        view = memoryview(self._chunks[self._chunk_column[row]])
+        return view[offset:offset + self._length_column[row]].toreadonly()
+
+    def content(self, index: int) -> str:
+        """Decoded content of a message"""
+        return str(self.content_view(index), 'utf-8')
+
+    def role(self, index: int) -> str:
+        """Role of a message"""
+        return self._roles[self._role_column[self._row(index)]]
+
+    def persona(self, index: int) -> int:
+        """Persona ID of a message"""
+        return self._persona_column[self._row(index)]
+
+    def personas(self) -> Iterable[int]:
+        """Persona IDs from the oldest message to the newest"""
+        return itertools.islice(self._persona_column, self._head, None)
+
+    def messages_by_persona(self, persona: int) -> List[Message]:
+        """Messages tagged with a persona ID, oldest first; only those are decoded"""
+        return [self[position] for position in self.persona_positions(persona)]
+
+    def __iter__(self) -> Iterator[Message]:
+        """Iterate messages from oldest to newest, decoding each lazily"""
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Message, List[Message]]:
+        """Decode a message by position, or a list of messages for a slice"""
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        row = self._row(index)
+        offset = self._offset_column[row]
+        chunk = self._chunks[self._chunk_column[row]]
+        return {
+            'role': self._roles[self._role_column[row]],
+            'content': chunk[offset:offset + self._length_column[row]].decode('utf-8'),
+        }
+
+    def arena_size(self) -> int:
+        """Bytes allocated for live arena chunks"""
+        return sum(len(chunk) for chunk in self._chunks.values())
+
+    def __repr__(self) -> str:
+        """String representation of the history"""
+        return (f"ArenaHistory(length={len(self)}, max_length={self.max_length}, "
+                f"chunks={len(self._chunks)})")
+
+
+def _remove_segment_file(segment_file, path: str) -> None:
+    """Close and delete a segment file"""
+    segment_file.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class HistorySegment:
+    """
+    Append-only file of history messages, read back through a memory map
+    Record start offsets, token counts and persona IDs are kept in memory
+    (14 bytes per message); a record is a (role length: u16, content length: u32) header
+    followed by the UTF-8 role and content. The file is created on the first
+    append (a new temporary file if no path is given) and deleted by discard,
+    close or garbage collection
+    """
+
+    _HEADER = struct.Struct('<HI')
+
+    def __init__(self, path: Optional[str] = None):
+        """Prepare a segment at path; nothing is written until the first append"""
+        self._temporary = path is None
+        self.path = path
+        self._file = None
+        self._finalizer: Optional[weakref.finalize] = None
+        self._map: Optional[mmap.mmap] = None
+        self._size = 0
+        self._offsets = array('Q')
+        self._tokens = array('I')
+        self._personas = array('H')
+
+    def _open(self) -> None:
+        """Create the segment file"""
+        if self._temporary:
+            descriptor, self.path = tempfile.mkstemp(prefix='history-', suffix='.seg')
+            os.close(descriptor)
+        self._file = open(self.path, 'w+b')
+        self._finalizer = weakref.finalize(self, _remove_segment_file, self._file, self.path)
+
+    def append(self, role: str, content: str, tokens: int, persona: int = 0) -> None:
+        """Append a message record"""
+        if self._file is None:
+            self._open()
+        role_bytes = role.encode('utf-8')
+        content_bytes = content.encode('utf-8')
+        self._offsets.append(self._size)
+        self._tokens.append(tokens)
+        self._personas.append(persona)
+        self._file.write(self._HEADER.pack(len(role_bytes), len(content_bytes)))
+        self._file.write(role_bytes)
+        self._file.write(content_bytes)
+        self._size += self._HEADER.size + len(role_bytes) + len(content_bytes)
+
+    def __len__(self) -> int:
+        """Number of records in the segment"""
+        return len(self._offsets)
+
+    def _mapped(self, end: int) -> mmap.mmap:
+        """Return a map covering the file up to end, remapping after appends"""
+        if self._map is None or len(self._map) < end:
+            self._file.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def read(self, index: int) -> Message:
+        """Read one message without touching the others"""
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else self._size
+        data = self._mapped(end)
+        role_length, content_length = self._HEADER.unpack_from(data, start)
+        role_start = start + self._HEADER.size
+        content_start = role_start + role_length
+        return {
+            'role': data[role_start:content_start].decode('utf-8'),
+            'content': data[content_start:content_start + content_length].decode('utf-8'),
+        }
+
+    def tokens(self, index: int) -> int:
+        """Token count of a record"""
+        return self._tokens[index]
+
+    def persona(self, index: int) -> int:
+        """Persona ID of a record"""
+        return self._personas[index]
+
+    def token_sum(self, start: int, stop: int) -> int:
+        """Total token count of the records from start up to stop"""
+        return sum(self._tokens[start:stop])
+
+    def compact(self, start: int) -> None:
+        """Drop the records before start, moving the rest to the front of the file"""
+        if start >= len(self):
+            self.discard()
+            return
+        begin = self._offsets[start]
+        live = bytes(self._mapped(self._size)[begin:self._size])
+        self._map.close()
+        self._map = None
+        self._file.seek(0)
+        self._file.write(live)
+        self._file.truncate()
+        self._size = len(live)
+        self._offsets = array('Q', (offset - begin for offset in self._offsets[start:]))
+        self._tokens = self._tokens[start:]
+        self._personas = self._personas[start:]
+
+    def discard(self) -> None:
+        """Drop every record and delete the file; the next append creates it again"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        self._file = None
+        if self._temporary:
+            self.path = None
+        self._size = 0
+        self._offsets = array('Q')
+        self._tokens = array('I')
+        self._personas = array('H')
+
+    def close(self) -> None:
+        """Delete the segment file"""
+        self.discard()
+
+
+class SpillingHistory(ConversationHistory):
+    """
+    Conversation history that keeps only a recent tail in memory
+
+    Once more than resident_limit messages are resident, the oldest ones
+    move to an append-only HistorySegment file. They stay part of the
+    history and are read back one at a time through the segment's memory
+    map, so indexing or slicing old messages loads only those messages.
+    max_length eviction drops spilled messages first; evicted records are
+    compacted out of the file once they outnumber the live ones (and number
+    at least compact_threshold), so a bounded history keeps a bounded file.
+    replace_oldest skips the replaced records the same way and keeps the
+    new message in memory, ahead of the remaining spilled ones.
+    The file only exists while messages are spilled; call close() (or clear())
+    to delete it.
+    """
+
+    compact_threshold = 1024
+
+    def __init__(self, max_length: Optional[int] = None, auto_clear: bool = False,
+                 on_evict: Optional[Callable[[Message], None]] = None,
+                 count_tokens: Optional[Callable[[str], int]] = None,
+                 path: Optional[str] = None, resident_limit: int = 256):
+        """
+        Create an empty history spilling to the segment file at path
+        (a new temporary file if omitted), created on the first spill
+        """
+        super().__init__(max_length, auto_clear, on_evict, count_tokens)
+        if resident_limit < 1:
+            raise ValueError(f"resident_limit must be at least 1, got {resident_limit}")
+        self.resident_limit = resident_limit
+        self.segment = HistorySegment(path)
+        # Segment records before _spilled_start have been evicted
+        self._spilled_start = 0
+        # A message that replaced the oldest ones (see replace_oldest) while
+        # spilled records follow it: (message, tokens, persona ID)
+        self._front: Optional[Tuple[Message, int, int]] = None
+
+    def add(self, role: str, content: str, persona: int = 0) -> None:
+        """Add a message, spilling the oldest resident ones past resident_limit"""
+        super().add(role, content, persona)
+        while len(self._messages) > self.resident_limit:
+            message, tokens, tag = super()._pop_oldest()
+            self.segment.append(message['role'], message['content'], tokens, tag)
+
+    def spilled_count(self) -> int:
+        """Number of live messages held in the segment file"""
+        return len(self.segment) - self._spilled_start
+
+    def _pop_oldest(self) -> Tuple[Message, int, int]:
+        """Evict the oldest message, spilled ones first"""
+        if self._front is not None:
+            popped, self._front = self._front, None
+            return popped
+        if not self.spilled_count():
+            return super()._pop_oldest()
+        index = self._spilled_start
+        popped = self.segment.read(index), self.segment.tokens(index), self.segment.persona(index)
+        self._skip_spilled(1)
+        return popped
+
+    def _skip_spilled(self, count: int) -> None:
+        """Drop the oldest count spilled records, compacting the segment once enough are dead"""
+        self._spilled_start += count
+        dead = self._spilled_start
+        if not self.spilled_count() or (dead >= self.compact_threshold and dead >= self.spilled_count()):
+            self.segment.compact(dead)
+            self._spilled_start = 0
+
+    def _position(self, index: int) -> int:
+        """Check a message position, counting from the front message if one is held"""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return index if self._front is None else index - 1
+
+    def persona(self, index: int) -> int:
+        """Persona ID of a message"""
+        index = self._position(index)
+        if index < 0:
+            return self._front[2]
+        spilled = self.spilled_count()
+        if index < spilled:
+            return self.segment.persona(self._spilled_start + index)
+        return self._personas[index - spilled]
+
+    def personas(self) -> Iterable[int]:
+        """Persona IDs from the oldest message to the newest"""
+        segment = self.segment
+        return itertools.chain(
+            () if self._front is None else (self._front[2],),
+            (segment.persona(index) for index in range(self._spilled_start, len(segment))),
+            self._personas
+        )
+
+    def messages_by_persona(self, persona: int) -> List[Message]:
+        """Messages tagged with a persona ID, oldest first; only those are read"""
+        return [self[position] for position in self.persona_positions(persona)]
+
+    def _newest_token_counts(self) -> Iterable[int]:
+        """Token counts from the newest message back"""
+        segment = self.segment
+        return itertools.chain(
+            reversed(self._token_counts),
+            (segment.tokens(index) for index in range(len(segment) - 1, self._spilled_start - 1, -1)),
+            () if self._front is None else (self._front[1],)
+        )
+
+    def _newest(self, count: int) -> List[Message]:
+        """The newest count messages, oldest first"""
+        resident = len(self._messages)
+        if count <= resident:
+            return super()._newest(count)
+        return self[len(self) - count:]
+
+    def replace_oldest(self, count: int, role: str, content: str, persona: int = 0) -> None:
+        """
+        Replace the oldest count messages with one message, e.g. a summary of them
+        Replaced spilled records are skipped without being read, like evicted ones
+        """
+        if not 0 < count <= len(self):
+            raise ValueError(f"Cannot replace {count} of {len(self)} messages")
+        if self._front is not None:
+            self.token_total -= self._front[1]
+            self._front = None
+            count -= 1
+        spilled = min(count, self.spilled_count())
+        if spilled:
+            start = self._spilled_start
+            self.token_total -= self.segment.token_sum(start, start + spilled)
+            self._skip_spilled(spilled)
+            count -= spilled
+        
+        tokens = self.count_tokens(content)
+        message = {'role': role, 'content': content}
+        if count or not self.spilled_count():
+            # The replaced messages reach into the resident ones
+            for _ in range(count):
+                self._messages.popleft()
+                self._personas.popleft()
+                self.token_total -= self._token_counts.popleft()
+            self._messages.appendleft(message)
+            self._token_counts.appendleft(tokens)
+            self._personas.appendleft(persona)
+        else:
+            self._front = (message, tokens, persona)
+        self.token_total += tokens
+        self.version += 1
+
+    def clear(self) -> None:
+        """Drop every message without calling on_evict, deleting the segment file"""
+        super().clear()
+        self.segment.discard()
+        self._spilled_start = 0
+        self._front = None
+
+    def close(self) -> None:
+        """Drop every message and delete the segment file"""
+        self.clear()
+
+    def __len__(self) -> int:
+        """Number of messages, resident and spilled"""
+        return (self._front is not None) + self.spilled_count() + len(self._messages)
+
+    def __iter__(self) -> Iterator[Message]:
+        """Iterate messages from oldest to newest, reading spilled ones on demand"""
+        if self._front is not None:
+            yield self._front[0]
+        for index in range(self._spilled_start, len(self.segment)):
+            yield self.segment.read(index)
+        yield from self._messages
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Message, List[Message]]:
+        """Get a message by position, or a list of messages for a slice"""
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        index = self._position(index)
+        if index < 0:
+            return self._front[0]
+        spilled = self.spilled_count()
+        if index < spilled:
+            return self.segment.read(self._spilled_start + index)
+        return self._messages[index - spilled]
+
+    def __repr__(self) -> str:
+        """String representation of the history"""
+        return (f"SpillingHistory(length={len(self)}, spilled={self.spilled_count()}, "
+                f"path={self.segment.path!r})")
+
+
+HISTORY_BACKENDS = {
+    'deque': ConversationHistory,
+    'arena': ArenaHistory,
+    'spill': SpillingHistory,
+}
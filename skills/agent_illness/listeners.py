@@ -0,0 +1,61 @@
+"""
+Listeners
+Change callbacks for catalogs shared by many short-lived skills and routers
+"""
+
+import inspect
+import weakref
+from typing import Callable, List, Optional
+
+
+Listener = Callable[[str], None]
+
+
+class ListenerList:
+    """
+    Callbacks notified with the key of each changed entry
+
+    Bound methods are held by weak reference and dropped once their object
+    is garbage collected, so a skill or router over a shared manager does
+    not pin itself (and its caches) in memory or keep receiving
+    notifications after it is gone. Other callables are held strongly
+    until removed.
+    """
+
+    def __init__(self):
+        """Create an empty list"""
+        self._refs: List[Callable[[], Optional[Listener]]] = []
+
+    def add(self, listener: Listener) -> None:
+        """Register a listener"""
+        if inspect.ismethod(listener):
+            ref = weakref.WeakMethod(listener, self._discard)
+        else:
+            ref = lambda: listener
+        self._refs.append(ref)
+
+    def _discard(self, ref: Callable[[], Optional[Listener]]) -> None:
+        """Drop the reference of a collected listener"""
+        try:
+            self._refs.remove(ref)
+        except ValueError:
+            pass
+
+    def remove(self, listener: Listener) -> None:
+        """Unregister a listener"""
+        for position, ref in enumerate(self._refs):
+            if ref() == listener:
+                del self._refs[position]
+                return
+        raise ValueError("Listener not registered")
+
+    def notify(self, key: str) -> None:
+        """Call every live listener with key"""
+        for ref in list(self._refs):
+            listener = ref()
+            if listener is not None:
+                listener(key)
+
+    def __len__(self) -> int:
+        """Number of registered listeners"""
+        return len(self._refs)
@@ -0,0 +1,116 @@
+"""
+Persona Router
+Routes user messages to the best-matching agent profile for the 'adaptive' conversation mode
+"""
+
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .agent_profiles import AgentProfile, AgentProfileManager
+
+
+_WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+_STOPWORDS = frozenset({
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'for', 'from',
+    'how', 'i', 'in', 'is', 'it', 'me', 'my', 'of', 'on', 'or', 'so', 'that',
+    'the', 'this', 'to', 'we', 'what', 'who', 'with', 'you', 'your',
+})
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, split into words, drop stopwords and strip common suffixes"""
+    terms = []
+    for word in _WORD_PATTERN.findall(text.lower()):
+        if word in _STOPWORDS:
+            continue
+        for suffix in ('ing', 'ed', 's'):
+            if len(word) > len(suffix) + 3 and word.endswith(suffix):
+                word = word[:-len(suffix)]
+                break
+        terms.append(word)
+    return terms
+
+
+def _profile_terms(profile: AgentProfile) -> List[str]:
+    """Terms describing a profile; expertise areas count twice"""
+    expertise = ' '.join(profile.expertise_areas)
+    return tokenize(f"{profile.role} {profile.description} {expertise} {expertise}")
+
+
+class PersonaRouter:
+    """
+    Scores messages against profile roles, descriptions and expertise areas
+    with BM25. Per-term weights are precomputed into postings lists, so
+    routing a message only sums the postings of its terms. The index is
+    rebuilt lazily after profiles are added
+    """
+
+    def __init__(self, profile_manager: AgentProfileManager, k1: float = 1.2, b: float = 0.75):
+        """Index the profiles of a manager"""
+        self.profile_manager = profile_manager
+        self.k1 = k1
+        self.b = b
+        # term -> [(profile key, BM25 weight)]
+        self._postings: Optional[Dict[str, List[Tuple[str, float]]]] = None
+        # profile key -> catalog position, to break score ties deterministically
+        self._positions: Dict[str, int] = {}
+        profile_manager.add_listener(self._mark_stale)
+
+    def detach(self) -> None:
+        """Stop following profile changes (the manager holds the router only weakly)"""
+        self.profile_manager.remove_listener(self._mark_stale)
+
+    def _mark_stale(self, key: str) -> None:
+        """Drop the index after the catalog changes; document frequencies shift globally"""
+        self._postings = None
+
+    def _build(self) -> Dict[str, List[Tuple[str, float]]]:
+        """Precompute BM25 weights for every (term, profile) pair"""
+        documents = {}
+        self._positions = {}
+        for key in self.profile_manager.get_profile_keys():
+            self._positions[key] = len(self._positions)
+            terms = _profile_terms(self.profile_manager.profiles[key])
+            frequencies: Dict[str, int] = {}
+            for term in terms:
+                frequencies[term] = frequencies.get(term, 0) + 1
+            documents[key] = (frequencies, len(terms))
+
+        count = len(documents)
+        average_length = sum(length for _, length in documents.values()) / count if count else 0.0
+        document_frequency: Dict[str, int] = {}
+        for frequencies, _ in documents.values():
+            for term in frequencies:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+
+        postings: Dict[str, List[Tuple[str, float]]] = {}
+        for key, (frequencies, length) in documents.items():
+            norm = self.k1 * (1 - self.b + self.b * length / average_length) if average_length else self.k1
+            for term, frequency in frequencies.items():
+                df = document_frequency[term]
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                weight = idf * frequency * (self.k1 + 1) / (frequency + norm)
+                postings.setdefault(term, []).append((key, weight))
+        return postings
+
+    def score(self, message: str) -> Dict[str, float]:
+        """Return the BM25 score of every profile that shares a term with message"""
+        postings = self._postings
+        if postings is None:
+            postings = self._postings = self._build()
+
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(message)):
+            for key, weight in postings.get(term, ()):
+                scores[key] = scores.get(key, 0.0) + weight
+        return scores
+
+    def route(self, message: str) -> Optional[str]:
+        """Return the key of the best-matching profile, or None if nothing matches"""
+        scores = self.score(message)
+        if not scores:
+            return None
+        positions = self._positions
+        return max(scores, key=lambda key: (scores[key], -positions[key]))
@@ -0,0 +1,237 @@
+"""
+Sampling
+Constant-time weighted sampling helpers for persona and style selection
+"""
+
+import random
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from .listeners import Listener, ListenerList
+
+
+class AliasTable:
+    """
+    Walker/Vose alias table over indices 0..n-1
+    Built in O(n); each weighted draw is O(1)
+    """
+
+    def __init__(self, weights: Sequence[float]):
+        """Build the table from non-negative weights with a positive sum"""
+        count = len(weights)
+        total = float(sum(weights))
+        if count == 0 or total <= 0:
+            raise ValueError("Weights must contain at least one positive value")
+        if any(weight < 0 for weight in weights):
+            raise ValueError("Weights must be non-negative")
+
+        scaled = [weight * count / total for weight in weights]
+        self.probability: List[float] = [1.0] * count
+        self.alias: List[int] = list(range(count))
+
+        small = [index for index, value in enumerate(scaled) if value < 1.0]
+        large = [index for index, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left over is 1.0 up to rounding error
+        for index in small + large:
+            self.probability[index] = 1.0
+
+    def __len__(self) -> int:
+        """Number of indices in the table"""
+        return len(self.probability)
+
+    def draw(self, rng: Optional[random.Random] = None) -> int:
+        """Draw one weighted index"""
+        position = (rng or random).random() * len(self.probability)
+        index = int(position)
+        if position - index < self.probability[index]:
+            return index
+        return self.alias[index]
+
+    def draw_many(self, k: int, rng: Optional[random.Random] = None) -> List[int]:
+        """Draw k weighted indices at once"""
+        uniform = (rng or random).random
+        count = len(self.probability)
+        probability = self.probability
+        alias = self.alias
+        indices = []
+        append = indices.append
+        for _ in range(k):
+            position = uniform() * count
+            index = int(position)
+            append(index if position - index < probability[index] else alias[index])
+        return indices
+
+
+class ShuffleBag:
+    """
+    Draws indices 0..n-1 without replacement, refilling once all have been drawn
+    Each draw is O(1) (swap-remove); the O(n) refill happens once per n
+    draws. The first draw after a refill never repeats the last draw
+    """
+
+    def __init__(self, size: int):
+        """Create a bag over size indices"""
+        self.size = 0
+        self._remaining: List[int] = []
+        self._last: Optional[int] = None
+        self.grow(size)
+
+    def grow(self, size: int) -> None:
+        """Add indices up to size, e.g. after entries were added to the catalog"""
+        if size < self.size:
+            raise ValueError(f"Cannot shrink a bag of {self.size} to {size}")
+        self._remaining.extend(range(self.size, size))
+        self.size = size
+
+    def getstate(self) -> Tuple[int, List[int], Optional[int]]:
+        """Return the bag's state (size, undrawn indices, last draw), e.g. for snapshots"""
+        return self.size, list(self._remaining), self._last
+
+    def setstate(self, state: Tuple[int, List[int], Optional[int]]) -> None:
+        """Restore a state returned by getstate"""
+        size, remaining, last = state
+        self.size = size
+        self._remaining = list(remaining)
+        self._last = last
+
+    def remaining(self) -> int:
+        """Number of indices left before the next refill"""
+        return len(self._remaining)
+
+    def draw(self, rng: Optional[random.Random] = None) -> int:
+        """Draw the next index"""
+        if self.size == 0:
+            raise ValueError("Cannot draw from an empty bag")
+        remaining = self._remaining
+        if not remaining:
+            remaining.extend(range(self.size))
+        position = (rng or random).randrange(len(remaining))
+        if remaining[position] == self._last and len(remaining) > 1:
+            # Only possible right after a refill
+            position = (position + 1) % len(remaining)
+        remaining[position], remaining[-1] = remaining[-1], remaining[position]
+        self._last = remaining.pop()
+        return self._last
+
+
+class KeyIndex:
+    """
+    The keys of a profile or style catalog in insertion order, with
+    sampling weights and change listeners
+
+    Random picks index the key list instead of copying the catalog, so
+    uniform draws are O(1); once any weight is set, draws go through an
+    AliasTable that is rebuilt lazily after weights change. Catalogs shared
+    between processes (those with keys_after, like SqliteCatalog) are
+    listed by rowid, and refresh picks up keys other processes added since:
+    on_added is called with each so the owner can update its own indexes,
+    then listeners are notified.
+    """
+
+    def __init__(self, catalog: Mapping[str, Any], kind: str,
+                 on_added: Optional[Listener] = None):
+        """Index the keys of catalog; kind names its entries in errors, e.g. 'Profile'"""
+        self._catalog = catalog
+        self.kind = kind
+        self._on_added = on_added
+        self._rowid: Optional[int] = None
+        keys_after = getattr(catalog, 'keys_after', None)
+        if keys_after is None:
+            self.keys: List[str] = list(catalog)
+        else:
+            rows = keys_after(0)
+            self.keys = [key for _, key in rows]
+            self._rowid = rows[-1][0] if rows else 0
+        self.positions: Dict[str, int] = {key: index for index, key in enumerate(self.keys)}
+        # Weights aligned with keys
+        self._weights: List[float] = [1.0] * len(self.keys)
+        self._alias: Optional[AliasTable] = None
+        self.weighted = False
+        self.listeners = ListenerList()
+
+    def __len__(self) -> int:
+        """Number of keys indexed"""
+        return len(self.keys)
+
+    def __contains__(self, key: object) -> bool:
+        """Whether a key is indexed (without refreshing)"""
+        return key in self.positions
+
+    def refresh(self) -> None:
+        """Pick up keys that other processes added to a shared store"""
+        if self._rowid is None:
+            return
+        for rowid, key in self._catalog.keys_after(self._rowid):
+            self._rowid = rowid
+            if key in self.positions:
+                continue
+            self._append(key)
+            if self._on_added is not None:
+                self._on_added(key)
+            self.listeners.notify(key)
+
+    def add(self, key: str) -> bool:
+        """
+        Add a key to the end of the index after a refresh
+        Returns False if it was already indexed
+        """
+        self.refresh()
+        if key in self.positions:
+            return False
+        self._append(key)
+        return True
+
+    def _append(self, key: str) -> None:
+        """Add a key with the default weight"""
+        self.positions[key] = len(self.keys)
+        self.keys.append(key)
+        self._weights.append(1.0)
+        self._alias = None
+
+    def sample_key(self, rng: Optional[random.Random] = None) -> str:
+        """Draw a key, weighted once any weight has been set"""
+        self.refresh()
+        if self.weighted:
+            return self.keys[self._get_alias().draw(rng)]
+        return (rng or random).choice(self.keys)
+
+    def sample_indices(self, k: int, rng: Optional[random.Random] = None) -> List[int]:
+        """Draw k key positions in one call, weighted once any weight has been set"""
+        self.refresh()
+        if self.weighted:
+            return self._get_alias().draw_many(k, rng)
+        return (rng or random).choices(range(len(self.keys)), k=k)
+
+    def set_weight(self, key: str, weight: float) -> None:
+        """Set the relative sampling weight of a key, making draws weighted"""
+        self.refresh()
+        index = self.positions.get(key)
+        if index is None:
+            raise ValueError(f"{self.kind} '{key}' not found")
+        if weight < 0:
+            raise ValueError(f"Weight must be non-negative, got {weight}")
+        self._weights[index] = float(weight)
+        self._alias = None
+        self.weighted = True
+
+    def get_weight(self, key: str) -> float:
+        """Get the sampling weight of a key"""
+        index = self.positions.get(key)
+        if index is None:
+            raise ValueError(f"{self.kind} '{key}' not found")
+        return self._weights[index]
+
+    def _get_alias(self) -> AliasTable:
+        """Return the alias table for the current weights, rebuilding it if stale"""
+        if self._alias is None:
+            self._alias = AliasTable(self._weights)
+        return self._alias
@@ -0,0 +1,216 @@
+"""
+Agent Snapshots
+Compact binary snapshots of DynamicAgent state for moving sessions between processes
+"""
+
+import struct
+import sys
+from array import array
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .system_prompt import PromptHandle, SystemPromptSkill
+
+
+# (size, undrawn indices, last draw) of a ShuffleBag
+BagState = Tuple[int, List[int], Optional[int]]
+
+SNAPSHOT_MAGIC = b'DAGS'
+SNAPSHOT_VERSION = 1
+
+_NONE = 0xFFFF  # string reference meaning "no string"
+_TIERS = SystemPromptSkill.TIERS
+_HEADER = struct.Struct('<4sBH')
+_LENGTH = struct.Struct('<H')
+_PERSONA = struct.Struct('<HHHHBHH')
+_RNG = struct.Struct('<B?d')
+_COUNT = struct.Struct('<B')
+_BAG = struct.Struct('<IiI')
+_MESSAGES = struct.Struct('<I')
+
+
+class AgentSnapshot(NamedTuple):
+    """The state of a DynamicAgent, by catalog keys rather than rendered text"""
+    profile_key: Optional[str]
+    style_key: Optional[str]
+    # The keys and tier the current system prompt was rendered from
+    prompt: Optional[PromptHandle]
+    tier: str
+    # Persona IDs 1..n in order; ID 0 means no persona, (None, None) a free ID
+    persona_handles: List[PromptHandle]
+    current_persona_id: int
+    rng_state: tuple
+    shuffle_state: Optional[Tuple[BagState, BagState]]
+    # (role, content, persona ID), oldest first
+    messages: List[Tuple[str, str, int]]
+
+
+def _array_bytes(values: array) -> bytes:
+    """Little-endian bytes of an array"""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class _Reader:
+    """Cursor over snapshot bytes"""
+
+    def __init__(self, data: bytes):
+        """Start reading at the beginning of data"""
+        self._data = memoryview(data)
+        self._offset = 0
+
+    def unpack(self, layout: struct.Struct) -> tuple:
+        """Read one struct"""
+        try:
+            values = layout.unpack_from(self._data, self._offset)
+        except struct.error as error:
+            raise ValueError(f"Truncated snapshot: {error}") from None
+        self._offset += layout.size
+        return values
+
+    def take(self, size: int) -> memoryview:
+        """Read size raw bytes"""
+        end = self._offset + size
+        if end > len(self._data):
+            raise ValueError("Truncated snapshot")
+        chunk = self._data[self._offset:end]
+        self._offset = end
+        return chunk
+
+    def array(self, typecode: str, count: int) -> array:
+        """Read count little-endian array items"""
+        values = array(typecode)
+        values.frombytes(self.take(count * values.itemsize))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+
+def encode_snapshot(snapshot: AgentSnapshot) -> bytes:
+    """
+    Pack a snapshot into a little-endian struct layout
+    Keys and roles are stored once in a string table and referenced by
+    16-bit index; history is stored as columns (role, persona ID, length)
+    followed by the concatenated UTF-8 message texts
+    """
+    strings: Dict[str, int] = {}
+
+    def ref(value: Optional[str]) -> int:
+        """String table index of a value, adding it on first use"""
+        if value is None:
+            return _NONE
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+            if index >= _NONE:
+                raise ValueError("Too many distinct keys and roles for a snapshot")
+        return index
+
+    prompt = snapshot.prompt or PromptHandle(None, None)
+    body = [_PERSONA.pack(
+        ref(snapshot.profile_key), ref(snapshot.style_key),
+        ref(prompt.profile_key), ref(prompt.style_key),
+        _TIERS.index(snapshot.tier),
+        snapshot.current_persona_id, len(snapshot.persona_handles)
+    )]
+    body.append(_array_bytes(array('H', [
+        ref(key) for handle in snapshot.persona_handles for key in handle
+    ])))
+
+    version, internal, gauss = snapshot.rng_state
+    body.append(_RNG.pack(version, gauss is not None, gauss or 0.0))
+    body.append(_LENGTH.pack(len(internal)))
+    body.append(_array_bytes(array('I', internal)))
+
+    bags = snapshot.shuffle_state or ()
+    body.append(_COUNT.pack(len(bags)))
+    for size, remaining, last in bags:
+        body.append(_BAG.pack(size, -1 if last is None else last, len(remaining)))
+        body.append(_array_bytes(array('I', remaining)))
+
+    roles = array('H')
+    personas = array('H')
+    lengths = array('I')
+    texts = []
+    for role, content, persona in snapshot.messages:
+        text = content.encode('utf-8')
+        roles.append(ref(role))
+        personas.append(persona)
+        lengths.append(len(text))
+        texts.append(text)
+    body.append(_MESSAGES.pack(len(texts)))
+    body.extend((_array_bytes(roles), _array_bytes(personas), _array_bytes(lengths)))
+    body.extend(texts)
+
+    header = [_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(strings))]
+    for value in strings:
+        encoded = value.encode('utf-8')
+        header.append(_LENGTH.pack(len(encoded)))
+        header.append(encoded)
+    return b''.join(header + body)
+
+
+def decode_snapshot(data: bytes) -> AgentSnapshot:
+    """Unpack bytes written by encode_snapshot"""
+    reader = _Reader(data)
+    magic, version, string_count = reader.unpack(_HEADER)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not an agent snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot version {version} not supported")
+    strings = [
+        str(reader.take(reader.unpack(_LENGTH)[0]), 'utf-8') for _ in range(string_count)
+    ]
+
+    def lookup(index: int) -> Optional[str]:
+        """String table entry of an index"""
+        if index == _NONE:
+            return None
+        if index >= len(strings):
+            raise ValueError("Corrupt snapshot: string reference out of range")
+        return strings[index]
+
+    (profile_ref, style_ref, prompt_profile_ref, prompt_style_ref,
+     tier, current_persona_id, handle_count) = reader.unpack(_PERSONA)
+    if tier >= len(_TIERS):
+        raise ValueError("Corrupt snapshot: unknown prompt tier")
+    prompt = None
+    if prompt_profile_ref != _NONE:
+        prompt = PromptHandle(lookup(prompt_profile_ref), lookup(prompt_style_ref))
+    handle_refs = reader.array('H', 2 * handle_count)
+    persona_handles = [
+        PromptHandle(lookup(handle_refs[index]), lookup(handle_refs[index + 1]))
+        for index in range(0, len(handle_refs), 2)
+    ]
+
+    rng_version, has_gauss, gauss = reader.unpack(_RNG)
+    internal = tuple(reader.array('I', reader.unpack(_LENGTH)[0]))
+    rng_state = (rng_version, internal, gauss if has_gauss else None)
+
+    bags = []
+    for _ in range(reader.unpack(_COUNT)[0]):
+        size, last, remaining_count = reader.unpack(_BAG)
+        remaining = reader.array('I', remaining_count).tolist()
+        bags.append((size, remaining, None if last < 0 else last))
+
+    message_count = reader.unpack(_MESSAGES)[0]
+    roles = reader.array('H', message_count)
+    personas = reader.array('H', message_count)
+    lengths = reader.array('I', message_count)
+    messages = [
+        (lookup(role), str(reader.take(length), 'utf-8'), persona)
+        for role, persona, length in zip(roles, personas, lengths)
+    ]
+
+    return AgentSnapshot(
+        profile_key=lookup(profile_ref),
+        style_key=lookup(style_ref),
+        prompt=prompt,
+        tier=_TIERS[tier],
+        persona_handles=persona_handles,
+        current_persona_id=current_persona_id,
+        rng_state=rng_state,
+        shuffle_state=tuple(bags) if bags else None,
+        messages=messages
+    )
@@ -0,0 +1,215 @@
+"""
+Persona Stores
+SQLite-backed profile and style catalogs with indexed lookups, shareable between processes
+"""
+
+import json
+import sqlite3
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import asdict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple
+
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+def _entry_record(entry: Any) -> Dict[str, Any]:
+    """Return the catalog record of a profile or style"""
+    to_record = getattr(entry, 'to_record', None)
+    return to_record() if to_record else asdict(entry)
+
+
+class SqliteCatalog(MutableMapping):
+    """
+    A key -> entry mapping stored in a SQLite table
+
+    Each row holds the entry's JSON record plus copies of selected record
+    fields in indexed columns, so attribute filters run as index lookups.
+    When a terms function is given, its terms for each entry are kept in a
+    companion table keyed by (term, key). Reads go through an in-process
+    LRU of built entries; the database file can be shared by several
+    processes, although entries cached by one process do not see writes
+    made by another.
+    """
+
+    def __init__(self, path: str, table: str, factory: Callable[[Mapping[str, Any]], Any],
+                 columns: Sequence[str] = (),
+                 terms: Optional[Callable[[Any], Iterable[str]]] = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        """Open (and if needed create) the table in the database at path"""
+        if not table.isidentifier() or not all(column.isidentifier() for column in columns):
+            raise ValueError("Table and column names must be identifiers")
+        self.path = path
+        self.table = table
+        self.factory = factory
+        self.columns: Tuple[str, ...] = tuple(columns)
+        self.terms = terms
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[str, Any]' = OrderedDict()
+
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        """Create the entry table, its attribute indexes and the term table"""
+        table = self.table
+        column_sql = ''.join(f', {column} TEXT' for column in self.columns)
+        with self._connection:
+            self._connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                f'(key TEXT PRIMARY KEY, record TEXT NOT NULL{column_sql})'
+            )
+            for column in self.columns:
+                self._connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})'
+                )
+            if self.terms is not None:
+                self._connection.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table}_terms '
+                    f'(term TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (term, key)) WITHOUT ROWID'
+                )
+                self._connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS {table}_terms_key ON {table}_terms (key)'
+                )
+
+    def _write(self, key: str, entry: Any) -> None:
+        """Upsert one entry; the caller commits"""
+        record = _entry_record(entry)
+        columns = self.columns
+        column_names = ''.join(f', {column}' for column in columns)
+        placeholders = ', ?' * len(columns)
+        updates = ''.join(f', {column} = excluded.{column}' for column in columns)
+        self._connection.execute(
+            f'INSERT INTO {self.table} (key, record{column_names}) VALUES (?, ?{placeholders}) '
+            f'ON CONFLICT (key) DO UPDATE SET record = excluded.record{updates}',
+            (key, json.dumps(record, ensure_ascii=False), *(record.get(column) for column in columns))
+        )
+        if self.terms is not None:
+            self._connection.execute(f'DELETE FROM {self.table}_terms WHERE key = ?', (key,))
+            self._connection.executemany(
+                f'INSERT INTO {self.table}_terms (term, key) VALUES (?, ?)',
+                [(term, key) for term in set(self.terms(entry))]
+            )
+
+    def _remember(self, key: str, entry: Any) -> None:
+        """Put an entry at the front of the LRU, evicting the oldest if full"""
+        cache = self._cache
+        cache[key] = entry
+        cache.move_to_end(key)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def __getitem__(self, key: str) -> Any:
+        """Return an entry from the LRU, or build it from its stored record"""
+        cache = self._cache
+        entry = cache.get(key)
+        if entry is not None:
+            cache.move_to_end(key)
+            return entry
+        row = self._connection.execute(
+            f'SELECT record FROM {self.table} WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        entry = self.factory(json.loads(row[0]))
+        self._remember(key, entry)
+        return entry
+
+    def __setitem__(self, key: str, entry: Any) -> None:
+        """Add or replace an entry"""
+        with self._connection:
+            self._write(key, entry)
+        self._remember(key, entry)
+
+    def __delitem__(self, key: str) -> None:
+        """Remove an entry"""
+        with self._connection:
+            cursor = self._connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            if cursor.rowcount == 0:
+                raise KeyError(key)
+            if self.terms is not None:
+                self._connection.execute(f'DELETE FROM {self.table}_terms WHERE key = ?', (key,))
+        self._cache.pop(key, None)
+
+    def __contains__(self, key: object) -> bool:
+        """Check for a key without building its entry"""
+        if key in self._cache:
+            return True
+        return self._connection.execute(
+            f'SELECT 1 FROM {self.table} WHERE key = ?', (key,)
+        ).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate keys in insertion order"""
+        rows = self._connection.execute(f'SELECT key FROM {self.table} ORDER BY rowid').fetchall()
+        return (row[0] for row in rows)
+
+    def __len__(self) -> int:
+        """Number of entries in the store"""
+        return self._connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def keys_after(self, rowid: int) -> List[Tuple[int, str]]:
+        """
+        Return (rowid, key) for the entries stored after rowid, in insertion
+        order; a rowid range scan, so polling for entries added by other
+        processes is cheap
+        """
+        return self._connection.execute(
+            f'SELECT rowid, key FROM {self.table} WHERE rowid > ? ORDER BY rowid', (rowid,)
+        ).fetchall()
+
+    def add_many(self, entries: Mapping[str, Any]) -> int:
+        """
+        Add or replace many entries in one transaction
+        Returns the number of entries written
+        """
+        with self._connection:
+            for key, entry in entries.items():
+                self._write(key, entry)
+                self._cache.pop(key, None)
+        return len(entries)
+
+    def query(self, **attributes: str) -> List[str]:
+        """
+        Return the keys whose indexed columns equal every given value,
+        in insertion order
+        """
+        unknown = set(attributes) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Cannot filter on {', '.join(sorted(unknown))}")
+        where = ' AND '.join(f'{column} = ?' for column in attributes) or '1'
+        rows = self._connection.execute(
+            f'SELECT key FROM {self.table} WHERE {where} ORDER BY rowid',
+            tuple(attributes.values())
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def find_term(self, term: str, prefix: bool = False) -> Set[str]:
+        """Return the keys stored under a term, or under every term it prefixes"""
+        if self.terms is None:
+            raise ValueError(f"Store '{self.table}' does not index terms")
+        if not prefix:
+            rows = self._connection.execute(
+                f'SELECT key FROM {self.table}_terms WHERE term = ?', (term,)
+            )
+        else:
+            # A range scan over the (term, key) primary key
+            rows = self._connection.execute(
+                f'SELECT key FROM {self.table}_terms WHERE term >= ? AND term < ?',
+                (term, term + '\U0010ffff')
+            )
+        return {row[0] for row in rows}
+
+    def cached_count(self) -> int:
+        """Number of entries currently held in the LRU"""
+        return len(self._cache)
+
+    def close(self) -> None:
+        """Close the database connection"""
+        self._connection.close()
+
+    def __repr__(self) -> str:
+        """String representation of the store"""
+        return f"SqliteCatalog({self.path!r}, table={self.table!r}, cached={len(self._cache)})"
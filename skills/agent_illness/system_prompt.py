@@ -3,9 +3,20 @@ System Prompt Skill
 Generates dynamic system prompts based on randomly selected agent profiles and characteristics
 """
 
-from typing import Dict, Optional
+import hashlib
+import random
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 from .agent_profiles import AgentProfileManager, AgentProfile
 from .characteristics import CharacteristicManager, TalkingStyle
+from .sampling import ShuffleBag
+from .template import PromptTemplate
+from .tokenizer import ApproximateTokenizer, Tokenizer
+
+
+class PromptHandle(NamedTuple):
+    """A reference to a rendered prompt by its profile and style keys"""
+    profile_key: str
+    style_key: str
 
 
 class SystemPromptSkill:
@@ -14,17 +25,141 @@ class SystemPromptSkill:
     Allows agents to change their persona, name, and talking style dynamically
     """
     
-    def __init__(self):
-        """Initialize the system prompt skill with managers"""
-        self.profile_manager = AgentProfileManager()
-        self.characteristic_manager = CharacteristicManager()
+    # Persona fields reported in a persona delta, with their display labels
+    DELTA_FIELDS = (
+        ('agent_name', 'Name'),
+        ('role', 'Role'),
+        ('expertise_areas', 'Expertise Areas'),
+        ('description', 'Description'),
+        ('tone', 'Tone'),
+        ('formality', 'Formality Level'),
+        ('pace', 'Pace'),
+        ('verbosity', 'Verbosity'),
+        ('personality_traits', 'Personality Traits'),
+        ('communication_patterns', 'Communication Patterns'),
+    )
+    
+    # 'standard' opens with the persona; 'prefix_cache' opens with the shared
+    # instructions so every persona shares one cacheable prompt prefix
+    LAYOUTS = ('standard', 'prefix_cache')
+    
+    # Prompt tiers from richest to smallest
+    TIERS = ('full', 'compact', 'minimal')
+    
+    def __init__(self, layout: str = 'standard', tokenizer: Optional[Tokenizer] = None,
+                 profile_manager: Optional[AgentProfileManager] = None,
+                 characteristic_manager: Optional[CharacteristicManager] = None,
+                 rng: Optional[random.Random] = None, shuffle: bool = False):
+        """
+        Initialize the system prompt skill with managers
+        Args:
+            layout: One of LAYOUTS
+            tokenizer: Token counter for prompt accounting (defaults to an
+                offline ApproximateTokenizer)
+            profile_manager: Profile catalog to use (defaults to the built-in one)
+            characteristic_manager: Style catalog to use (defaults to the built-in one)
+            rng: Random stream for all random picks (defaults to a private,
+                unseeded one, so skills never share the global random state)
+            shuffle: Pick random profiles and styles from shuffle bags, so
+                none repeats until every one has been used
+        """
+        self.profile_manager = profile_manager or AgentProfileManager()
+        self.characteristic_manager = characteristic_manager or CharacteristicManager()
+        self.tokenizer = tokenizer or ApproximateTokenizer()
+        self.rng = rng if rng is not None else random.Random()
+        # The current persona belongs to the skill, not the managers, so
+        # skills sharing one catalog do not overwrite each other's selection
+        self.current_profile_key: Optional[str] = None
+        self.current_profile: Optional[AgentProfile] = None
+        self.current_style_key: Optional[str] = None
+        self.current_style: Optional[TalkingStyle] = None
+        self._profile_bag: Optional[ShuffleBag] = None
+        self._style_bag: Optional[ShuffleBag] = None
+        if shuffle:
+            self._profile_bag = ShuffleBag(len(self.profile_manager.get_profile_keys()))
+            self._style_bag = ShuffleBag(len(self.characteristic_manager.get_style_keys()))
+        # Rendered prompts keyed by tier, then profile key, then style key;
+        # _prompt_cache is the 'full' tier
+        self._tier_prompt_caches: Dict[str, Dict[str, Dict[str, str]]] = {
+            tier: {} for tier in self.TIERS
+        }
+        self._prompt_cache = self._tier_prompt_caches['full']
+        # Token counts of static template segments, keyed by segment text
+        self._section_token_counts: Dict[str, int] = {}
+        # Token counts of template fields, keyed by profile/style key then field
+        self._profile_token_counts: Dict[str, Dict[str, int]] = {}
+        self._style_token_counts: Dict[str, Dict[str, int]] = {}
+        self.set_layout(layout)
+        # Held weakly by the managers; detach() unregisters them explicitly
+        self.profile_manager.add_listener(self._invalidate_profile)
+        self.characteristic_manager.add_listener(self._invalidate_style)
+        self._attached = True
+    
+    def detach(self) -> None:
+        """Stop following catalog changes, e.g. before dropping a skill over shared managers"""
+        if self._attached:
+            self.profile_manager.remove_listener(self._invalidate_profile)
+            self.characteristic_manager.remove_listener(self._invalidate_style)
+            self._attached = False
+    
+    def set_layout(self, layout: str) -> None:
+        """Switch the prompt layout, recompiling the templates and dropping cached prompts"""
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Layout '{layout}' not found")
+        
+        self.layout = layout
         self.prompt_template = self._create_prompt_template()
+        partials = self._create_prompt_partials()
+        self.compiled_templates: Dict[str, PromptTemplate] = {
+            tier: PromptTemplate(source, partials=partials)
+            for tier, source in self._create_tier_templates().items()
+        }
+        self.compiled_template = self.compiled_templates['full']
+        for cache in self._tier_prompt_caches.values():
+            cache.clear()
     
     def _create_prompt_template(self) -> str:
-        """Create the base template for system prompts"""
+        """
+        Create the base template for system prompts in the current layout
+        Uses PromptTemplate syntax: {field}, {#section}...{/section} and {>partial}
+        """
+        if self.layout == 'prefix_cache':
+            return """{>shared_instructions}
+## Persona
+You are {agent_name}, a {role}.
+
+{>identity}{#communication_patterns}
+## Communication Patterns
+{communication_patterns}
+{/communication_patterns}"""
+        
         return """You are {agent_name}, a {role}.
 
-## Identity
+{>identity}
+{#communication_patterns}## Communication Patterns
+{communication_patterns}
+
+{/communication_patterns}{>behavioral_guidelines}
+{>core_instructions}"""
+    
+    def _create_tier_templates(self) -> Dict[str, str]:
+        """Create the template for every prompt tier in the current layout"""
+        if self.layout == 'prefix_cache':
+            compact = """{>compact_instructions}
+{>compact_persona}"""
+        else:
+            compact = """{>compact_persona}{>compact_instructions}"""
+        
+        return {
+            'full': self.prompt_template,
+            'compact': compact,
+            'minimal': "You are {agent_name}, a {role}. Tone: {tone}.\n",
+        }
+    
+    def _create_prompt_partials(self) -> Dict[str, str]:
+        """Create the sections that templates include as partials"""
+        return {
+            'identity': """## Identity
 - Role: {role}
 - Name: {agent_name}
 - Expertise Areas: {expertise_areas}
@@ -36,25 +171,56 @@ class SystemPromptSkill:
 - Pace: {pace}
 - Verbosity: {verbosity}
 - Personality Traits: {personality_traits}
-
-## Communication Patterns
-{communication_patterns}
-
-## Behavioral Guidelines
+""",
+            'behavioral_guidelines': """## Behavioral Guidelines
 1. Maintain your assigned role and expertise consistently
 2. Communicate in the specified tone and formality level
 3. Adapt your response pace to the conversation needs
 4. Provide responses matching your verbosity preference
 5. Demonstrate the personality traits listed above
 6. Follow the communication patterns for greetings, explanations, and closings
+""",
+            'core_instructions': """## Core Instructions
+- Always stay in character as {agent_name}
+- Use your expertise areas to provide valuable insights
+- Follow your communication style guidelines in every interaction
+- Be helpful, honest, and harmless while maintaining your persona
+- Adapt your responses to the user's needs while staying true to your characteristics
+""",
+            'compact_persona': """You are {agent_name}, a {role}.
+Expertise: {expertise_areas}
+Style: {tone}; {formality}, {pace} pace, {verbosity} answers. Traits: {personality_traits}.
+""",
+            'compact_instructions': """Stay in character, use your expertise, match your style, and be helpful, honest, and harmless.
+""",
+            # Persona-independent wording of the two sections above
+            'shared_instructions': """## Behavioral Guidelines
+1. Maintain your assigned role and expertise consistently
+2. Communicate in the specified tone and formality level
+3. Adapt your response pace to the conversation needs
+4. Provide responses matching your verbosity preference
+5. Demonstrate the personality traits listed in your persona
+6. Follow the communication patterns for greetings, explanations, and closings
 
 ## Core Instructions
-- Always stay in character as {agent_name}
+- Always stay in character as the persona described below
 - Use your expertise areas to provide valuable insights
 - Follow your communication style guidelines in every interaction
 - Be helpful, honest, and harmless while maintaining your persona
 - Adapt your responses to the user's needs while staying true to your characteristics
-"""
+""",
+        }
+    
+    def get_shared_prefix(self) -> str:
+        """
+        Get the static text every prompt in the current layout starts with
+        In the 'prefix_cache' layout this covers the shared instructions
+        """
+        return self.compiled_template.static_prefix
+    
+    def get_prefix_hash(self) -> str:
+        """Get a stable SHA-256 hex digest of the shared prompt prefix"""
+        return hashlib.sha256(self.get_shared_prefix().encode('utf-8')).hexdigest()
     
     def generate_system_prompt(self) -> str:
         """
@@ -62,10 +228,10 @@ class SystemPromptSkill:
         Returns a complete system prompt string
         """
         # Select random profile and characteristics
-        profile = self.profile_manager.get_random_profile()
-        style = self.characteristic_manager.get_random_style()
+        profile = self._pick_profile()
+        style = self._pick_style()
         
-        return self._format_prompt(profile, style)
+        return self._get_prompt(self.current_profile_key, profile, self.current_style_key, style)
     
     def generate_system_prompt_for_profile(self, profile_key: str) -> str:
         """
@@ -75,9 +241,9 @@ class SystemPromptSkill:
         if not profile:
             raise ValueError(f"Profile '{profile_key}' not found")
         
-        self.profile_manager.current_profile = profile
-        style = self.characteristic_manager.get_random_style()
-        return self._format_prompt(profile, style)
+        self._set_profile(profile_key, profile)
+        style = self._pick_style()
+        return self._get_prompt(profile_key, profile, self.current_style_key, style)
     
     def generate_system_prompt_for_style(self, style_key: str) -> str:
         """
@@ -87,9 +253,19 @@ class SystemPromptSkill:
         if not style:
             raise ValueError(f"Style '{style_key}' not found")
         
-        self.characteristic_manager.current_style = style
-        profile = self.profile_manager.get_random_profile()
-        return self._format_prompt(profile, style)
+        self._set_style(style_key, style)
+        profile = self._pick_profile()
+        return self._get_prompt(self.current_profile_key, profile, style_key, style)
+    
+    def generate_system_prompt_for_space_style(self, profile_key: Optional[str] = None) -> str:
+        """
+        Generate a system prompt with a style drawn from the style space
+        The profile is chosen at random if omitted; the prompt is not cached
+        """
+        handle = self.select_persona(profile_key, space_style=True)
+        return self._get_prompt(
+            handle.profile_key, self.current_profile, handle.style_key, self.current_style
+        )
     
     def generate_system_prompt_custom(self, profile_key: str, style_key: str) -> str:
         """
@@ -103,41 +279,415 @@ class SystemPromptSkill:
         if not style:
             raise ValueError(f"Style '{style_key}' not found")
         
-        self.profile_manager.current_profile = profile
-        self.characteristic_manager.current_style = style
+        self._set_profile(profile_key, profile)
+        self._set_style(style_key, style)
+        return self._get_prompt(profile_key, profile, style_key, style)
+    
+    def generate_system_prompts_batch(self, n: int, seed: Optional[int] = None,
+                                      as_handles: bool = False
+                                      ) -> List[Union[str, PromptHandle]]:
+        """
+        Generate n prompts for random profile/style pairs in one step
+        All pairs are drawn at once from a dedicated RNG when seed is given
+        (for reproducible datasets), otherwise from the skill's rng, honoring
+        profile/style weights when set; each distinct pair is rendered only once,
+        into a call-local table rather than the prompt cache, so large batches
+        do not leave their prompts cached. The current profile and style are
+        left untouched.
+        Returns prompt strings, or PromptHandles if as_handles is True
+        """
+        if n < 0:
+            raise ValueError(f"Batch size must be non-negative, got {n}")
+        profile_keys = self.profile_manager.get_profile_keys()
+        style_keys = self.characteristic_manager.get_style_keys()
+        if not profile_keys or not style_keys:
+            raise ValueError("No profiles or styles available")
+        
+        rng = random.Random(seed) if seed is not None else self.rng
+        if self.profile_manager.is_weighted() or self.characteristic_manager.is_weighted():
+            profile_indices = self.profile_manager.sample_profile_indices(n, rng)
+            style_indices = self.characteristic_manager.sample_style_indices(n, rng)
+            # Sampling may pick up keys added to a shared store; the lists only grow
+            num_styles = len(style_keys)
+            pair_indices = [
+                profile_index * num_styles + style_index
+                for profile_index, style_index in zip(profile_indices, style_indices)
+            ]
+        else:
+            num_styles = len(style_keys)
+            pair_indices = rng.choices(range(len(profile_keys) * num_styles), k=n)
+        
+        # Resolve each distinct pair once, then fan the results out
+        resolved = {}
+        for index in set(pair_indices):
+            profile_key = profile_keys[index // num_styles]
+            style_key = style_keys[index % num_styles]
+            if as_handles:
+                resolved[index] = PromptHandle(profile_key, style_key)
+            else:
+                resolved[index] = self._format_prompt(
+                    self.profile_manager.profiles[profile_key],
+                    self.characteristic_manager.talking_styles[style_key]
+                )
+        return list(map(resolved.__getitem__, pair_indices))
+    
+    def render_handle(self, handle: PromptHandle) -> str:
+        """Render the prompt a PromptHandle refers to without changing the current persona"""
+        profile = self.profile_manager.get_profile_by_role(handle.profile_key)
+        style = self.characteristic_manager.get_style_by_name(handle.style_key)
+        
+        if not profile:
+            raise ValueError(f"Profile '{handle.profile_key}' not found")
+        if not style:
+            raise ValueError(f"Style '{handle.style_key}' not found")
+        
+        return self._get_prompt(handle.profile_key, profile, handle.style_key, style)
+    
+    def _set_profile(self, key: str, profile: AgentProfile) -> AgentProfile:
+        """Make a profile the skill's current one"""
+        self.current_profile_key = key
+        self.current_profile = profile
+        return profile
+    
+    def _set_style(self, key: str, style: TalkingStyle) -> TalkingStyle:
+        """Make a style the skill's current one"""
+        self.current_style_key = key
+        self.current_style = style
+        return style
+    
+    def _pick_profile(self) -> AgentProfile:
+        """
+        Make a random profile current using the skill's rng
+        Draws from the shuffle bag when shuffling, otherwise from the manager
+        """
+        manager = self.profile_manager
+        bag = self._profile_bag
+        if bag is None:
+            key = manager.sample_profile_key(self.rng)
+        else:
+            keys = manager.get_profile_keys()
+            if len(keys) > bag.size:
+                bag.grow(len(keys))
+            key = keys[bag.draw(self.rng)]
+        return self._set_profile(key, manager.profiles[key])
+    
+    def _pick_style(self) -> TalkingStyle:
+        """
+        Make a random style current using the skill's rng
+        Draws from the shuffle bag when shuffling, otherwise from the manager
+        """
+        manager = self.characteristic_manager
+        bag = self._style_bag
+        if bag is None:
+            key = manager.sample_style_key(self.rng)
+        else:
+            keys = manager.get_style_keys()
+            if len(keys) > bag.size:
+                bag.grow(len(keys))
+            key = keys[bag.draw(self.rng)]
+        return self._set_style(key, manager.talking_styles[key])
+    
+    def _pick_space_style(self) -> TalkingStyle:
+        """
+        Make a random style from the manager's style space current using the
+        skill's rng; the style is not added to the catalog
+        """
+        manager = self.characteristic_manager
+        key = manager.sample_space_style_key(self.rng)
+        return self._set_style(key, manager.get_style_by_name(key))
+    
+    def get_shuffle_state(self) -> Optional[Tuple[Tuple, Tuple]]:
+        """Get the profile and style shuffle bag states (None when not shuffling)"""
+        if self._profile_bag is None:
+            return None
+        return self._profile_bag.getstate(), self._style_bag.getstate()
+    
+    def set_shuffle_state(self, state: Optional[Tuple[Tuple, Tuple]]) -> None:
+        """Restore shuffle bag states from get_shuffle_state; None turns shuffling off"""
+        if state is None:
+            self._profile_bag = self._style_bag = None
+            return
+        self._profile_bag = ShuffleBag(0)
+        self._style_bag = ShuffleBag(0)
+        self._profile_bag.setstate(state[0])
+        self._style_bag.setstate(state[1])
+    
+    def select_persona(self, profile_key: Optional[str] = None,
+                       style_key: Optional[str] = None,
+                       space_style: bool = False) -> PromptHandle:
+        """
+        Make a profile/style pair current without rendering a prompt
+        Either key may be omitted to pick that half at random; with
+        space_style, an omitted style is drawn from the style space
+        """
+        if profile_key is None:
+            self._pick_profile()
+        else:
+            profile = self.profile_manager.get_profile_by_role(profile_key)
+            if not profile:
+                raise ValueError(f"Profile '{profile_key}' not found")
+            self._set_profile(profile_key, profile)
+        
+        if style_key is None:
+            if space_style:
+                self._pick_space_style()
+            else:
+                self._pick_style()
+        else:
+            style = self.characteristic_manager.get_style_by_name(style_key)
+            if not style:
+                raise ValueError(f"Style '{style_key}' not found")
+            self._set_style(style_key, style)
+        
+        return PromptHandle(self.current_profile_key, self.current_style_key)
+    
+    def build_persona_delta(self, old: PromptHandle, new: PromptHandle) -> str:
+        """
+        Build a compact message describing only the persona fields that differ
+        between two profile/style pairs, to append to an existing conversation
+        instead of resending a full system prompt
+        Returns an empty string when nothing changed
+        """
+        contexts = []
+        for handle in (old, new):
+            profile = self.profile_manager.get_profile_by_role(handle.profile_key)
+            style = self.characteristic_manager.get_style_by_name(handle.style_key)
+            if not profile:
+                raise ValueError(f"Profile '{handle.profile_key}' not found")
+            if not style:
+                raise ValueError(f"Style '{handle.style_key}' not found")
+            contexts.append(self._build_context(profile, style))
+        old_context, new_context = contexts
+        
+        changes = []
+        for field, label in self.DELTA_FIELDS:
+            value = new_context[field]
+            if value == old_context[field]:
+                continue
+            if field == 'communication_patterns':
+                changes.append(f"- {label}:\n{value}" if value else f"- {label}: none")
+            else:
+                changes.append(f"- {label}: {value}")
+        
+        if not changes:
+            return ''
+        return (
+            "## Persona Update\n"
+            f"From now on you are {new_context['agent_name']}, a {new_context['role']}. "
+            "All earlier instructions still apply except for these changes:\n"
+            + '\n'.join(changes) + '\n'
+        )
+    
+    def render_prompt_uncached(self, profile_key: str, style_key: str) -> str:
+        """
+        Render the prompt for a profile/style pair without reading or filling
+        the prompt cache, for bulk exports whose size would make caching costly
+        """
+        profile = self.profile_manager.get_profile_by_role(profile_key)
+        style = self.characteristic_manager.get_style_by_name(style_key)
+        
+        if not profile:
+            raise ValueError(f"Profile '{profile_key}' not found")
+        if not style:
+            raise ValueError(f"Style '{style_key}' not found")
+        
         return self._format_prompt(profile, style)
     
-    def _format_prompt(self, profile: AgentProfile, style: TalkingStyle) -> str:
+    def _get_prompt(self, profile_key: str, profile: AgentProfile,
+                    style_key: str, style: TalkingStyle, tier: str = 'full') -> str:
+        """
+        Return the rendered prompt for a profile/style pair, rendering it once
+        and serving later requests for the same pair from the prompt cache
+        Prompts for generated style space styles are rendered but not cached
+        """
+        cache = self._tier_prompt_caches[tier]
+        row = cache.get(profile_key)
+        prompt = row.get(style_key) if row is not None else None
+        if prompt is None:
+            prompt = self._format_prompt(profile, style, tier)
+            if self.characteristic_manager.is_catalog_style(style_key):
+                if row is None:
+                    row = cache[profile_key] = {}
+                row[style_key] = prompt
+        return prompt
+    
+    def get_prompt_tier(self, profile_key: str, style_key: str, tier: str) -> str:
+        """Get the cached prompt of one tier for a profile/style pair"""
+        if tier not in self.TIERS:
+            raise ValueError(f"Tier '{tier}' not found")
+        profile = self.profile_manager.get_profile_by_role(profile_key)
+        style = self.characteristic_manager.get_style_by_name(style_key)
+        
+        if not profile:
+            raise ValueError(f"Profile '{profile_key}' not found")
+        if not style:
+            raise ValueError(f"Style '{style_key}' not found")
+        
+        return self._get_prompt(profile_key, profile, style_key, style, tier)
+    
+    def select_prompt_tier(self, profile_key: str, style_key: str, token_budget: int) -> str:
+        """
+        Pick the richest tier whose prompt fits within token_budget
+        Raises ValueError if not even the minimal tier fits
+        """
+        for tier in self.TIERS:
+            if self.count_prompt_tokens(profile_key, style_key, tier) <= token_budget:
+                return tier
+        raise ValueError(f"No prompt tier fits a budget of {token_budget} tokens")
+    
+    def generate_system_prompt_for_budget(self, token_budget: int,
+                                          profile_key: Optional[str] = None,
+                                          style_key: Optional[str] = None) -> str:
+        """
+        Generate a system prompt in the richest tier that fits token_budget
+        Omitted profile/style keys are chosen at random, as in select_persona
+        """
+        handle = self.select_persona(profile_key, style_key)
+        tier = self.select_prompt_tier(handle.profile_key, handle.style_key, token_budget)
+        return self.get_prompt_tier(handle.profile_key, handle.style_key, tier)
+    
+    def precompute_tiers(self, profile_keys: Optional[Iterable[str]] = None,
+                         style_keys: Optional[Iterable[str]] = None) -> int:
+        """
+        Render and cache every tier for each profile/style pair
+        Defaults to the whole catalog. Returns the number of prompts cached
+        """
+        if profile_keys is None:
+            profile_keys = self.profile_manager.get_profile_keys()
+        if style_keys is None:
+            style_keys = self.characteristic_manager.get_style_keys()
+        style_keys = list(style_keys)
+        
+        count = 0
+        for profile_key in profile_keys:
+            for style_key in style_keys:
+                for tier in self.TIERS:
+                    self.get_prompt_tier(profile_key, style_key, tier)
+                    self.count_prompt_tokens(profile_key, style_key, tier)
+                    count += 1
+        return count
+    
+    def _invalidate_profile(self, profile_key: str) -> None:
+        """Drop cached prompts for one profile (a row of the cache)"""
+        for cache in self._tier_prompt_caches.values():
+            cache.pop(profile_key, None)
+        self._profile_token_counts.pop(profile_key, None)
+    
+    def _invalidate_style(self, style_key: str) -> None:
+        """Drop cached prompts for one style (a column of the cache)"""
+        for cache in self._tier_prompt_caches.values():
+            for row in cache.values():
+                row.pop(style_key, None)
+        self._style_token_counts.pop(style_key, None)
+    
+    def clear_prompt_cache(self) -> None:
+        """
+        Drop every cached prompt
+        Needed only when profiles or styles are mutated in place rather than
+        replaced through add_profile/add_style
+        """
+        for cache in self._tier_prompt_caches.values():
+            cache.clear()
+        self._profile_token_counts.clear()
+        self._style_token_counts.clear()
+    
+    def _format_prompt(self, profile: AgentProfile, style: TalkingStyle,
+                       tier: str = 'full') -> str:
         """
         Format the prompt template with profile and style information
         """
+        return self.compiled_templates[tier].render(self._build_context(profile, style))
+    
+    def _build_context(self, profile: AgentProfile, style: TalkingStyle) -> Dict[str, str]:
+        """Build the template context for a profile and style"""
+        context = self._profile_context(profile)
+        context.update(self._style_context(style))
+        return context
+    
+    def _profile_context(self, profile: AgentProfile) -> Dict[str, str]:
+        """Build the template fields that come from a profile"""
+        return {
+            'agent_name': profile.name,
+            'role': profile.role,
+            'expertise_areas': ', '.join(profile.expertise_areas),
+            'description': profile.description,
+        }
+    
+    def _style_context(self, style: TalkingStyle) -> Dict[str, str]:
+        """Build the template fields that come from a talking style"""
         communication_patterns_str = '\n'.join([
             f"  - {key.capitalize()}: {value}"
             for key, value in style.communication_patterns.items()
         ])
         
-        prompt = self.prompt_template.format(
-            agent_name=profile.name,
-            role=profile.role,
-            expertise_areas=', '.join(profile.expertise_areas),
-            description=profile.description,
-            tone=style.tone,
-            formality=style.formality,
-            pace=style.pace,
-            verbosity=style.verbosity,
-            personality_traits=', '.join(style.personality_traits),
-            communication_patterns=communication_patterns_str
-        )
+        return {
+            'tone': style.tone,
+            'formality': style.formality,
+            'pace': style.pace,
+            'verbosity': style.verbosity,
+            'personality_traits': ', '.join(style.personality_traits),
+            'communication_patterns': communication_patterns_str,
+        }
+    
+    def count_tokens(self, text: str) -> int:
+        """Count the tokens in text with the skill's tokenizer"""
+        return self.tokenizer.count(text)
+    
+    def count_prompt_tokens(self, profile_key: Optional[str] = None,
+                            style_key: Optional[str] = None, tier: str = 'full') -> int:
+        """
+        Count the tokens of the prompt for a profile/style pair without rendering it
+        Defaults to the current profile and style. The total is a sum of token
+        counts cached per template section and per profile/style field
+        """
+        template = self.compiled_templates.get(tier)
+        if template is None:
+            raise ValueError(f"Tier '{tier}' not found")
+        if profile_key is None:
+            profile_key = self.current_profile_key
+        if style_key is None:
+            style_key = self.current_style_key
         
-        return prompt
+        profile_counts = self._profile_token_counts.get(profile_key)
+        if profile_counts is None:
+            profile = self.profile_manager.get_profile_by_role(profile_key)
+            if not profile:
+                raise ValueError(f"Profile '{profile_key}' not found")
+            profile_counts = self._profile_token_counts[profile_key] = {
+                field: self.tokenizer.count(value)
+                for field, value in self._profile_context(profile).items()
+            }
+        
+        style_counts = self._style_token_counts.get(style_key)
+        if style_counts is None:
+            style = self.characteristic_manager.get_style_by_name(style_key)
+            if not style:
+                raise ValueError(f"Style '{style_key}' not found")
+            style_counts = {
+                field: self.tokenizer.count(value)
+                for field, value in self._style_context(style).items()
+            }
+            if self.characteristic_manager.is_catalog_style(style_key):
+                self._style_token_counts[style_key] = style_counts
+        
+        return template.count_tokens(
+            {**profile_counts, **style_counts}, self._count_section_tokens
+        )
+    
+    def _count_section_tokens(self, text: str) -> int:
+        """Count the tokens of a static template segment, caching the result"""
+        count = self._section_token_counts.get(text)
+        if count is None:
+            count = self._section_token_counts[text] = self.tokenizer.count(text)
+        return count
     
     def get_current_persona(self) -> Dict[str, str]:
         """
         Get information about the current persona
         Returns a dictionary with profile and style information
         """
-        profile = self.profile_manager.get_current_profile()
-        style = self.characteristic_manager.get_current_style()
+        profile = self.current_profile
+        style = self.current_style
         
         if not profile or not style:
             return {}
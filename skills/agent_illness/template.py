@@ -0,0 +1,177 @@
+"""
+Prompt Template
+Compiles prompt templates once into static and dynamic segments for fast rendering
+"""
+
+import re
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+
+# Node kinds of a compiled template
+_STATIC = 0
+_FIELD = 1
+_SECTION = 2
+_INVERTED = 3
+
+# {{ and }} are literal braces, {name} is a field, {#name}/{^name} open a
+# conditional/inverted section closed by {/name}, {>name} includes a partial
+_TAG_PATTERN = re.compile(r'\{\{|\}\}|\{([#^/>]?)(\w+)\}')
+
+_MAX_PARTIAL_DEPTH = 16
+
+
+class TemplateError(ValueError):
+    """Raised when a template cannot be compiled"""
+
+
+class PromptTemplate:
+    """
+    A prompt template compiled into a flat list of static and dynamic segments
+
+    Supported syntax:
+    - {name}            substituted with context[name]
+    - {#name}...{/name} rendered only when context[name] is truthy
+    - {^name}...{/name} rendered only when context[name] is falsy
+    - {>name}           replaced at compile time with the partial 'name'
+    - {{ and }}         literal braces
+    """
+
+    def __init__(self, source: str, partials: Optional[Mapping[str, str]] = None):
+        """Compile the template source, inlining any partials"""
+        self.source = source
+        self.partials: Dict[str, str] = dict(partials or {})
+        self._nodes = self._compile(source, 0)
+        self._encoded_nodes = self._encode(self._nodes)
+        self.fields = frozenset(self._collect_fields(self._nodes))
+        # Text every rendering starts with, regardless of context
+        self.static_prefix = self._nodes[0][1] if self._nodes and self._nodes[0][0] == _STATIC else ''
+
+    def _compile(self, source: str, depth: int) -> List[Tuple]:
+        """Parse source into nested nodes, merging adjacent static text"""
+        if depth > _MAX_PARTIAL_DEPTH:
+            raise TemplateError("Partials nested too deeply (recursive partial?)")
+
+        root: List[Tuple] = []
+        stack: List[Tuple[str, List[Tuple]]] = []
+        nodes = root
+        position = 0
+
+        for match in _TAG_PATTERN.finditer(source):
+            self._append_static(nodes, source[position:match.start()])
+            position = match.end()
+            token = match.group(0)
+            sigil, name = match.group(1), match.group(2)
+
+            if token == '{{':
+                self._append_static(nodes, '{')
+            elif token == '}}':
+                self._append_static(nodes, '}')
+            elif sigil == '':
+                nodes.append((_FIELD, name, None))
+            elif sigil in ('#', '^'):
+                children: List[Tuple] = []
+                nodes.append((_SECTION if sigil == '#' else _INVERTED, name, children))
+                stack.append((name, nodes))
+                nodes = children
+            elif sigil == '/':
+                if not stack or stack[-1][0] != name:
+                    raise TemplateError(f"Unexpected closing tag '{{/{name}}}'")
+                _, nodes = stack.pop()
+            else:
+                if name not in self.partials:
+                    raise TemplateError(f"Partial '{name}' not found")
+                for node in self._compile(self.partials[name], depth + 1):
+                    if node[0] == _STATIC:
+                        self._append_static(nodes, node[1])
+                    else:
+                        nodes.append(node)
+
+        self._append_static(nodes, source[position:])
+        if stack:
+            raise TemplateError(f"Unclosed section '{stack[-1][0]}'")
+        return root
+
+    @staticmethod
+    def _append_static(nodes: List[Tuple], text: str) -> None:
+        """Append static text, merging it into a preceding static segment"""
+        if not text:
+            return
+        if nodes and nodes[-1][0] == _STATIC:
+            nodes[-1] = (_STATIC, nodes[-1][1] + text, None)
+        else:
+            nodes.append((_STATIC, text, None))
+
+    def _encode(self, nodes: List[Tuple]) -> List[Tuple]:
+        """Copy the nodes with static segments pre-encoded as UTF-8"""
+        return [
+            (kind, value.encode('utf-8') if kind == _STATIC else value,
+             self._encode(children) if children else children)
+            for kind, value, children in nodes
+        ]
+
+    def _collect_fields(self, nodes: List[Tuple]) -> List[str]:
+        """List every context name referenced by the nodes"""
+        names = []
+        for kind, value, children in nodes:
+            if kind != _STATIC:
+                names.append(value)
+            if children:
+                names.extend(self._collect_fields(children))
+        return names
+
+    def render(self, context: Mapping[str, str]) -> str:
+        """Render the template by joining static segments and context values"""
+        parts: List[str] = []
+        self._render_into(self._nodes, context, parts)
+        return ''.join(parts)
+
+    def render_bytes(self, context: Mapping[str, str]) -> bytes:
+        """Render the template straight to UTF-8 using pre-encoded static segments"""
+        parts: List[bytes] = []
+        self._render_into(self._encoded_nodes, context, parts, encode=True)
+        return b''.join(parts)
+
+    def _render_into(self, nodes: List[Tuple], context: Mapping[str, str],
+                     parts: List, encode: bool = False) -> None:
+        """Append the rendered pieces of nodes to parts"""
+        append = parts.append
+        for kind, value, children in nodes:
+            if kind == _STATIC:
+                append(value)
+            elif kind == _FIELD:
+                append(context[value].encode('utf-8') if encode else context[value])
+            elif kind == _SECTION:
+                if context.get(value):
+                    self._render_into(children, context, parts, encode)
+            elif not context.get(value):
+                self._render_into(children, context, parts, encode)
+
+    def count_tokens(self, field_counts: Mapping[str, int],
+                     count_static: Callable[[str], int]) -> int:
+        """
+        Sum the token counts of the segments a render would produce
+        field_counts maps each field to the token count of its value; a
+        section is included when its field has a non-zero count.
+        count_static returns the token count of a static segment
+        """
+        return self._count_into(self._nodes, field_counts, count_static)
+
+    def _count_into(self, nodes: List[Tuple], field_counts: Mapping[str, int],
+                    count_static: Callable[[str], int]) -> int:
+        """Return the summed token count of nodes"""
+        total = 0
+        for kind, value, children in nodes:
+            if kind == _STATIC:
+                total += count_static(value)
+            elif kind == _FIELD:
+                total += field_counts[value]
+            elif kind == _SECTION:
+                if field_counts.get(value):
+                    total += self._count_into(children, field_counts, count_static)
+            elif not field_counts.get(value):
+                total += self._count_into(children, field_counts, count_static)
+        return total
+
+    def __repr__(self) -> str:
+        """String representation of the compiled template"""
+        return f"PromptTemplate(fields={sorted(self.fields)})"
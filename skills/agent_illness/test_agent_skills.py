@@ -3,11 +3,30 @@ Unit tests for Agent Skills
 Validates all functionality works correctly
 """
 
+import gc
+import io
+import json
+import os
+import random
 import pytest
-from agent_illness.system_prompt import SystemPromptSkill
-from agent_illness.agent_profiles import AgentProfileManager, AgentProfile
-from agent_illness.characteristics import CharacteristicManager, TalkingStyle
+from agent_illness.system_prompt import SystemPromptSkill, PromptHandle
+from agent_illness.agent_profiles import AgentProfileManager, AgentProfile, CompactAgentProfile
+from agent_illness.characteristics import (
+    CharacteristicManager, CompactTalkingStyle, StyleSpace, TalkingStyle
+)
 from agent_illness.dynamic_agent import DynamicAgent
+from agent_illness.catalog import Interner, LazyCatalog, write_catalog
+from agent_illness.compaction import HistoryCompactor, truncating_summarizer
+from agent_illness.config import AgentConfig
+from agent_illness.exporter import (
+    BinaryPromptWriter, export_prompts, iter_binary_prompts, iter_prompt_handles
+)
+from agent_illness.template import PromptTemplate, TemplateError
+from agent_illness.history import ArenaHistory, ConversationHistory, SpillingHistory
+from agent_illness.router import PersonaRouter
+from agent_illness.store import SqliteCatalog
+from agent_illness.sampling import AliasTable, KeyIndex, ShuffleBag
+from agent_illness.tokenizer import ApproximateTokenizer, EncoderTokenizer
 
 
 class TestAgentProfileManager:
@@ -56,6 +75,61 @@ class TestAgentProfileManager:
         manager.get_random_profile()
         current = manager.get_current_profile()
         assert current is not None
+    
+    def test_find_profiles_by_expertise(self):
+        """Test AND/OR/prefix expertise queries"""
+        manager = AgentProfileManager()
+        assert manager.find_profiles_by_expertise(['Statistics']) == ['analyst']
+        assert manager.find_profiles_by_expertise(['planning', 'strategy']) == ['strategist']
+        assert manager.find_profiles_by_expertise(['planning', 'teaching']) == []
+        assert manager.find_profiles_by_expertise(
+            ['planning', 'teaching'], match='any'
+        ) == ['educator', 'strategist']
+        assert manager.find_profiles_by_expertise(['data'], prefix=True) == ['researcher', 'analyst']
+        assert manager.find_profiles_by_expertise(['innov', 'creat'], prefix=True) == ['innovator']
+        assert manager.find_profiles_by_expertise(['analysis']) == ['researcher', 'analyst']
+        with pytest.raises(ValueError):
+            manager.find_profiles_by_expertise(['data'], match='some')
+    
+    def test_expertise_index_tracks_updates(self):
+        """Test that added and replaced profiles update the index"""
+        manager = AgentProfileManager()
+        manager.find_profiles_by_expertise(['statistics'])
+        manager.add_profile('statistician', AgentProfile(
+            role='Statistician',
+            name='Stat',
+            description='Test Description',
+            expertise_areas=['Statistics', 'Probability']
+        ))
+        assert manager.find_profiles_by_expertise(['statistics']) == ['analyst', 'statistician']
+        
+        manager.add_profile('analyst', AgentProfile(
+            role='Data Analyst',
+            name='Alex Sterling',
+            description='Test Description',
+            expertise_areas=['reporting']
+        ))
+        assert manager.find_profiles_by_expertise(['statistics']) == ['statistician']
+        assert manager.find_profiles_by_expertise(['pattern'], prefix=True) == []
+    
+    def test_profile_key_index(self):
+        """Test that the sampling index tracks added profiles"""
+        manager = AgentProfileManager()
+        assert manager.get_profile_keys() == list(manager.profiles)
+        
+        new_profile = AgentProfile(
+            role='Test Role',
+            name='Test Name',
+            description='Test Description',
+            expertise_areas=['test']
+        )
+        manager.add_profile('test', new_profile)
+        manager.add_profile('test', new_profile)
+        assert manager.get_profile_keys() == list(manager.profiles)
+        
+        seen = {id(manager.get_random_profile()) for _ in range(500)}
+        assert id(new_profile) in seen
+        assert manager.profiles[manager.current_profile_key] is manager.current_profile
 
 
 class TestCharacteristicManager:
@@ -98,6 +172,24 @@ class TestCharacteristicManager:
         assert retrieved is not None
         assert retrieved.tone == 'test tone'
     
+    def test_style_key_index(self):
+        """Test that the sampling index tracks added styles"""
+        manager = CharacteristicManager()
+        new_style = TalkingStyle(
+            name='Test Style',
+            tone='test tone',
+            formality='casual',
+            pace='moderate',
+            verbosity='balanced'
+        )
+        manager.add_style('test', new_style)
+        manager.add_style('friendly', new_style)
+        assert manager.get_style_keys() == list(manager.talking_styles)
+        assert len(manager.get_style_keys()) == 7
+        
+        style = manager.get_random_style()
+        assert manager.talking_styles[manager.current_style_key] is style
+    
     def test_get_style_description(self):
         """Test getting style description"""
         manager = CharacteristicManager()
@@ -107,6 +199,425 @@ class TestCharacteristicManager:
         assert 'Style:' in description
 
 
+class TestFileCatalogs:
+    """Test lazy, file-backed persona catalogs"""
+    
+    def _write_catalogs(self, tmp_path):
+        """Write the built-in catalogs to JSONL files"""
+        profile_path = str(tmp_path / 'profiles.jsonl')
+        style_path = str(tmp_path / 'styles.jsonl')
+        write_catalog(profile_path, AgentProfileManager().profiles)
+        write_catalog(style_path, CharacteristicManager().talking_styles)
+        return profile_path, style_path
+    
+    def test_lookup_materializes_only_used_entries(self, tmp_path):
+        """Test that only looked-up profiles are built"""
+        profile_path, _ = self._write_catalogs(tmp_path)
+        manager = AgentProfileManager.from_catalog(profile_path)
+        assert isinstance(manager.profiles, LazyCatalog)
+        assert len(manager.get_profile_keys()) == 6
+        assert manager.profiles.materialized_count() == 0
+        
+        profile = manager.get_profile_by_role('educator')
+        assert profile == AgentProfileManager().get_profile_by_role('educator')
+        assert manager.get_profile_by_role('missing') is None
+        assert manager.profiles.materialized_count() == 1
+    
+    def test_catalog_backed_prompts(self, tmp_path):
+        """Test that prompts from file catalogs match the built-in ones"""
+        profile_path, style_path = self._write_catalogs(tmp_path)
+        skill = SystemPromptSkill(
+            profile_manager=AgentProfileManager.from_catalog(profile_path),
+            characteristic_manager=CharacteristicManager.from_catalog(style_path)
+        )
+        expected = SystemPromptSkill().generate_system_prompt_custom('mentor', 'nurturing')
+        assert skill.generate_system_prompt_custom('mentor', 'nurturing') == expected
+        assert skill.generate_system_prompt().startswith('You are')
+    
+    def test_add_to_file_catalog(self, tmp_path):
+        """Test adding and replacing entries over a file catalog"""
+        _, style_path = self._write_catalogs(tmp_path)
+        manager = CharacteristicManager.from_catalog(style_path)
+        new_style = TalkingStyle(
+            name='Test Style',
+            tone='test tone',
+            formality='casual',
+            pace='moderate',
+            verbosity='balanced'
+        )
+        manager.add_style('test', new_style)
+        manager.add_style('friendly', new_style)
+        assert manager.get_style_by_name('friendly') is new_style
+        assert len(manager.get_all_styles()) == 7
+        assert manager.get_style_keys()[-1] == 'test'
+    
+    def test_json_catalog(self, tmp_path):
+        """Test loading a JSON catalog keyed by entry key"""
+        path = tmp_path / 'profiles.json'
+        path.write_text(json.dumps({
+            'tester': {
+                'role': 'Tester',
+                'name': 'Tess',
+                'description': 'Finds bugs',
+                'expertise_areas': ['testing']
+            }
+        }))
+        manager = AgentProfileManager.from_catalog(str(path))
+        assert manager.get_random_profile().name == 'Tess'
+    
+    def test_unordered_jsonl_records(self, tmp_path):
+        """Test indexing JSONL records whose key is not the first field"""
+        path = tmp_path / 'profiles.jsonl'
+        path.write_text(
+            '{"role": "Tester", "name": "Tess", "description": "d", "key": "tester"}\n\n'
+        )
+        catalog = LazyCatalog(str(path), lambda record: record['name'])
+        assert list(catalog) == ['tester']
+        assert catalog['tester'] == 'Tess'
+        catalog.close()
+
+
+class TestCompactEntries:
+    """Test the interned, immutable profile and style variants"""
+    
+    def test_compact_style_round_trip(self):
+        """Test that compact styles read like and convert back to TalkingStyle"""
+        style = CharacteristicManager().get_style_by_name('professional')
+        compact = CompactTalkingStyle.from_style(style)
+        assert compact.formality == 'formal'
+        assert compact.pace == 'moderate'
+        assert compact.verbosity == 'balanced'
+        assert compact.communication_patterns == style.communication_patterns
+        assert compact.to_style() == style
+        assert not hasattr(compact, '__dict__')
+        with pytest.raises(AttributeError):
+            compact.tone = 'changed'
+    
+    def test_compact_entries_share_storage(self):
+        """Test that repeated values are stored once per catalog"""
+        manager = CharacteristicManager()
+        interner = Interner()
+        friendly = CompactTalkingStyle.from_style(manager.get_style_by_name('friendly'), interner)
+        professional = CompactTalkingStyle.from_style(manager.get_style_by_name('professional'), interner)
+        assert friendly.pace is professional.pace
+        copy = CompactTalkingStyle.from_style(manager.get_style_by_name('friendly'), interner)
+        assert all(a is b for a, b in zip(copy.personality_traits, friendly.personality_traits))
+        size = len(interner)
+        CompactTalkingStyle.from_style(manager.get_style_by_name('friendly'))
+        assert len(interner) == size
+        
+        profile = AgentProfileManager().get_profile_by_role('researcher')
+        first = CompactAgentProfile.from_profile(profile, interner)
+        second = CompactAgentProfile.from_profile(profile, interner)
+        assert all(a is b for a, b in zip(first.expertise_areas, second.expertise_areas))
+        assert first.to_profile() == profile
+    
+    def test_compact_prompts_match(self):
+        """Test that compact entries render the same prompts"""
+        skill = SystemPromptSkill()
+        expected = skill.generate_system_prompt_custom('mentor', 'friendly')
+        
+        compact_skill = SystemPromptSkill()
+        profiles = compact_skill.profile_manager
+        styles = compact_skill.characteristic_manager
+        profiles.add_profile('mentor', CompactAgentProfile.from_profile(profiles.profiles['mentor']))
+        styles.add_style('friendly', CompactTalkingStyle.from_style(styles.talking_styles['friendly']))
+        assert compact_skill.generate_system_prompt_custom('mentor', 'friendly') == expected
+    
+    def test_compact_catalogs(self, tmp_path):
+        """Test loading catalogs as compact entries and writing them back"""
+        path = str(tmp_path / 'styles.jsonl')
+        write_catalog(path, CharacteristicManager().talking_styles)
+        manager = CharacteristicManager.from_catalog(path, compact=True)
+        style = manager.get_style_by_name('analytical')
+        assert isinstance(style, CompactTalkingStyle)
+        assert style.pace is manager.get_style_by_name('professional').pace
+        assert style.pace is not CharacteristicManager.from_catalog(path, compact=True) \
+            .get_style_by_name('professional').pace
+        
+        copy_path = str(tmp_path / 'copy.jsonl')
+        write_catalog(copy_path, {'analytical': style})
+        copy = CharacteristicManager.from_catalog(copy_path)
+        assert copy.get_style_by_name('analytical') == CharacteristicManager().get_style_by_name('analytical')
+        
+        profile_path = str(tmp_path / 'profiles.jsonl')
+        write_catalog(profile_path, AgentProfileManager().profiles)
+        profiles = AgentProfileManager.from_catalog(profile_path, compact=True)
+        assert isinstance(profiles.get_profile_by_role('analyst'), CompactAgentProfile)
+        assert profiles.find_profiles_by_expertise(['statistics']) == ['analyst']
+
+
+class TestStyleSpace:
+    """Test the virtual combinatorial style space"""
+    
+    def test_index_addresses_every_combination(self):
+        """Test that every index decodes to a distinct style"""
+        space = StyleSpace(['formal', 'casual'], ['fast', 'slow'], ['concise'],
+                           ['calm', 'bright'], ['a', 'b', 'c', 'd'], traits_per_style=2)
+        assert len(space) == 2 * 2 * 1 * 2 * 6
+        styles = [space[index] for index in range(len(space))]
+        combinations = {
+            (style.formality, style.pace, style.verbosity, style.tone,
+             tuple(style.personality_traits))
+            for style in styles
+        }
+        assert len(combinations) == len(space)
+        assert space[0].personality_traits == ['a', 'b']
+        assert space[-1].personality_traits == ['c', 'd']
+        assert space[-1].formality == 'casual'
+        with pytest.raises(IndexError):
+            space[len(space)]
+    
+    def test_manager_space_sampling(self):
+        """Test drawing space styles through the manager"""
+        manager = CharacteristicManager()
+        space = manager.get_style_space()
+        assert len(space) > 100000
+        size = len(manager.get_style_keys())
+        
+        style = manager.get_random_space_style(random.Random(3))
+        assert manager.current_style_key.startswith('space_')
+        assert manager.get_style_by_name(manager.current_style_key) == style
+        assert style.formality in space.axes[0]
+        
+        skill = SystemPromptSkill(characteristic_manager=manager)
+        prompt = skill.generate_system_prompt_custom('researcher', manager.current_style_key)
+        assert style.tone in prompt
+        assert skill.count_prompt_tokens() > 0
+        
+        rng = random.Random(4)
+        for _ in range(500):
+            manager.get_random_space_style(rng)
+        assert len(manager.get_style_keys()) == size
+        assert len(manager.talking_styles) == size
+        assert all(manager.get_random_style(rng).name != style.name for _ in range(50))
+        assert skill._prompt_cache.get('researcher', {}) == {}
+        assert manager.get_style_by_name(f'space_{len(space)}') is None
+
+    def test_space_keys_resolve_in_fresh_managers(self):
+        """Test that a space key resolves in a manager that has not built the space yet"""
+        key = CharacteristicManager().sample_space_style_key(random.Random(5))
+        fresh = CharacteristicManager()
+        assert fresh.style_space is None
+        style = fresh.get_style_by_name(key)
+        assert style == CharacteristicManager().get_style_space()[int(key[len('space_'):])]
+        assert fresh.current_style_key is None
+
+    def test_agent_space_style_persona(self):
+        """Test that an agent can take a drawn space style as its persona"""
+        agent = DynamicAgent(seed=11)
+        prompt = agent.initialize_persona_with_space_style('educator')
+        skill = agent.system_prompt_skill
+        assert skill.current_style_key.startswith('space_')
+        assert skill.characteristic_manager.current_style_key is None
+        assert agent.get_current_persona()['tone'] == skill.current_style.tone
+        assert skill.current_style.tone in prompt
+        assert not skill.characteristic_manager.is_catalog_style(skill.current_style_key)
+        assert skill._prompt_cache.get('educator', {}) == {}
+
+
+class TestStyleFilters:
+    """Test the bitmap attribute index"""
+    
+    def test_filter_by_attributes(self):
+        """Test AND across attributes and OR within one attribute"""
+        manager = CharacteristicManager()
+        assert manager.filter_styles(formality='casual', pace='slow') == ['nurturing']
+        assert manager.filter_styles(formality=['formal', 'professional'], verbosity='concise') == ['concise']
+        assert manager.filter_styles(traits=['precise']) == ['professional', 'concise']
+        assert manager.filter_styles(any_traits=['caring', 'optimistic']) == ['enthusiastic', 'nurturing']
+        assert manager.filter_styles(formality='unknown') == []
+        assert manager.filter_styles() == manager.get_style_keys()
+    
+    def test_filters_follow_catalog_changes(self):
+        """Test that added and replaced styles are reindexed"""
+        manager = CharacteristicManager()
+        assert manager.filter_styles(traits=['curious']) == []
+        manager.add_style('explorer', TalkingStyle(
+            name='Explorer',
+            tone='curious',
+            formality='casual',
+            pace='fast',
+            verbosity='concise',
+            personality_traits=['curious']
+        ))
+        assert manager.filter_styles(traits=['curious']) == ['explorer']
+        manager.add_style('explorer', TalkingStyle(
+            name='Explorer',
+            tone='curious',
+            formality='formal',
+            pace='fast',
+            verbosity='concise',
+            personality_traits=['bold']
+        ))
+        assert manager.filter_styles(traits=['curious']) == []
+        assert manager.filter_styles(formality='casual', pace='fast') == ['enthusiastic']
+        assert manager.find_styles(formality='formal', pace='fast') == ['explorer']
+
+
+class TestSqliteStore:
+    """Test SQLite-backed profile and style stores"""
+    
+    def test_profile_store(self, tmp_path):
+        """Test indexed profile lookups through a SQLite store"""
+        path = str(tmp_path / 'personas.db')
+        manager = AgentProfileManager.from_sqlite(path, cache_size=2)
+        manager.profiles.add_many(AgentProfileManager().profiles)
+        
+        manager = AgentProfileManager.from_sqlite(path, cache_size=2)
+        assert manager.get_profile_keys() == list(AgentProfileManager().profiles)
+        assert manager.get_profile_by_role('analyst').name == 'Alex Sterling'
+        assert manager.get_profile_by_role('missing') is None
+        assert manager.find_profiles_by_expertise(['statistics']) == ['analyst']
+        assert manager.find_profiles_by_expertise(['car'], prefix=True) == ['mentor']
+        
+        for key in ('researcher', 'educator', 'mentor'):
+            manager.get_profile_by_role(key)
+        assert manager.profiles.cached_count() == 2
+    
+    def test_profile_store_updates(self, tmp_path):
+        """Test that added and replaced profiles are visible to other connections"""
+        path = str(tmp_path / 'personas.db')
+        manager = AgentProfileManager.from_sqlite(path)
+        manager.add_profile('chef', AgentProfile(
+            role='Chef',
+            name='Chef Remy',
+            description='A chef',
+            expertise_areas=['cooking']
+        ))
+        manager.add_profile('chef', AgentProfile(
+            role='Chef',
+            name='Chef Remy',
+            description='A chef',
+            expertise_areas=['baking']
+        ))
+        assert manager.find_profiles_by_expertise(['cooking']) == []
+        
+        other = AgentProfileManager.from_sqlite(path, compact=True)
+        assert isinstance(other.get_profile_by_role('chef'), CompactAgentProfile)
+        assert other.find_profiles_by_expertise(['baking']) == ['chef']
+        del other.profiles['chef']
+        assert len(other.profiles) == 0
+
+    def test_managers_share_store(self, tmp_path):
+        """Test that entries added through one manager are found and sampled by another"""
+        path = str(tmp_path / 'personas.db')
+        first = AgentProfileManager.from_sqlite(path)
+        first.profiles.add_many(AgentProfileManager().profiles)
+        second = AgentProfileManager.from_sqlite(path)
+        router = PersonaRouter(second)
+        first.add_profile('statistician', AgentProfile(
+            role='Statistician',
+            name='Sam Fisher',
+            description='Designs surveys and sampling plans',
+            expertise_areas=['statistics', 'survey design']
+        ))
+        assert second.find_profiles_by_expertise(['statistics']) == ['analyst', 'statistician']
+        assert second.get_profile_keys()[-1] == 'statistician'
+        assert router.route('survey design') == 'statistician'
+        second.set_profile_weight('statistician', 1.0)
+
+        styles_path = str(tmp_path / 'styles.db')
+        first_styles = CharacteristicManager.from_sqlite(styles_path)
+        first_styles.talking_styles.add_many(CharacteristicManager().talking_styles)
+        second_styles = CharacteristicManager.from_sqlite(styles_path)
+        second_styles.filter_styles(formality='casual')
+        first_styles.add_style('laconic', CharacteristicManager().get_style_by_name('concise'))
+        assert 'laconic' in second_styles.filter_styles(formality='professional')
+        assert second_styles.get_style_keys()[-1] == 'laconic'
+
+    def test_style_attribute_queries(self, tmp_path):
+        """Test attribute filters on SQLite-backed and in-memory styles"""
+        path = str(tmp_path / 'personas.db')
+        store = SqliteCatalog(path, 'styles', lambda record: record,
+                              columns=('formality', 'pace', 'verbosity'))
+        store.add_many(CharacteristicManager().talking_styles)
+        
+        stored = CharacteristicManager.from_sqlite(path)
+        in_memory = CharacteristicManager()
+        for filters in ({'formality': 'casual'}, {'pace': 'moderate', 'verbosity': 'balanced'}, {}):
+            assert stored.find_styles(**filters) == in_memory.find_styles(**filters)
+        assert stored.find_styles(formality='casual', pace='slow') == ['nurturing']
+        assert stored.get_style_by_name('friendly') == in_memory.get_style_by_name('friendly')
+        with pytest.raises(ValueError):
+            store.query(tone='warm')
+
+
+class TestWeightedSampling:
+    """Test alias-table weighted sampling"""
+    
+    def test_alias_table_distribution(self):
+        """Test that draws follow the weights"""
+        table = AliasTable([1, 0, 3])
+        rng = random.Random(5)
+        draws = table.draw_many(8000, rng)
+        assert draws.count(1) == 0
+        assert 0.70 < draws.count(2) / len(draws) < 0.80
+        assert table.draw(rng) in (0, 2)
+    
+    def test_alias_table_rejects_bad_weights(self):
+        """Test rejecting empty, zero-sum and negative weights"""
+        for weights in ([], [0, 0], [1, -1]):
+            with pytest.raises(ValueError):
+                AliasTable(weights)
+    
+    def test_key_index(self):
+        """Test the shared key index: appends, weights, errors and listeners"""
+        catalog = {'a': 1, 'b': 2}
+        added = []
+        index = KeyIndex(catalog, 'Entry')
+        index.listeners.add(added.append)
+        assert index.add('c') and not index.add('a')
+        assert index.keys == ['a', 'b', 'c'] and index.positions['c'] == 2
+        index.set_weight('b', 0)
+        index.set_weight('c', 0)
+        assert set(index.sample_indices(50, random.Random(2))) == {0}
+        assert index.sample_key() == 'a'
+        with pytest.raises(ValueError, match="Entry 'missing' not found"):
+            index.get_weight('missing')
+        assert added == []
+    
+    def test_weighted_profiles(self):
+        """Test that profile weights bias random selection"""
+        manager = AgentProfileManager()
+        for key in manager.get_profile_keys():
+            manager.set_profile_weight(key, 0)
+        manager.set_profile_weight('mentor', 5)
+        assert manager.is_weighted()
+        assert manager.get_profile_weight('mentor') == 5.0
+        
+        rng = random.Random(1)
+        assert {manager.get_random_profile(rng).name for _ in range(50)} == {'Coach Jordan'}
+        keys = manager.get_profile_keys()
+        assert {keys[i] for i in manager.sample_profile_indices(100, rng)} == {'mentor'}
+    
+    def test_weights_rebuild_after_add(self):
+        """Test that new entries join the weighted table with weight 1"""
+        manager = CharacteristicManager()
+        for key in manager.get_style_keys():
+            manager.set_style_weight(key, 0)
+        manager.add_style('test', TalkingStyle(
+            name='Test Style',
+            tone='test tone',
+            formality='casual',
+            pace='moderate',
+            verbosity='balanced'
+        ))
+        assert manager.get_random_style().name == 'Test Style'
+        with pytest.raises(ValueError):
+            manager.set_style_weight('missing', 1)
+    
+    def test_weighted_batch(self):
+        """Test that batch generation honors weights"""
+        skill = SystemPromptSkill()
+        for key in skill.profile_manager.get_profile_keys():
+            skill.profile_manager.set_profile_weight(key, 0)
+        skill.profile_manager.set_profile_weight('educator', 1)
+        handles = skill.generate_system_prompts_batch(200, seed=9, as_handles=True)
+        assert {handle.profile_key for handle in handles} == {'educator'}
+        assert handles == skill.generate_system_prompts_batch(200, seed=9, as_handles=True)
+
+
 class TestSystemPromptSkill:
     """Test SystemPromptSkill functionality"""
     
@@ -161,6 +672,266 @@ class TestSystemPromptSkill:
         assert len(styles) > 0
 
 
+class TestPromptCache:
+    """Test SystemPromptSkill prompt caching"""
+    
+    def test_cached_prompt_is_reused(self):
+        """Test that the same profile/style pair is rendered only once"""
+        skill = SystemPromptSkill()
+        prompt1 = skill.generate_system_prompt_custom('educator', 'friendly')
+        prompt2 = skill.generate_system_prompt_custom('educator', 'friendly')
+        assert prompt1 is prompt2
+        assert skill._prompt_cache['educator']['friendly'] is prompt1
+    
+    def test_cached_prompt_matches_format(self):
+        """Test that cached prompts match a fresh render"""
+        skill = SystemPromptSkill()
+        prompt = skill.generate_system_prompt()
+        assert prompt == skill._format_prompt(skill.current_profile, skill.current_style)
+    
+    def test_add_profile_invalidates_row_only(self):
+        """Test that replacing a profile drops only that profile's entries"""
+        skill = SystemPromptSkill()
+        skill.generate_system_prompt_custom('educator', 'friendly')
+        skill.generate_system_prompt_custom('mentor', 'friendly')
+        
+        skill.profile_manager.add_profile('educator', AgentProfile(
+            role='Educator',
+            name='Professor Ada',
+            description='Test Description',
+            expertise_areas=['teaching']
+        ))
+        assert 'educator' not in skill._prompt_cache
+        assert 'friendly' in skill._prompt_cache['mentor']
+        assert 'Professor Ada' in skill.generate_system_prompt_custom('educator', 'friendly')
+    
+    def test_add_style_invalidates_column_only(self):
+        """Test that replacing a style drops only that style's entries"""
+        skill = SystemPromptSkill()
+        skill.generate_system_prompt_custom('educator', 'friendly')
+        skill.generate_system_prompt_custom('educator', 'concise')
+        
+        skill.characteristic_manager.add_style('friendly', TalkingStyle(
+            name='Friendly',
+            tone='test tone',
+            formality='casual',
+            pace='moderate',
+            verbosity='balanced'
+        ))
+        assert 'friendly' not in skill._prompt_cache['educator']
+        assert 'concise' in skill._prompt_cache['educator']
+        assert 'test tone' in skill.generate_system_prompt_custom('educator', 'friendly')
+
+
+class TestBatchGeneration:
+    """Test batch prompt generation"""
+    
+    def test_batch_prompts(self):
+        """Test generating a batch of rendered prompts"""
+        skill = SystemPromptSkill()
+        prompts = skill.generate_system_prompts_batch(50, seed=7)
+        assert len(prompts) == 50
+        assert all(prompt.startswith('You are') for prompt in prompts)
+        assert skill._prompt_cache == {}
+    
+    def test_batch_is_reproducible(self):
+        """Test that the same seed yields the same batch"""
+        skill = SystemPromptSkill()
+        handles1 = skill.generate_system_prompts_batch(100, seed=42, as_handles=True)
+        handles2 = skill.generate_system_prompts_batch(100, seed=42, as_handles=True)
+        assert handles1 == handles2
+        assert all(isinstance(handle, PromptHandle) for handle in handles1)
+    
+    def test_handles_render_like_batch(self):
+        """Test that handles render to the same prompts as a rendered batch"""
+        skill = SystemPromptSkill()
+        handles = skill.generate_system_prompts_batch(20, seed=3, as_handles=True)
+        prompts = skill.generate_system_prompts_batch(20, seed=3)
+        assert [skill.render_handle(handle) for handle in handles] == prompts
+        
+        handle = handles[0]
+        expected = SystemPromptSkill().generate_system_prompt_custom(
+            handle.profile_key, handle.style_key
+        )
+        assert prompts[0] == expected
+    
+    def test_batch_leaves_current_persona(self):
+        """Test that batch generation does not change the current persona"""
+        skill = SystemPromptSkill()
+        skill.generate_system_prompt_custom('educator', 'friendly')
+        skill.generate_system_prompts_batch(30, seed=1)
+        persona = skill.get_current_persona()
+        assert persona['role'] == 'Educator'
+        assert skill.current_style_key == 'friendly'
+    
+    def test_render_missing_handle(self):
+        """Test rendering a handle for an unknown profile"""
+        skill = SystemPromptSkill()
+        with pytest.raises(ValueError):
+            skill.render_handle(PromptHandle('missing', 'friendly'))
+
+
+class TestPromptLayouts:
+    """Test the prefix-cache-friendly prompt layout"""
+    
+    def test_prefix_cache_layout_shares_prefix(self):
+        """Test that every persona starts with the same shared prefix"""
+        skill = SystemPromptSkill(layout='prefix_cache')
+        prefix = skill.get_shared_prefix()
+        assert prefix.startswith('## Behavioral Guidelines')
+        assert '## Core Instructions' in prefix
+        
+        for profile_key, style_key in [('educator', 'friendly'), ('analyst', 'concise')]:
+            prompt = skill.generate_system_prompt_custom(profile_key, style_key)
+            assert prompt.startswith(prefix)
+            assert skill.profile_manager.get_profile_by_role(profile_key).name not in prefix
+    
+    def test_prefix_hash_is_stable(self):
+        """Test that the prefix hash only depends on the layout"""
+        skill1 = SystemPromptSkill(layout='prefix_cache')
+        skill2 = SystemPromptSkill(layout='prefix_cache')
+        skill2.generate_system_prompt()
+        assert skill1.get_prefix_hash() == skill2.get_prefix_hash()
+        assert skill1.get_prefix_hash() != SystemPromptSkill().get_prefix_hash()
+    
+    def test_layouts_carry_same_persona(self):
+        """Test that both layouts describe the same persona"""
+        standard = SystemPromptSkill().generate_system_prompt_custom('mentor', 'nurturing')
+        prefixed = SystemPromptSkill(layout='prefix_cache').generate_system_prompt_custom(
+            'mentor', 'nurturing'
+        )
+        assert standard.startswith('You are Coach Jordan')
+        assert 'You are Coach Jordan' in prefixed
+        assert '- Greeting: warm and welcoming' in prefixed
+    
+    def test_set_layout_clears_cache(self):
+        """Test that switching layout re-renders prompts"""
+        skill = SystemPromptSkill()
+        skill.generate_system_prompt_custom('mentor', 'nurturing')
+        skill.set_layout('prefix_cache')
+        assert skill._prompt_cache == {}
+        assert skill.generate_system_prompt_custom('mentor', 'nurturing').startswith('## Behavioral')
+    
+    def test_unknown_layout(self):
+        """Test rejecting unknown layouts"""
+        with pytest.raises(ValueError):
+            SystemPromptSkill(layout='sideways')
+    
+    def test_agent_reports_prefix_hash(self):
+        """Test that agents expose the prefix hash of their layout"""
+        agent = DynamicAgent(layout='prefix_cache')
+        agent.initialize_persona()
+        info = agent.get_agent_info()
+        assert info['prompt_prefix_hash'] == agent.system_prompt_skill.get_prefix_hash()
+        assert agent.get_system_prompt().startswith('## Behavioral Guidelines')
+
+
+class TestPromptExporter:
+    """Test streaming prompt export"""
+    
+    def test_export_jsonl(self):
+        """Test exporting the full cross product as JSONL"""
+        skill = SystemPromptSkill()
+        sink = io.BytesIO()
+        count = export_prompts(skill, sink, fmt='jsonl')
+        assert count == 36
+        
+        lines = sink.getvalue().decode('utf-8').splitlines()
+        assert len(lines) == 36
+        record = json.loads(lines[0])
+        assert record['prompt'] == skill.generate_system_prompt_custom(
+            record['profile'], record['style']
+        )
+    
+    def test_export_binary_round_trip(self):
+        """Test that binary exports read back to the same prompts"""
+        skill = SystemPromptSkill()
+        sink = io.BytesIO()
+        handles = list(iter_prompt_handles(skill, ['educator', 'mentor'], ['friendly']))
+        assert export_prompts(skill, sink, fmt='binary', handles=handles) == 2
+        
+        sink.seek(0)
+        records = list(iter_binary_prompts(sink))
+        assert [handle for handle, _ in records] == handles
+        assert records[1][1] == skill.generate_system_prompt_custom('mentor', 'friendly')
+    
+    def test_export_bypasses_prompt_cache(self):
+        """Test that exporting does not fill the prompt cache"""
+        skill = SystemPromptSkill()
+        export_prompts(skill, io.BytesIO(), fmt='binary')
+        assert skill._prompt_cache == {}
+    
+    def test_writer_flushes_in_bulk(self):
+        """Test that records are buffered until the buffer size is reached"""
+        skill = SystemPromptSkill()
+        sink = io.BytesIO()
+        writer = BinaryPromptWriter(sink, buffer_size=1 << 20)
+        for handle in iter_prompt_handles(skill, ['educator'], ['friendly', 'concise']):
+            writer.write(handle, skill.render_handle(handle))
+        assert sink.getvalue() == b''
+        writer.flush()
+        assert len(list(iter_binary_prompts(io.BytesIO(sink.getvalue())))) == 2
+    
+    def test_unknown_format(self):
+        """Test rejecting unknown export formats"""
+        with pytest.raises(ValueError):
+            export_prompts(SystemPromptSkill(), io.BytesIO(), fmt='xml')
+
+
+class TestPromptTemplate:
+    """Test PromptTemplate compilation and rendering"""
+    
+    def test_render_fields(self):
+        """Test substituting fields"""
+        template = PromptTemplate("Hello {name}, you are {role}.")
+        assert template.render({'name': 'Ada', 'role': 'a tester'}) == "Hello Ada, you are a tester."
+        assert template.fields == {'name', 'role'}
+    
+    def test_conditional_sections(self):
+        """Test that sections render only for truthy values"""
+        template = PromptTemplate("A{#extra}[{extra}]{/extra}{^extra}-{/extra}B")
+        assert template.render({'extra': 'x'}) == "A[x]B"
+        assert template.render({'extra': ''}) == "A-B"
+    
+    def test_partials_and_escapes(self):
+        """Test inlining partials and literal braces"""
+        template = PromptTemplate("{{{>greeting}}}", partials={'greeting': "hi {name}"})
+        assert template.render({'name': 'Bo'}) == "{hi Bo}"
+    
+    def test_render_bytes(self):
+        """Test rendering straight to UTF-8"""
+        template = PromptTemplate("名字: {name}")
+        assert template.render_bytes({'name': 'Ada'}) == "名字: Ada".encode('utf-8')
+    
+    def test_invalid_templates(self):
+        """Test that malformed templates are rejected"""
+        with pytest.raises(TemplateError):
+            PromptTemplate("{#open}never closed")
+        with pytest.raises(TemplateError):
+            PromptTemplate("{/stray}")
+        with pytest.raises(TemplateError):
+            PromptTemplate("{>missing}")
+        with pytest.raises(TemplateError):
+            PromptTemplate("{>loop}", partials={'loop': "{>loop}"})
+    
+    def test_empty_patterns_section_dropped(self):
+        """Test that styles without communication patterns omit the section"""
+        skill = SystemPromptSkill()
+        skill.characteristic_manager.add_style('plain', TalkingStyle(
+            name='Plain',
+            tone='plain',
+            formality='casual',
+            pace='moderate',
+            verbosity='balanced'
+        ))
+        prompt = skill.generate_system_prompt_custom('educator', 'plain')
+        assert '## Communication Patterns' not in prompt
+        assert '## Behavioral Guidelines' in prompt
+        
+        prompt = skill.generate_system_prompt_custom('educator', 'friendly')
+        assert '## Communication Patterns' in prompt
+
+
 class TestDynamicAgent:
     """Test DynamicAgent functionality"""
     
@@ -230,6 +1001,8 @@ class TestDynamicAgent:
         assert len(history) == 2
         assert history[0]['role'] == 'user'
         assert history[1]['role'] == 'assistant'
+        assert isinstance(history, list)
+        assert json.loads(json.dumps(history + [{'role': 'user', 'content': 'Thanks'}]))[2]['content'] == 'Thanks'
     
     def test_clear_history(self):
         """Test clearing conversation history"""
@@ -282,6 +1055,776 @@ class TestDynamicAgent:
         assert prompt1 == prompt2
 
 
+class TestTokenAccounting:
+    """Test tokenizers and cached prompt token counts"""
+    
+    def test_approximate_tokenizer(self):
+        """Test the offline token approximation"""
+        tokenizer = ApproximateTokenizer()
+        assert tokenizer.count('') == 0
+        assert tokenizer.count('Hello, world!') == 6
+        assert tokenizer.count('你好') == 2
+    
+    def test_prompt_tokens_match_rendered_prompt(self):
+        """Test that summed section/field counts equal counting the whole prompt"""
+        for layout in SystemPromptSkill.LAYOUTS:
+            skill = SystemPromptSkill(layout=layout)
+            for profile_key, style_key in [('educator', 'friendly'), ('analyst', 'concise')]:
+                prompt = skill.generate_system_prompt_custom(profile_key, style_key)
+                assert skill.count_prompt_tokens() == skill.count_tokens(prompt)
+    
+    def test_counts_are_cached_per_field(self):
+        """Test that field counts are cached and invalidated with the profile"""
+        skill = SystemPromptSkill()
+        before = skill.count_prompt_tokens('educator', 'friendly')
+        assert 'educator' in skill._profile_token_counts
+        assert 'friendly' in skill._style_token_counts
+        
+        skill.profile_manager.add_profile('educator', AgentProfile(
+            role='Educator',
+            name='Professor Marcus Aurelius Antoninus',
+            description='A patient educator who excels at explaining complex concepts clearly',
+            expertise_areas=['teaching', 'explanation', 'learning guidance', 'simplification']
+        ))
+        assert 'educator' not in skill._profile_token_counts
+        assert skill.count_prompt_tokens('educator', 'friendly') > before
+    
+    def test_pluggable_tokenizer(self):
+        """Test plugging in an encoder-based tokenizer"""
+        skill = SystemPromptSkill(tokenizer=EncoderTokenizer(list))
+        prompt = skill.generate_system_prompt_custom('mentor', 'nurturing')
+        assert skill.count_prompt_tokens() == len(prompt)
+    
+    def test_agent_info_reports_tokens(self):
+        """Test that agent info includes prompt and history token counts"""
+        agent = DynamicAgent()
+        assert agent.get_agent_info()['prompt_tokens'] == 0
+        
+        prompt = agent.initialize_persona_custom('mentor', 'nurturing')
+        agent.add_to_history('user', 'How can I improve?')
+        info = agent.get_agent_info()
+        tokenizer = ApproximateTokenizer()
+        assert info['prompt_tokens'] == tokenizer.count(prompt)
+        assert info['history_tokens'] == tokenizer.count('How can I improve?')
+
+
+class TestPromptTiers:
+    """Test token-budgeted prompt tiers"""
+    
+    def test_tiers_shrink(self):
+        """Test that each tier is smaller than the previous one"""
+        skill = SystemPromptSkill()
+        counts = [skill.count_prompt_tokens('analyst', 'analytical', tier) for tier in skill.TIERS]
+        assert counts == sorted(counts, reverse=True)
+        assert len(set(counts)) == len(counts)
+        
+        for tier in skill.TIERS:
+            prompt = skill.get_prompt_tier('analyst', 'analytical', tier)
+            assert 'Alex Sterling' in prompt
+            assert skill.count_prompt_tokens('analyst', 'analytical', tier) == skill.count_tokens(prompt)
+    
+    def test_select_richest_fitting_tier(self):
+        """Test picking the richest tier within a budget"""
+        skill = SystemPromptSkill()
+        full = skill.count_prompt_tokens('analyst', 'analytical', 'full')
+        compact = skill.count_prompt_tokens('analyst', 'analytical', 'compact')
+        minimal = skill.count_prompt_tokens('analyst', 'analytical', 'minimal')
+        assert skill.select_prompt_tier('analyst', 'analytical', full) == 'full'
+        assert skill.select_prompt_tier('analyst', 'analytical', full - 1) == 'compact'
+        assert skill.select_prompt_tier('analyst', 'analytical', compact - 1) == 'minimal'
+        with pytest.raises(ValueError):
+            skill.select_prompt_tier('analyst', 'analytical', minimal - 1)
+    
+    def test_generate_for_budget(self):
+        """Test generating a prompt under a budget"""
+        skill = SystemPromptSkill()
+        prompt = skill.generate_system_prompt_for_budget(150, 'mentor', 'nurturing')
+        assert prompt == skill.get_prompt_tier('mentor', 'nurturing', 'compact')
+        assert skill.get_current_persona()['agent_name'] == 'Coach Jordan'
+    
+    def test_precompute_tiers(self):
+        """Test precomputing every tier for the catalog"""
+        skill = SystemPromptSkill()
+        assert skill.precompute_tiers() == 6 * 6 * len(skill.TIERS)
+        for tier in skill.TIERS:
+            assert len(skill._tier_prompt_caches[tier]['educator']) == 6
+    
+    def test_agent_budget_persona(self):
+        """Test initializing an agent within a token budget"""
+        agent = DynamicAgent()
+        prompt = agent.initialize_persona_for_budget(30, 'educator', 'friendly')
+        assert prompt.startswith('You are Professor Marcus')
+        assert agent.get_prompt_token_count() <= 30
+
+
+class TestSharedManagers:
+    """Test many agents over one profile and style catalog"""
+
+    def test_agents_do_not_pin_listeners(self):
+        """Test that dropped or closed agents stop listening to shared managers"""
+        profiles = AgentProfileManager()
+        styles = CharacteristicManager()
+        for _ in range(100):
+            agent = DynamicAgent(profile_manager=profiles, characteristic_manager=styles)
+            agent.initialize_persona()
+        del agent
+        gc.collect()
+        assert len(profiles._keys.listeners) == 0
+        assert len(styles._keys.listeners) == 0
+
+        with DynamicAgent(profile_manager=profiles, characteristic_manager=styles) as agent:
+            agent.adapt_persona('statistics')
+            assert len(profiles._keys.listeners) == 2
+        assert len(profiles._keys.listeners) == 0
+        listener = []
+        profiles.add_listener(listener.append)
+        profiles.add_profile('chef', AgentProfile(role='Chef', name='Remy', description='A chef', expertise_areas=['cooking']))
+        assert listener == ['chef']
+        profiles.remove_listener(listener.append)
+        with pytest.raises(ValueError):
+            profiles.remove_listener(listener.append)
+
+    def test_agents_keep_separate_personas(self):
+        """Test that agents sharing managers do not overwrite each other's persona"""
+        profiles = AgentProfileManager()
+        styles = CharacteristicManager()
+        first = DynamicAgent(profile_manager=profiles, characteristic_manager=styles)
+        second = DynamicAgent(profile_manager=profiles, characteristic_manager=styles)
+        first.initialize_persona_custom('researcher', 'professional')
+        second.initialize_persona_custom('educator', 'friendly')
+        assert first.get_current_persona()['role'] == 'Research Expert'
+        assert first.system_prompt_skill.current_style_key == 'professional'
+        assert first.get_prompt_token_count() != second.get_prompt_token_count()
+        assert profiles.current_profile_key is None
+        assert styles.current_style_key is None
+
+
+class TestSeededAgents:
+    """Test per-agent random streams and shuffle-bag scheduling"""
+    
+    def test_shuffle_bag_cycles(self):
+        """Test that a bag yields every index once per cycle without back-to-back repeats"""
+        bag = ShuffleBag(5)
+        rng = random.Random(0)
+        draws = [bag.draw(rng) for _ in range(50)]
+        for start in range(0, 50, 5):
+            assert sorted(draws[start:start + 5]) == [0, 1, 2, 3, 4]
+        assert all(first != second for first, second in zip(draws, draws[1:]))
+        
+        first = [bag.draw(rng), bag.draw(rng)]
+        bag.grow(7)
+        rest = [bag.draw(rng) for _ in range(5)]
+        assert sorted(first + rest) == list(range(7))
+        with pytest.raises(ValueError):
+            ShuffleBag(0).draw()
+    
+    def test_seeded_agents_are_reproducible(self):
+        """Test that agents with the same seed choose the same personas"""
+        def personas(agent):
+            choices = []
+            for _ in range(10):
+                agent.change_persona()
+                choices.append(agent._prompt_handle)
+            return choices
+        
+        assert personas(DynamicAgent(seed=5)) == personas(DynamicAgent(seed=5))
+        assert personas(DynamicAgent(seed=5)) != personas(DynamicAgent(seed=6))
+    
+    def test_shuffled_agent_avoids_repeats(self):
+        """Test that a shuffling agent uses every profile before repeating one"""
+        agent = DynamicAgent(seed=1, shuffle=True)
+        num_profiles = len(agent.system_prompt_skill.list_available_profiles())
+        roles = []
+        for _ in range(num_profiles * 2):
+            agent.change_persona()
+            roles.append(agent.get_current_persona()['role'])
+        assert len(set(roles[:num_profiles])) == num_profiles
+        assert len(set(roles[num_profiles:])) == num_profiles
+        assert all(first != second for first, second in zip(roles, roles[1:]))
+
+
+class TestConversationHistory:
+    """Test the bounded conversation history"""
+    
+    def test_ring_buffer_evicts_oldest(self):
+        """Test that a full history evicts its oldest messages"""
+        evicted = []
+        history = ConversationHistory(max_length=3, on_evict=evicted.append)
+        for index in range(5):
+            history.add('user', f'message {index}')
+        assert [message['content'] for message in history] == ['message 2', 'message 3', 'message 4']
+        assert [message['content'] for message in evicted] == ['message 0', 'message 1']
+        assert history[-1] == {'role': 'user', 'content': 'message 4'}
+        assert history[1:] == [history[1], history[2]]
+        assert history.evicted_count == 2
+    
+    def test_auto_clear(self):
+        """Test that auto_clear empties a full history before appending"""
+        evicted = []
+        history = ConversationHistory(max_length=2, auto_clear=True, on_evict=evicted.append)
+        for index in range(3):
+            history.add('user', str(index))
+        assert history == [{'role': 'user', 'content': '2'}]
+        assert len(evicted) == 2
+    
+    def test_agent_honors_config(self):
+        """Test that agents take history limits from their configuration"""
+        evicted = []
+        agent = DynamicAgent(config=AgentConfig({'max_history_length': 2}), on_evict=evicted.append)
+        for index in range(4):
+            agent.add_to_history('user', str(index))
+        assert [message['content'] for message in agent.get_conversation_history()] == ['2', '3']
+        assert len(evicted) == 2
+        assert DynamicAgent().get_history_view().max_length == 1000
+
+
+class TestArenaHistory:
+    """Test the columnar arena history backend"""
+    
+    def test_matches_deque_backend(self):
+        """Test that both backends hold the same messages under eviction"""
+        evicted = ([], [])
+        histories = (
+            ConversationHistory(max_length=50, on_evict=evicted[0].append),
+            ArenaHistory(max_length=50, on_evict=evicted[1].append, chunk_size=128),
+        )
+        for index in range(500):
+            for history in histories:
+                history.add(('user', 'assistant')[index % 2], f'message {index} ' + '\u00e9' * (index % 40))
+        assert histories[1] == list(histories[0])
+        assert histories[1][10:13] == histories[0][10:13]
+        assert evicted[0] == evicted[1]
+        assert len(histories[1]._chunks) < 500 // 2
+    
+    def test_columns(self):
+        """Test role codes, persona IDs and zero-copy content views"""
+        history = ArenaHistory(chunk_size=16)
+        history.add('user', 'hello', persona=3)
+        view = history.content_view(0)
+        history.add('tool', 'a message longer than one chunk')
+        assert bytes(view) == b'hello'
+        assert view.readonly
+        assert history.role(1) == 'tool'
+        assert history.persona(0) == 3
+        assert history.persona(1) == 0
+        assert history.content(-1) == 'a message longer than one chunk'
+        with pytest.raises(IndexError):
+            history.role(2)
+    
+    def test_chunks_grow_geometrically(self):
+        """Test that short sessions get a small arena and chunks double up to chunk_size"""
+        history = ArenaHistory()
+        for index in range(10):
+            history.add('user', f'short message {index}')
+        assert history.arena_size() == ArenaHistory.FIRST_CHUNK_SIZE
+        history = ArenaHistory(chunk_size=1024)
+        for _ in range(100):
+            history.add('user', 'x' * 100)
+        sizes = [len(chunk) for chunk in history._chunks.values()]
+        assert sizes[:3] == [256, 512, 1024]
+        assert max(sizes) == 1024
+        assert history.content(-1) == 'x' * 100
+    
+    def test_replace_oldest_in_place(self):
+        """Test that replacing old rows keeps token totals and frees their chunks"""
+        history = ArenaHistory(max_length=30, chunk_size=64)
+        for index in range(50):
+            history.add('user', f'message {index:02d}')
+        history.replace_oldest(25, 'system', 'summary')
+        assert list(history) == [{'role': 'system', 'content': 'summary'}] + [
+            {'role': 'user', 'content': f'message {index:02d}'} for index in range(45, 50)
+        ]
+        assert history.token_total == sum(history.count_tokens(message['content']) for message in history)
+        for index in range(50, 100):
+            history.add('user', f'message {index:02d}')
+            assert history.arena_size() <= 64 * 10
+        assert history[0]['content'] == 'message 70'
+        assert history.token_total == sum(history.count_tokens(message['content']) for message in history)
+    
+    def test_agent_arena_backend(self):
+        """Test an agent using the arena backend"""
+        agent = DynamicAgent(history_backend='arena')
+        agent.initialize_persona_custom('researcher', 'professional')
+        agent.add_to_history('user', 'Hello')
+        agent.change_persona_delta('educator', 'professional')
+        assert agent.get_conversation_history()[0] == {'role': 'user', 'content': 'Hello'}
+        history = agent.get_history_view()
+        assert isinstance(history, ArenaHistory)
+        assert history[0] == {'role': 'user', 'content': 'Hello'}
+        assert history[1]['role'] == 'system'
+        assert agent.get_history_token_count() > 0
+        with pytest.raises(ValueError):
+            DynamicAgent(history_backend='unknown')
+
+
+class TestSpillingHistory:
+    """Test spilling old history to a segment file"""
+    
+    def test_spills_and_reads_back(self, tmp_path):
+        """Test that only the tail stays resident and spilled messages read back"""
+        path = str(tmp_path / 'session.seg')
+        history = SpillingHistory(path=path, resident_limit=3, count_tokens=len)
+        expected = []
+        for index in range(20):
+            message = {'role': ('user', 'assistant')[index % 2], 'content': f'message {index} \u00e9'}
+            history.append(message)
+            expected.append(message)
+        assert len(history._messages) == 3
+        assert history.spilled_count() == 17
+        assert history == expected
+        assert history[5] == expected[5]
+        assert history[-1] == expected[-1]
+        assert history[2:6] == expected[2:6]
+        assert history.token_total == sum(len(message['content']) for message in expected)
+        assert history.get_window(len(expected[-1]['content']) * 5) == expected[-5:]
+        history.close()
+    
+    def test_eviction_drains_segment(self, tmp_path):
+        """Test that max_length evicts spilled messages first and reclaims the file"""
+        evicted = []
+        path = str(tmp_path / 'session.seg')
+        history = SpillingHistory(max_length=5, on_evict=evicted.append, path=path, resident_limit=2)
+        for index in range(7):
+            history.add('user', str(index))
+        assert [message['content'] for message in history] == ['2', '3', '4', '5', '6']
+        assert [message['content'] for message in evicted] == ['0', '1']
+        history.clear()
+        assert len(history) == 0
+        assert not os.path.exists(path)
+        history.close()
+    
+    def test_bounded_history_keeps_segment_bounded(self, tmp_path):
+        """Test that evicted records are compacted out of the file in steady state"""
+        history = SpillingHistory(max_length=100, path=str(tmp_path / 'session.seg'), resident_limit=10)
+        for index in range(10_000):
+            history.add('user', f'message {index}')
+        assert len(history) == 100
+        assert len(history.segment) <= 2 * max(SpillingHistory.compact_threshold, 90)
+        assert [message['content'] for message in history][:2] == ['message 9900', 'message 9901']
+        assert history[-1] == {'role': 'user', 'content': 'message 9999'}
+        history.close()
+    
+    def test_segment_file_lifetime(self, tmp_path):
+        """Test that the segment file is created on the first spill and deleted on close"""
+        path = tmp_path / 'session.seg'
+        history = SpillingHistory(path=str(path), resident_limit=2)
+        history.add('user', 'a')
+        history.add('user', 'b')
+        assert not path.exists()
+        history.add('user', 'c')
+        assert path.exists()
+        history.close()
+        assert not path.exists()
+        config = AgentConfig({'history_resident_length': 1, 'history_spill_dir': str(tmp_path)})
+        with DynamicAgent(config=config, history_backend='spill') as agent:
+            agent.add_to_history('user', 'first')
+            agent.add_to_history('user', 'second')
+            assert len(os.listdir(tmp_path)) == 1
+        assert os.listdir(tmp_path) == []
+        agent = DynamicAgent(config=config, history_backend='spill')
+        agent.add_to_history('user', 'first')
+        agent.add_to_history('user', 'second')
+        del agent
+        assert os.listdir(tmp_path) == []
+    
+    def test_agent_spill_backend(self, tmp_path):
+        """Test an agent spilling history into the configured directory"""
+        config = AgentConfig({'history_resident_length': 2, 'history_spill_dir': str(tmp_path)})
+        agent = DynamicAgent(config=config, history_backend='spill')
+        for index in range(5):
+            agent.add_to_history('user', str(index))
+        history = agent.get_history_view()
+        assert history.spilled_count() == 3
+        assert os.path.dirname(history.segment.path) == str(tmp_path)
+        assert [message['content'] for message in history] == ['0', '1', '2', '3', '4']
+        history.close()
+
+    def test_replace_oldest_skips_spilled_records(self, tmp_path, monkeypatch):
+        """Test that replacing spilled messages neither reads nor rewrites the segment"""
+        history = SpillingHistory(path=str(tmp_path / 'replace.seg'), resident_limit=4)
+        for index in range(20):
+            history.add('user', f'message {index}')
+
+        def unexpected_read(index):
+            raise AssertionError("spilled record read")
+        monkeypatch.setattr(history.segment, 'read', unexpected_read)
+        history.replace_oldest(10, 'system', 'summary', persona=3)
+        history.replace_oldest(2, 'system', 'newer summary', persona=3)
+        assert len(history.segment) == 16
+        assert history.persona(0) == 3
+        monkeypatch.undo()
+
+        contents = [message['content'] for message in history]
+        assert contents == ['newer summary'] + [f'message {index}' for index in range(11, 20)]
+        assert history.get_window(10 ** 6) == list(history)
+        assert history.token_total == sum(history.count_tokens(content) for content in contents)
+        history.replace_oldest(8, 'system', 'latest summary')
+        assert [message['content'] for message in history] == ['latest summary', 'message 18', 'message 19']
+        assert history.spilled_count() == 0
+        assert history.token_total == sum(history.count_tokens(message['content']) for message in history)
+        history.close()
+
+
+class TestHistoryCompaction:
+    """Test background history compaction"""
+    
+    def test_truncating_summarizer(self):
+        """Test that summaries extract first sentences and stay bounded"""
+        messages = [{'role': 'user', 'content': f'Question {index}. More detail here.'} for index in range(20)]
+        summary = truncating_summarizer(messages, max_lines=3)
+        assert summary.startswith('Summary of 20 earlier messages (17 older ones omitted):')
+        assert '- user: Question 19.' in summary
+        assert 'More detail' not in summary
+        assert truncating_summarizer([{'role': 'user', 'content': 'x' * 200}], max_chars=10).endswith('xxxxxxx...')
+    
+    @pytest.mark.parametrize('backend', ['deque', 'arena'])
+    def test_agent_history_stays_flat(self, backend):
+        """Test that summaries replace old messages on a later append"""
+        compactor = HistoryCompactor(threshold=10, keep_recent=4)
+        agent = DynamicAgent(compactor=compactor, history_backend=backend)
+        for index in range(11):
+            agent.add_to_history('user', f'message {index}')
+        assert compactor.wait(timeout=5)
+        history = agent.get_history_view()
+        assert len(history) == 5
+        assert history[0]['role'] == 'system'
+        assert history[0]['content'].startswith('Summary of 7 earlier messages')
+        assert [message['content'] for message in history[1:]] == [f'message {index}' for index in range(7, 11)]
+        assert history.token_total == sum(agent.system_prompt_skill.count_tokens(message['content'])
+                                          for message in history)
+        
+        for index in range(11, 100):
+            agent.add_to_history('user', f'message {index}')
+            compactor.wait(timeout=5)
+        assert len(agent.get_conversation_history()) <= 11
+        compactor.shutdown()
+    
+    def test_stale_summary_is_discarded(self):
+        """Test that a summary is dropped if the history was cleared meanwhile"""
+        compactor = HistoryCompactor(threshold=3, keep_recent=1)
+        history = ConversationHistory()
+        for index in range(4):
+            history.add('user', str(index))
+        compactor.after_append(history)
+        history.clear()
+        history.add('user', 'fresh')
+        assert not compactor.wait(timeout=5)
+        assert history == [{'role': 'user', 'content': 'fresh'}]
+        compactor.shutdown()
+
+
+class TestHistoryWindow:
+    """Test running token totals and token-budget windows"""
+    
+    @pytest.mark.parametrize('history_class', [ConversationHistory, ArenaHistory])
+    def test_running_total_and_window(self, history_class):
+        """Test that totals follow appends and evictions and windows fit budgets"""
+        history = history_class(max_length=4, count_tokens=len)
+        for content in ('aaaa', 'bb', 'cccccc', 'd', 'eee'):
+            history.add('user', content)
+        assert history.token_total == 2 + 6 + 1 + 3
+        assert [message['content'] for message in history.get_window(4)] == ['d', 'eee']
+        assert [message['content'] for message in history.get_window(10)] == ['cccccc', 'd', 'eee']
+        assert history.get_window(2) == []
+        assert len(history.get_window(100)) == 4
+        history.clear()
+        assert history.token_total == 0
+    
+    def test_agent_window_counts_prompt(self):
+        """Test that agent windows leave room for the system prompt"""
+        agent = DynamicAgent(tokenizer=EncoderTokenizer(list))
+        agent.initialize_persona_custom('researcher', 'professional')
+        prompt_tokens = agent.get_prompt_token_count()
+        for content in ('first', 'second', 'third'):
+            agent.add_to_history('user', content)
+        assert agent.get_history_token_count() == len('firstsecondthird')
+        window = agent.get_window(prompt_tokens + len('secondthird'))
+        assert [message['content'] for message in window] == ['second', 'third']
+        assert agent.get_window(prompt_tokens) == []
+
+
+class TestPersonaTags:
+    """Test persona-tagged history and history-preserving switches"""
+
+    @pytest.mark.parametrize('history_class', [ConversationHistory, ArenaHistory, SpillingHistory])
+    def test_tags_survive_storage(self, history_class, tmp_path):
+        """Test that persona IDs follow messages through eviction, spilling and compaction"""
+        options = {'resident_limit': 2, 'path': str(tmp_path / 'tags.seg')} \
+            if history_class is SpillingHistory else {}
+        history = history_class(max_length=5, **options)
+        for index in range(6):
+            history.add('user', f'message {index}', persona=index % 2 + 1)
+        assert [history.persona(index) for index in range(len(history))] == [2, 1, 2, 1, 2]
+        assert history.persona_positions(1) == [1, 3]
+        assert [message['content'] for message in history.messages_by_persona(2)] == [
+            'message 1', 'message 3', 'message 5'
+        ]
+        history.replace_oldest(2, 'system', 'summary')
+        assert [history.persona(index) for index in range(len(history))] == [0, 2, 1, 2]
+        assert history.messages_by_persona(0) == [{'role': 'system', 'content': 'summary'}]
+        if history_class is SpillingHistory:
+            history.close()
+
+    def test_switch_keeps_history(self):
+        """Test that switches keep tagged history when keep_history_on_switch is set"""
+        agent = DynamicAgent(keep_history_on_switch=True)
+        agent.initialize_persona_custom('researcher', 'professional')
+        researcher = agent.current_persona_id
+        agent.add_to_history('user', 'What is machine learning?')
+        agent.add_to_history('assistant', 'From a data science view...')
+        agent.initialize_persona_custom('educator', 'friendly')
+        agent.add_to_history('assistant', 'Put simply...')
+        assert len(agent.get_conversation_history()) == 3
+        assert agent.current_persona_id != researcher
+        assert [message['content'] for message in agent.get_messages_by_persona()] == ['Put simply...']
+        assert len(agent.get_messages_by_persona(researcher)) == 2
+        assert agent.get_persona_handle(researcher) == PromptHandle('researcher', 'professional')
+        agent.initialize_persona_custom('researcher', 'professional')
+        assert agent.current_persona_id == researcher
+        with pytest.raises(ValueError):
+            agent.get_persona_handle(99)
+
+    def test_default_switch_clears_history(self):
+        """Test that switches still reset the conversation by default"""
+        agent = DynamicAgent()
+        agent.initialize_persona_custom('researcher', 'professional')
+        agent.add_to_history('user', 'Hello')
+        agent.initialize_persona_custom('educator', 'friendly')
+        assert len(agent.get_conversation_history()) == 0
+        assert agent.current_persona_id == 1
+
+    def test_persona_ids_are_reused(self):
+        """Test that IDs no message carries any more are handed out again"""
+        agent = DynamicAgent(config=AgentConfig({'max_history_length': 2}), keep_history_on_switch=True)
+        agent.min_persona_table = 4
+        skill = agent.system_prompt_skill
+        pairs = [(profile, style) for profile in skill.profile_manager.get_profile_keys()
+                 for style in skill.characteristic_manager.get_style_keys()]
+        for profile, style in pairs:
+            agent.initialize_persona_custom(profile, style)
+            agent.add_to_history('user', f'{profile} {style}')
+        assert len(pairs) > 8
+        assert max(agent.conversation_history.personas()) <= 5
+        for message, persona_id in zip(agent.get_conversation_history(), agent.conversation_history.personas()):
+            assert ' '.join(agent.get_persona_handle(persona_id)) == message['content']
+        restored = DynamicAgent.from_snapshot(agent.snapshot(), keep_history_on_switch=True)
+        restored.initialize_persona_custom(*pairs[0])
+        assert restored.get_persona_handle(restored.current_persona_id) == PromptHandle(*pairs[0])
+        agent.clear_history()
+        assert agent.current_persona_id == 1
+        assert agent.get_persona_handle(1) == PromptHandle(*pairs[-1])
+
+    def test_delta_switch_tags_new_persona(self):
+        """Test that the delta message is tagged with the persona it switches to"""
+        agent = DynamicAgent()
+        agent.initialize_persona_custom('educator', 'friendly')
+        agent.add_to_history('user', 'Hello')
+        delta = agent.change_persona_delta('educator', 'concise')
+        assert agent.get_messages_by_persona() == [{'role': 'system', 'content': delta}]
+        assert agent.get_persona_handle(agent.current_persona_id) == PromptHandle('educator', 'concise')
+
+
+class TestAgentSnapshots:
+    """Test binary agent snapshots"""
+
+    def _session(self, **kwargs):
+        """An agent with two personas and a short tagged history"""
+        agent = DynamicAgent(seed=7, keep_history_on_switch=True, **kwargs)
+        agent.initialize_persona_custom('researcher', 'professional')
+        agent.add_to_history('user', 'What is machine learning?')
+        agent.add_to_history('assistant', '从数据科学的角度来看，机器学习是...')
+        agent.initialize_persona_for_budget(10_000, 'educator', 'friendly')
+        agent.add_to_history('assistant', 'Put simply...')
+        return agent
+
+    def test_round_trip(self):
+        """Test that a restored agent matches the original and continues identically"""
+        agent = self._session(shuffle=True)
+        data = agent.snapshot()
+        assert agent.get_system_prompt().encode('utf-8') not in data
+        restored = DynamicAgent.from_snapshot(data, history_backend='arena', keep_history_on_switch=True)
+        assert restored.get_system_prompt() == agent.get_system_prompt()
+        assert restored.get_current_persona() == agent.get_current_persona()
+        assert restored.get_conversation_history() == agent.get_conversation_history()
+        assert restored.get_messages_by_persona(1) == agent.get_messages_by_persona(1)
+        assert restored.current_persona_id == agent.current_persona_id
+        assert restored.get_history_token_count() == agent.get_history_token_count()
+        for _ in range(5):
+            assert restored.change_persona() == agent.change_persona()
+
+    def test_delta_switch_state(self):
+        """Test that a delta switch restores the current keys apart from the prompt keys"""
+        agent = DynamicAgent()
+        agent.initialize_persona_custom('educator', 'friendly')
+        agent.change_persona_delta('educator', 'concise')
+        restored = DynamicAgent.from_snapshot(agent.snapshot())
+        assert restored.get_current_persona()['tone'] == agent.get_current_persona()['tone']
+        assert restored.get_system_prompt() == agent.get_system_prompt()
+        assert restored.get_prompt_token_count() == agent.get_prompt_token_count()
+
+    def test_space_style_round_trip(self):
+        """Test restoring a space-style session into agents on fresh catalogs"""
+        agent = DynamicAgent(seed=3, keep_history_on_switch=True)
+        agent.initialize_persona_with_space_style('researcher')
+        agent.add_to_history('user', 'Hello')
+        agent.change_persona_delta('educator', agent.system_prompt_skill.current_style_key)
+        restored = DynamicAgent.from_snapshot(agent.snapshot(), keep_history_on_switch=True)
+        assert restored.system_prompt_skill.characteristic_manager.talking_styles.keys() == \
+            agent.system_prompt_skill.characteristic_manager.talking_styles.keys()
+        assert restored.system_prompt_skill.current_style_key.startswith('space_')
+        assert restored.get_system_prompt() == agent.get_system_prompt()
+        assert restored.get_current_persona() == agent.get_current_persona()
+        assert restored.get_conversation_history() == agent.get_conversation_history()
+        assert restored.get_prompt_token_count() == agent.get_prompt_token_count()
+
+    def test_runtime_catalog_keys_round_trip(self, tmp_path):
+        """Test restoring a session on keys another process added to a shared store"""
+        path = str(tmp_path / 'personas.db')
+        AgentProfileManager.from_sqlite(path).profiles.add_many(AgentProfileManager().profiles)
+        agent = DynamicAgent(profile_manager=AgentProfileManager.from_sqlite(path))
+        restored_manager = AgentProfileManager.from_sqlite(path)
+        agent.system_prompt_skill.profile_manager.add_profile('statistician', AgentProfile(
+            role='Statistician',
+            name='Sam Fisher',
+            description='Designs surveys and sampling plans',
+            expertise_areas=['statistics', 'survey design']
+        ))
+        agent.initialize_persona_custom('statistician', 'concise')
+        agent.add_to_history('user', 'How large a sample do I need?')
+        restored = DynamicAgent.from_snapshot(agent.snapshot(), profile_manager=restored_manager)
+        assert restored.get_system_prompt() == agent.get_system_prompt()
+        assert restored.get_current_persona()['agent_name'] == 'Sam Fisher'
+        assert restored.get_conversation_history() == agent.get_conversation_history()
+
+    def test_empty_agent(self):
+        """Test snapshots of an agent without a persona"""
+        restored = DynamicAgent.from_snapshot(DynamicAgent().snapshot())
+        assert restored.get_system_prompt() is None
+        assert restored.get_current_persona() == {}
+        assert len(restored.get_conversation_history()) == 0
+
+    def test_rejects_bad_snapshots(self):
+        """Test that corrupt snapshots and unknown catalog keys raise ValueError"""
+        data = self._session().snapshot()
+        agent = DynamicAgent()
+        with pytest.raises(ValueError):
+            agent.restore(b'XXXX' + data[4:])
+        with pytest.raises(ValueError):
+            agent.restore(data[:len(data) // 2])
+        profiles = AgentProfileManager()
+        profiles.profiles.pop('educator')
+        with pytest.raises(ValueError):
+            DynamicAgent.from_snapshot(data, profile_manager=profiles)
+
+
+class TestPersonaDelta:
+    """Test incremental persona switches"""
+    
+    def test_delta_lists_only_changed_fields(self):
+        """Test that a style-only switch reports only style fields"""
+        skill = SystemPromptSkill()
+        delta = skill.build_persona_delta(
+            PromptHandle('educator', 'friendly'), PromptHandle('educator', 'concise')
+        )
+        assert '- Tone: direct and efficient' in delta
+        assert '- Pace: fast' in delta
+        assert '- Name:' not in delta
+        assert '- Formality Level:' in delta
+        assert '- Verbosity: concise' in delta
+        assert len(delta) < len(skill.generate_system_prompt_custom('educator', 'concise'))
+    
+    @pytest.mark.parametrize('backend', ['deque', 'arena', 'spill'])
+    def test_summary_role_is_configurable(self, backend):
+        """Test that summaries can be added as user turns"""
+        compactor = HistoryCompactor(threshold=10, keep_recent=4, summary_role='user')
+        agent = DynamicAgent(compactor=compactor, history_backend=backend)
+        for index in range(11):
+            agent.add_to_history('user', f'message {index}')
+        assert compactor.wait(timeout=5)
+        agent.add_to_history('assistant', 'reply')
+        history = agent.get_conversation_history()
+        assert {message['role'] for message in history} == {'user', 'assistant'}
+        assert history[0]['content'].startswith('Summary of')
+        compactor.shutdown()
+    
+    def test_delta_for_same_persona_is_empty(self):
+        """Test that switching to the same persona produces no delta"""
+        skill = SystemPromptSkill()
+        handle = PromptHandle('mentor', 'nurturing')
+        assert skill.build_persona_delta(handle, handle) == ''
+    
+    def test_agent_delta_switch_keeps_history(self):
+        """Test that a delta switch appends to history instead of clearing it"""
+        agent = DynamicAgent()
+        prompt = agent.initialize_persona_custom('researcher', 'professional')
+        agent.add_to_history('user', 'Hello')
+        
+        delta = agent.change_persona_delta('educator', 'professional')
+        history = agent.get_conversation_history()
+        assert len(history) == 2
+        assert history[1] == {'role': 'system', 'content': delta}
+        assert '- Name: Professor Marcus' in delta
+        assert '- Tone:' not in delta
+        assert agent.get_system_prompt() == prompt
+        assert agent.get_current_persona()['agent_name'] == 'Professor Marcus'
+    
+    def test_delta_role_is_configurable(self):
+        """Test that delta messages can be added as user turns"""
+        agent = DynamicAgent(delta_role='user')
+        agent.initialize_persona_custom('researcher', 'professional')
+        agent.add_to_history('user', 'Hello')
+        
+        delta = agent.change_persona_delta('educator', 'professional')
+        assert agent.get_conversation_history()[1] == {'role': 'user', 'content': delta}
+    
+    def test_delta_switch_requires_persona(self):
+        """Test that a delta switch needs an active persona"""
+        agent = DynamicAgent()
+        with pytest.raises(ValueError):
+            agent.change_persona_delta()
+
+
+class TestPersonaRouter:
+    """Test keyword routing for the adaptive conversation mode"""
+    
+    def test_route_by_expertise(self):
+        """Test routing messages to matching profiles"""
+        router = PersonaRouter(AgentProfileManager())
+        assert router.route('Can you run some statistics on this data?') == 'analyst'
+        assert router.route('I need career advice and motivation') == 'mentor'
+        assert router.route('Help me with long-term planning and forecasting') == 'strategist'
+        assert router.route('xyzzy') is None
+    
+    def test_router_sees_new_profiles(self):
+        """Test that the index is rebuilt after profiles are added"""
+        manager = AgentProfileManager()
+        router = PersonaRouter(manager)
+        assert router.route('cooking recipes') is None
+        manager.add_profile('chef', AgentProfile(
+            role='Chef',
+            name='Chef Remy',
+            description='A chef who loves cooking',
+            expertise_areas=['cooking', 'recipes']
+        ))
+        assert router.route('cooking recipes') == 'chef'
+    
+    def test_agent_adapts_persona(self):
+        """Test that an adaptive agent switches persona and keeps history"""
+        agent = DynamicAgent()
+        assert agent.adapt_persona('Explain this concept simply, I am learning') == 'educator'
+        assert agent.get_current_persona()['role'] == 'Educator'
+        style_key = agent.system_prompt_skill.current_style_key
+        agent.add_to_history('user', 'Explain this concept simply')
+        
+        assert agent.adapt_persona('Show me the statistics and data analysis') == 'analyst'
+        assert agent.get_current_persona()['role'] == 'Data Analyst'
+        assert agent.system_prompt_skill.current_style_key == style_key
+        assert len(agent.get_conversation_history()) == 2
+        
+        assert agent.adapt_persona('More statistics please') == 'analyst'
+        assert len(agent.get_conversation_history()) == 2
+
+
 class TestIntegration:
     """Integration tests for complete workflows"""
     
@@ -0,0 +1,56 @@
+"""
+Tokenizers
+Pluggable, offline token counters used for prompt and history token accounting
+"""
+
+import re
+from typing import Callable, Sequence
+
+
+class Tokenizer:
+    """
+    Interface for token counters
+    Any object with a count(text) -> int method can be used in its place
+    """
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens in text"""
+        raise NotImplementedError
+
+
+class ApproximateTokenizer(Tokenizer):
+    """
+    Offline approximation of BPE token counts
+    Latin words and digit runs cost one token per chars_per_token characters,
+    while each CJK character and each punctuation mark costs one token
+    """
+
+    _PIECE_PATTERN = re.compile(
+        r'[A-Za-z]+|\d+|[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]|[^\sA-Za-z\d]'
+    )
+
+    def __init__(self, chars_per_token: int = 4):
+        """Initialize with the average number of characters per word token"""
+        if chars_per_token < 1:
+            raise ValueError("chars_per_token must be at least 1")
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        """Return the approximate number of tokens in text"""
+        divisor = self.chars_per_token
+        return sum(
+            (len(piece) + divisor - 1) // divisor
+            for piece in self._PIECE_PATTERN.findall(text)
+        )
+
+
+class EncoderTokenizer(Tokenizer):
+    """Adapts an encode function (e.g. a BPE encoder's encode) to the Tokenizer interface"""
+
+    def __init__(self, encode: Callable[[str], Sequence]):
+        """Wrap a function that returns the token sequence for a text"""
+        self.encode = encode
+
+    def count(self, text: str) -> int:
+        """Return the length of the encoded text"""
+        return len(self.encode(text))